@@ -1,54 +1,206 @@
 # Originally written by Kyle McCulloh
 # Ported to Python by Norton Pengra
+#
+# Usage (from data/): python downloadAll.py [state ...]
+# Downloads the congressional districts and every state's census CSV, VTD and tract
+# shapefiles (or just the given states'), MAX_WORKERS at a time. The shapefiles stay
+# zipped ({state}/vtd.zip, {state}/tracts.zip), the pipeline reads them straight from
+# the archives. Interrupted downloads resume from their .part file on the next run.
+# A download is checked (zips opened, the census CSV decompressed) before it's renamed
+# into place. The sha256 of every file, downloaded now or already on disk, is checked
+# against checksums.sha256 on every run, and files that don't match are downloaded
+# again. Files that aren't listed there yet are added to it.
+import gzip
+import hashlib
 import io
+import logging
 import os
+import shutil
+import sys
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-def download116District():
-    if not os.path.isdir("116_congressional_districts"):
-        os.mkdir("116_congressional_districts")
+DISTRICTS_URL = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_cd116_20m.zip"
+CENSUS_URL = "http://censusdata.ire.org/{fips}/all_140_in_{fips}.P3.csv"
+VTD_URL = "https://www2.census.gov/geo/tiger/TIGER2012/VTD/tl_2012_{fips}_vtd10.zip"
+TRACTS_URL = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_{fips}_tract_500k.zip"
+
+CHECKSUMS_LOCATION = "checksums.sha256"
+MAX_WORKERS = 4
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60 # seconds
+
+class ChecksumError(ValueError):
+    "Raised if a downloaded file doesn't match its recorded checksum"
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def loadChecksums(path=CHECKSUMS_LOCATION):
+    "Returns {file: sha256} from a sha256sum style file"
+    checksums = {}
+    if os.path.isfile(path):
+        with io.open(path) as handle:
+            for line in handle:
+                if line.strip():
+                    digest, name = line.split(None, 1)
+                    checksums[name.strip()] = digest
+    return checksums
+
+def saveChecksums(checksums, path=CHECKSUMS_LOCATION):
+    with io.open(path, 'w') as handle:
+        for name in sorted(checksums):
+            handle.write(f"{checksums[name]}  {name}\n")
+
+def fetch(url, destination, expected=None, after=None):
+    """
+        Downloads url to destination through destination.part, resuming whatever a previous
+        attempt left there. after checks (and transforms) the finished download before it's
+        renamed into place, it takes the .part file and returns the path of the result.
+        Returns the sha256 of the file, raises ChecksumError if it doesn't match expected.
+        A download that fails its check or checksum is dropped, so the next run starts over.
+    """
+    part = destination + '.part'
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f"bytes={offset}-")
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            # A server that ignores the range sends the whole file again
+            mode = 'ab' if response.status == 206 else 'wb'
+            with open(part, mode) as handle:
+                shutil.copyfileobj(response, handle, CHUNK_SIZE)
+    except urllib.error.HTTPError as error:
+        # 416: the partial file is already the whole file
+        if error.code != 416 or not offset:
+            raise
+
+    finished = part
+    try:
+        if after is not None:
+            finished = after(part)
+        digest = sha256(finished)
+        if expected is not None and digest != expected:
+            raise ChecksumError(f"{url}: expected sha256 {expected}, got {digest}")
+    except Exception:
+        for path in set([part, finished]):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(finished, destination)
+    return digest
+
+def checkZip(path):
+    "Raises zipfile.BadZipFile if the archive is damaged (or isn't a zip at all), returns path"
+    with zipfile.ZipFile(path) as archive:
+        damaged = archive.testzip()
+    if damaged is not None:
+        raise zipfile.BadZipFile(f"{path}: {damaged} is damaged")
+    return path
 
-    target = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_cd116_20m.zip"
-    os.system(f"wget -O temp.zip https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_cd116_20m.zip")
-    os.system(f"unzip temp.zip -d 116_congressional_districts/")
-    os.system(f"rm temp.zip")
+def gunzip(path):
+    "Decompresses path (gzip data) into path + '.gunzip', removes path and returns the new path"
+    with gzip.open(path, 'rb') as source, open(path + '.gunzip', 'wb') as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+    os.remove(path)
+    return path + '.gunzip'
 
-def main():
-    with io.open("stateKeys.csv") as handle:
+def getFiles(states=None, stateKeys="stateKeys.csv"):
+    """
+        Returns (url, destination, post processing step) for every file of the given states (every
+        state by default), leaving out the shapefiles that were already extracted
+    """
+    files = []
+    if not os.path.isdir("116_congressional_districts"):
+        files.append((DISTRICTS_URL, "116_congressional_districts.zip", checkZip))
+
+    with io.open(stateKeys) as handle:
         lines = handle.readlines()
 
     for line in lines:
-        line = line.strip()
-        fips, state_code, state_name, state_ns = line.split(',')
+        fips, state_code, state_name = line.strip().split(',')[:3]
+        state_name = state_name.lower().replace(' ', '_')
+        if states and state_name not in states:
+            continue
 
         if not os.path.isdir(state_name):
             print(f"Creating Directory for {state_name}")
-            state_name = state_name.lower().replace(' ', '_')
-            os.mkdir(f"{state_name}")
-        else:
-            print(f"Directory already exists for {state_name}")
-
-        if not os.path.isfile(f"{state_name}/{state_name}.csv"):
-            print(f"Downloading 2010 {state_name.title()} Census Data")
-            os.system(f"wget -O - http://censusdata.ire.org/{fips}/all_140_in_{fips}.P3.csv | gunzip > {state_name}/{state_name}.csv")
-
-
-        if not os.path.isdir(f"{state_name}/vtd/"):
-            os.mkdir(f"{state_name}/vtd")
-            print(f"Downloading 2010 {state_name.title()} Census VTD shapefiles")
-            os.system(f"wget -O {state_name}/temp.zip https://www2.census.gov/geo/tiger/TIGER2012/VTD/tl_2012_{fips}_vtd10.zip")
-            os.system(f"unzip {state_name}/temp.zip -d {state_name}/vtd/")
-            os.system(f"rm {state_name}/temp.zip")
-
-        if not os.path.isdir(f"{state_name}/tracts/"):
-            os.mkdir(f"{state_name}/tracts")
-            print(f"Downloading 2018 {state_name.title()} Census Tract shapefiles")
-            os.system(f"wget -O {state_name}/temp.zip https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_{fips}_tract_500k.zip")
-            os.system(f"unzip {state_name}/temp.zip -d {state_name}/tracts/")
-            os.system(f"rm {state_name}/temp.zip")
-
+            os.mkdir(state_name)
         if not os.path.isdir(f"{state_name}/votes"):
             os.mkdir(f"{state_name}/votes")
 
+        files.append((CENSUS_URL.format(fips=fips), f"{state_name}/{state_name}.csv", gunzip))
+        if not os.path.isdir(f"{state_name}/vtd"):
+            files.append((VTD_URL.format(fips=fips), f"{state_name}/vtd.zip", checkZip))
+        if not os.path.isdir(f"{state_name}/tracts"):
+            files.append((TRACTS_URL.format(fips=fips), f"{state_name}/tracts.zip", checkZip))
+    return files
+
+def checkExisting(destination, after, checksums):
+    """
+        Checks a file that's already on disk against its recorded checksum. A file without one
+        is recorded now, once a zip passes checkZip. Returns False (and removes the file) if it's bad
+    """
+    digest = sha256(destination)
+    if destination in checksums:
+        if digest == checksums[destination]:
+            return True
+        logging.error(f"{destination} doesn't match its recorded sha256, downloading it again")
+    else:
+        try:
+            if after is checkZip:
+                checkZip(destination)
+            checksums[destination] = digest
+            return True
+        except zipfile.BadZipFile as error:
+            logging.error(f"{error}, downloading it again")
+    os.remove(destination)
+    return False
+
+def getJobs(files, checksums):
+    "Returns the files that have to be downloaded: the missing ones, and the ones that failed checkExisting"
+    return [(url, destination, after) for url, destination, after in files
+            if not os.path.isfile(destination) or not checkExisting(destination, after, checksums)]
+
+def runJob(job, checksums):
+    "Downloads and post processes one file, returns its sha256"
+    url, destination, after = job
+    print(f"Downloading {url}")
+    digest = fetch(url, destination, checksums.get(destination), after)
+    print(f"Finished {destination}")
+    return digest
+
+def downloadAll(jobs, checksums, workers=MAX_WORKERS):
+    """
+        Runs the jobs on a pool of workers, records the checksums of new files in checksums.
+        Returns {destination: exception} for every job that failed.
+    """
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(job, pool.submit(runJob, job, checksums)) for job in jobs]
+        for (url, destination, _), future in futures:
+            try:
+                checksums[destination] = future.result()
+            except Exception as error:
+                logging.error(f"Failed to download {url}: {error}")
+                failures[destination] = error
+    return failures
+
+def main(states=None):
+    checksums = loadChecksums()
+    jobs = getJobs(getFiles(states), checksums)
+    failures = downloadAll(jobs, checksums)
+    saveChecksums(checksums)
+    print(f"Downloaded {len(jobs) - len(failures)} of {len(jobs)} files")
+    return 1 if failures else 0
+
 if __name__ == "__main__":
-    download116District()
-    # main()
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
@@ -8,32 +8,27 @@ import sys
 import logging
 import os
 
-import stateparser
-import merged2output
+from pipeline import (
+    processState,
+    sanityChecks,
+    planState,
+    unknownArguments
+)
 
 from exceptions import (
-    DirectoryNotFoundError,
-    NoGISFilesFoundException,
-    NoCSVFilesFoundException
+    DirectoryNotFoundError
 )
 
+from journal import RunJournal
+
 from util import (
     # Constants
     INPUT_PREFIX,
     OUTPUT_PREFIX,
-    OUTPUT_IDX_LOCATION,
-    OUTPUT_JSON_LOCATION,
-)
+    CACHE_LOCATION,
 
-from stateparser import (
-    VTD_LOCATION,
-    TRACTS_LOCATION,
-    VOTES_LOCATION,
-    DEMOGRAPHIC_LOCATION
-)
-
-from merged2output import (
-    MERGED_DF_INPUT
+    # Functions
+    cleanTemporaryFiles
 )
 
 # This is the default set of states that the method will run on
@@ -41,58 +36,6 @@ from merged2output import (
 # TODO: remove this list
 WORKING = ['iowa']
 
-def processState(state: str, args):
-    """
-        Converts a state directory (location of GIS and CSV file) and produces an .idx and .json file.
-        Assumes the proper state GIS/CSV files exist
-    """
-    logging.info(f"Processing state: {state}")
-    if '-use_cache' in args:
-        logging.info(f"Attempting to use previously cached stateparser data..")
-        if not os.path.exists(MERGED_DF_INPUT.format(state=state)):
-            logging.info(f"Cannot find cached data for {state}")
-            logging.info(f"Running stateparser({state})")
-            stateparser.main(state)
-        else:
-            logging.info(f"Found cached data for {state}!")
-    else:
-        logging.info(f"Running stateparser({state})")
-        stateparser.main(state)
-    
-    #-idx, -readable, -json, -novert, -all, or NONE, Documentation in merged2output.py
-    # default merged2output args
-    outputArgs = [state] # default merged2output args
-    for arg in args:
-        if arg.startswith('-') and arg != '-use_cache':
-            outputArgs.append(arg)
-
-    if '-parse' not in args:
-        logging.info(f"Running merged2output({str(outputArgs)[1:-1]})")
-        merged2output.main(outputArgs)
-    
-def sanityChecks(state: str):
-    if not os.path.isdir(VTD_LOCATION.format(state=state)):
-            logging.warning(f"VTD gis files not found for {state}")
-            raise NoGISFilesFoundException()
-
-    if not os.path.isdir(TRACTS_LOCATION.format(state=state)):
-        logging.warning(f"Census tract gis files not found for {state}")
-        raise NoGISFilesFoundException()
-
-    if not os.path.isdir(VOTES_LOCATION.format(state=state)):
-        logging.warning(f"Voting data gis files not found for {state}")
-        raise NoGISFilesFoundException()
-
-    if not os.path.isfile(DEMOGRAPHIC_LOCATION.format(state=state)):
-        logging.warning(f"Demographics CSV file not found for {state}")
-        raise NoCSVFilesFoundException()
-
-    if os.path.isfile(OUTPUT_IDX_LOCATION.format(state=state)):
-        logging.warning(f"Overwriting existing IDX file for {state}")
-
-    if os.path.isfile(OUTPUT_JSON_LOCATION.format(state=state)):
-        logging.warning(f"Overwriting existing JSON file for {state}")
-
 def getArgs():
     args = []
     for arg in sys.argv:
@@ -113,11 +56,24 @@ def main():
     # Check if the directory containing states exist/output directory exists
     checkDirectories()
 
-    # Get args set
+    # Get args set, typos are caught before anything heavy is imported
     args = getArgs()
+    unknown = unknownArguments(args)
+    if unknown:
+        print("Unknown argument: " + ', '.join(unknown))
+        sys.exit(2)
+
+    # Outputs half written by runs that died, then where this run picks up from
+    journal = None
+    if '-plan' not in args:
+        for path in cleanTemporaryFiles(OUTPUT_PREFIX, CACHE_LOCATION):
+            logging.info(f"Removed the abandoned temporary file {path}")
+        journal = RunJournal(args, '-resume' in args)
+    elif '-resume' in args:
+        journal = RunJournal(args, resume=True)
 
     # Get state argument if it exists
-    stateList = os.listdir(INPUT_PREFIX)
+    stateList = sorted(os.listdir(INPUT_PREFIX))
     if len(sys.argv) > 1:
         if sys.argv[1] in stateList:
             stateList = [sys.argv[1]]
@@ -131,15 +87,20 @@ def main():
         if state in WORKING:
             logging.info(f"Found state {state}")
 
+            # Only describe what would run
+            if '-plan' in args:
+                print('\n'.join(planState(state, args, journal)))
+                continue
+
             # Sanity Checks for input data
-            sanityChecks(state)
+            sanityChecks(state, args)
 
             # Then perform processing
-            processState(state, args)
+            processState(state, args, journal)
 
 if __name__ == "__main__":
     # Quick sanity check before running huge process on each state
-    if len(sys.argv) == 1 or sys.argv[1].startswith('-') :
+    if (len(sys.argv) == 1 or sys.argv[1].startswith('-')) and '-plan' not in sys.argv:
         print('Are you sure you would like to process all states? [y/n] ')
         inp = input()
         if inp not in ['y', 'Y']:
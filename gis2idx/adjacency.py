@@ -0,0 +1,213 @@
+"""
+Adjacency modes for the precinct graph, besides merged2output.getNeighbors (queen contiguity
+through GEOS touches()).
+
+Rook contiguity: two precincts are neighbors if they share a stretch of boundary at least
+MIN_SHARED_LENGTH long, corner-only contacts don't count. Vertices are snapped to a grid,
+every boundary segment goes into a hash table keyed on its endpoints, and segments that show
+up in more than one precinct are shared boundary. That's one pass over every segment instead
+of a predicate per pair. Where the two sides of a border don't have the same vertices (a
+T-junction, or one side simplified), the segments left without a partner are split at the
+vertices lying on them and hashed again, which only costs a spatial query per unmatched segment.
+
+Connectivity repair: islands (and whatever dropWater leaves stranded) end up as components
+of the graph that can't be reached from the rest of the state. connectComponents links every
+minor component to the nearest precinct of the largest one, through a KD-tree over the
+boundary vertices of the largest component, and reports those synthetic edges.
+
+Parallel queen contiguity: getParallelNeighbors answers the same touches() question as
+getNeighbors across a process pool. The geometries are written once to a geometry arena (see
+arena.py), and every worker rebuilds only the geometries its slice compares.
+"""
+
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import arena
+
+SNAP_GRID = 0.1             # meters, vertices closer than this are the same vertex
+MIN_SHARED_LENGTH = 1.0     # meters, default rook threshold
+
+def getRings(geometry):
+    "Returns every ring of a polygon or multi-polygon"
+    polygons = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    rings = []
+    for polygon in polygons:
+        rings.append(polygon.exterior)
+        rings += list(polygon.interiors)
+    return rings
+
+def normalizeSegments(segments):
+    "Stores the smaller endpoint first, as both sides walk a shared segment in opposite directions"
+    flip = (segments[:, 0] > segments[:, 2]) | ((segments[:, 0] == segments[:, 2]) & (segments[:, 1] > segments[:, 3]))
+    segments[flip] = segments[flip][:, [2, 3, 0, 1]]
+    return segments
+
+def getSegments(geometries):
+    "Returns (snapped segment endpoints as an (n, 4) array, owner of every segment)"
+    endpoints, owners = [], []
+    for owner, geometry in enumerate(geometries):
+        for ring in getRings(geometry):
+            coords = np.round(np.asarray(ring.coords)[:, :2] / SNAP_GRID).astype(np.int64)
+            endpoints.append(np.hstack([coords[:-1], coords[1:]]))
+            owners.append(np.full(len(coords) - 1, owner, dtype=np.int64))
+
+    if not endpoints:
+        return np.zeros((0, 4), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    segments = np.vstack(endpoints)
+    owners = np.concatenate(owners)
+
+    # Drop segments that collapsed onto a single grid point
+    keep = (segments[:, 0] != segments[:, 2]) | (segments[:, 1] != segments[:, 3])
+    return normalizeSegments(segments[keep]), owners[keep]
+
+def hashSegments(segments, owners, groups=None):
+    "Adds every segment to a hash table keyed on its endpoints, returns {endpoints: [owner, ...]}"
+    groups = {} if groups is None else groups
+    for key, owner in zip(map(tuple, segments.tolist()), owners.tolist()):
+        groups.setdefault(key, []).append(owner)
+    return groups
+
+def splitSegments(segments, owners):
+    """
+        Splits every segment at the vertices of the other segments that lie on it (within a grid
+        cell), so a stretch of boundary one side draws with fewer vertices than the other ends up
+        as the same segments on both sides
+    """
+    vertices = np.unique(segments.reshape(-1, 2), axis=0)
+    tree = cKDTree(vertices)
+    pieces, pieceOwners = [], []
+    for (x0, y0, x1, y1), owner in zip(segments.tolist(), owners.tolist()):
+        dx, dy = x1 - x0, y1 - y0
+        squaredLength = dx * dx + dy * dy
+        nearby = vertices[tree.query_ball_point([(x0 + x1) / 2, (y0 + y1) / 2], squaredLength ** 0.5 / 2 + 1)]
+        along = (nearby[:, 0] - x0) * dx + (nearby[:, 1] - y0) * dy
+        across = np.abs((nearby[:, 1] - y0) * dx - (nearby[:, 0] - x0) * dy)
+        inside = (along > 0) & (along < squaredLength) & (across * across <= squaredLength)
+        points = [(x0, y0)] + [tuple(p) for p in nearby[inside][np.argsort(along[inside])].tolist()] + [(x1, y1)]
+        for start, stop in zip(points[:-1], points[1:]):
+            pieces.append(start + stop)
+            pieceOwners.append(owner)
+    return normalizeSegments(np.array(pieces, dtype=np.int64).reshape(-1, 4)), np.array(pieceOwners, dtype=np.int64)
+
+def getSharedLengths(geometries):
+    "Returns {(i, j): shared boundary length} for every pair i < j of geometries that share a segment"
+    segments, owners = getSegments(geometries)
+    groups = hashSegments(segments, owners)
+
+    # Segments on a single boundary are either the outline of the state, or boundary the other
+    # side draws through a vertex this side doesn't have: split them there and hash them again
+    unmatched = [key for key, members in groups.items() if len(set(members)) == 1]
+    if unmatched:
+        unmatchedOwners = np.array([groups.pop(key)[0] for key in unmatched], dtype=np.int64)
+        hashSegments(*splitSegments(np.array(unmatched, dtype=np.int64), unmatchedOwners), groups)
+
+    totals = {}
+    for (x0, y0, x1, y1), members in groups.items():
+        # Overlapping polygons can stack more than two on a segment, a ring that runs over itself isn't adjacency
+        members = sorted(set(members))
+        if len(members) < 2:
+            continue
+        length = math.hypot(x1 - x0, y1 - y0) * SNAP_GRID
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                pair = (members[a], members[b])
+                totals[pair] = totals.get(pair, 0.0) + length
+    return totals
+
+def getRookNeighbors(geometries, minSharedLength: float = MIN_SHARED_LENGTH):
+    """
+        Returns a 2D list that stores a list of neighbors for each precinct, only counting
+        precincts that share at least minSharedLength of boundary (geometries in a metric CRS)
+    """
+    neighbors = [[] for _ in geometries]
+    for (i, j), length in getSharedLengths(geometries).items():
+        if length >= minSharedLength:
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+    return [sorted(n) for n in neighbors]
+
+def getComponents(neighborsLists):
+    "Union-find over the graph, returns the component label (its smallest node) of every node"
+    parent = list(range(len(neighborsLists)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, neighbors in enumerate(neighborsLists):
+        for j in neighbors:
+            rootI, rootJ = find(i), find(j)
+            if rootI != rootJ:
+                parent[max(rootI, rootJ)] = min(rootI, rootJ)
+    return [find(i) for i in range(len(neighborsLists))]
+
+def getBoundaryVertices(geometries, nodes):
+    "Returns (the boundary vertices of the given nodes as an (n, 2) array, the node owning each vertex)"
+    coords, owners = [], []
+    for node in nodes:
+        for ring in getRings(geometries[node]):
+            ringCoords = np.asarray(ring.coords)[:, :2]
+            coords.append(ringCoords)
+            owners.append(np.full(len(ringCoords), node, dtype=np.int64))
+    return np.vstack(coords), np.concatenate(owners)
+
+def connectComponents(geometries, neighborsLists):
+    """
+        Links every component besides the largest to its nearest node in the largest
+        (geometries in a metric CRS). Returns (the new neighbor lists, the synthetic edges
+        as sorted (i, j, distance) tuples with i < j)
+    """
+    components = {}
+    for node, label in enumerate(getComponents(neighborsLists)):
+        components.setdefault(label, []).append(node)
+    if len(components) <= 1:
+        return neighborsLists, []
+
+    mainLabel = max(components, key=lambda label: len(components[label]))
+    mainCoords, mainOwners = getBoundaryVertices(geometries, components[mainLabel])
+    tree = cKDTree(mainCoords)
+
+    neighbors = [list(n) for n in neighborsLists]
+    synthetic = []
+    for label, nodes in components.items():
+        if label == mainLabel:
+            continue
+        coords, owners = getBoundaryVertices(geometries, nodes)
+        distances, nearest = tree.query(coords)
+        closest = int(np.argmin(distances))
+        i, j = int(owners[closest]), int(mainOwners[nearest[closest]])
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+        synthetic.append((min(i, j), max(i, j), float(distances[closest])))
+
+    return [sorted(n) for n in neighbors], sorted(synthetic)
+
+def getTouchingPairs(geometryArena, start: int, stop: int):
+    "Returns the (i, j) pairs, j < i, of touching geometries for every i in [start, stop)"
+    bounds = geometryArena.bounds
+    pairs = []
+    for i in range(start, stop):
+        minX, minY, maxX, maxY = bounds[i]
+        candidates = np.nonzero((bounds[:i, 0] <= maxX) & (bounds[:i, 2] >= minX) &
+                                (bounds[:i, 1] <= maxY) & (bounds[:i, 3] >= minY))[0]
+        geometry = geometryArena.geometry(i)
+        pairs += [(i, int(j)) for j in candidates if geometry.touches(geometryArena.geometry(int(j)))]
+    return pairs
+
+def getParallelNeighbors(geometries, arenaPath: str, workers: int = None):
+    """
+        Returns the same neighbor lists as merged2output.getNeighbors, computed across a process
+        pool from a geometry arena written to arenaPath
+    """
+    arena.write(arenaPath, geometries)
+    neighbors = [[] for _ in geometries]
+    for pairs in arena.mapSlices(arenaPath, getTouchingPairs, workers):
+        for i, j in pairs:
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+    return [sorted(n) for n in neighbors]
@@ -0,0 +1,111 @@
+"""
+A geometry arena: a state's geometries stored once, as WKB, in a file every worker process maps.
+The page cache shares the mapping between processes, so a pool reads the geometries zero copy and
+only rebuilds the GEOS geometries it touches, instead of unpickling every shapely object in every
+worker.
+
+Layout (big endian):
+    ARENA_HEADER_F      magic, number of geometries
+    u8[count + 1]       WKB offsets, relative to the start of the WKB
+    f8[count][4]        bounds (minx, miny, maxx, maxy) of every geometry
+    the WKB of every geometry, back to back
+"""
+
+import mmap
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from shapely import wkb
+
+from util import (
+    # Constants
+    ARENA_MAGIC_NUMBER,
+
+    # Functions
+    atomicOpen
+)
+
+ARENA_HEADER_F = '>IQ'      # 12 bytes: magic, count
+U8 = np.dtype('>u8')
+F8 = np.dtype('>f8')
+SLICE_SIZE = 256            # geometries handed to a worker at a time
+
+# Arenas already mapped by this process, by path
+_OPEN_ARENAS = {}
+
+def write(path: str, geometries):
+    "Writes geometries to an arena at path, replacing it once it's complete"
+    blobs = [geometry.wkb for geometry in geometries]
+    offsets = np.zeros(len(blobs) + 1, dtype=U8)
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+    bounds = np.array([geometry.bounds for geometry in geometries], dtype=F8).reshape(len(blobs), 4)
+
+    with atomicOpen(path, 'wb') as handle:
+        handle.write(struct.pack(ARENA_HEADER_F, ARENA_MAGIC_NUMBER, len(blobs)))
+        handle.write(offsets.tobytes())
+        handle.write(bounds.tobytes())
+        for blob in blobs:
+            handle.write(blob)
+    return path
+
+class GeometryArena(object):
+    "A memory mapped arena, geometries are rebuilt from it one at a time and kept once built"
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as handle:
+            self._buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count = struct.unpack_from(ARENA_HEADER_F, self._buffer)
+        if magic != ARENA_MAGIC_NUMBER:
+            raise ValueError(f"{path} is not a geometry arena (magic number {hex(magic)})")
+        position = struct.calcsize(ARENA_HEADER_F)
+        self.offsets = np.frombuffer(self._buffer, dtype=U8, count=count + 1, offset=position).astype(np.int64)
+        position += U8.itemsize * (count + 1)
+        self.bounds = np.frombuffer(self._buffer, dtype=F8, count=4 * count, offset=position) \
+            .astype(np.float64).reshape(count, 4)
+        self._start = position + F8.itemsize * 4 * count
+        self._geometries = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def wkb(self, i: int):
+        "Returns a zero copy view of the WKB of geometry i"
+        return memoryview(self._buffer)[self._start + self.offsets[i]:self._start + self.offsets[i + 1]]
+
+    def geometry(self, i: int):
+        "Returns geometry i, rebuilding it the first time it's asked for"
+        geometry = self._geometries.get(i)
+        if geometry is None:
+            geometry = self._geometries[i] = wkb.loads(bytes(self.wkb(i)))
+        return geometry
+
+    def close(self):
+        self._geometries = {}
+        self.offsets = self.bounds = None
+        self._buffer.close()
+
+def openArena(path: str):
+    "Returns this process' GeometryArena for path, mapping it the first time"
+    arena = _OPEN_ARENAS.get(path)
+    if arena is None:
+        arena = _OPEN_ARENAS[path] = GeometryArena(path)
+    return arena
+
+def _runSlice(task):
+    function, path, start, stop = task
+    return function(openArena(path), start, stop)
+
+def mapSlices(path: str, function, workers: int = None, sliceSize: int = SLICE_SIZE):
+    """
+        Runs function(arena, start, stop) over consecutive slices of the arena at path across a
+        process pool and returns the results in slice order. function has to be a module level
+        function, only it and the path are sent to the workers.
+    """
+    with open(path, 'rb') as handle:
+        count = struct.unpack(ARENA_HEADER_F, handle.read(struct.calcsize(ARENA_HEADER_F)))[1]
+    tasks = [(function, path, start, min(start + sliceSize, count)) for start in range(0, count, sliceSize)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_runSlice, tasks))
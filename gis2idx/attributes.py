@@ -0,0 +1,59 @@
+"""
+The declarative schema of the per-precinct attributes. Every attribute says where it's loaded
+from, and the PACKED_* lists say how the merged frame's columns are packed into the .idx, so
+adding a column only takes an entry here.
+
+Datasets:
+    demographics    the tract CSV (data/{state}/{state}.csv), spread over the VTDs by area
+                    (or the block CSV, with -blocks)
+    votes           the election result CSVs in data/{state}/votes/, already per precinct,
+                    joined onto the VTDs (see votes.py)
+"""
+
+from collections import namedtuple
+
+# name:     the column in the merged frame
+# column:   the column in the loaded dataset's table
+# sources:  the input CSV columns it's read from, summing every one that's present
+# dataset:  'demographics' or 'votes'
+Attribute = namedtuple('Attribute', ['name', 'column', 'sources', 'dataset'])
+
+ATTRIBUTES = [
+    Attribute('totalPop', 'TotalPop', ['P003001'], 'demographics'),     # Total
+    Attribute('whitePop', 'WhitePop', ['P003002'], 'demographics'),     # White alone
+    Attribute('blackPop', 'BlackPop', ['P003003'], 'demographics'),     # Black or African American alone
+    Attribute('nativeAPop', 'NativeAPop', ['P003004'], 'demographics'), # American Indian and Alaska Native alone
+    Attribute('asianPop', 'AsianPop', ['P003005'], 'demographics'),     # Asian alone
+    Attribute('pacisPop', 'PacIsPop', ['P003006'], 'demographics'),     # Native Hawaiian and Other Pacific Islander alone
+    Attribute('otherPop', 'OtherPop', ['P003007'], 'demographics'),     # Some Other Race alone
+    Attribute('multiPop', 'MultiPop', ['P003008'], 'demographics'),     # Two or More Races
+
+    # 2016 presidential results, in the Harvard Dataverse (VEST) column names or plain ones
+    Attribute('demVotes', 'demVotes', ['G16PREDCli', 'demVotes'], 'votes'),
+    Attribute('repVotes', 'repVotes', ['G16PRERTru', 'repVotes'], 'votes'),
+    Attribute('otherVotes', 'otherVotes', ['G16PRELJoh', 'G16PREGSte', 'G16PRECCas', 'G16PREIMcM',
+                                           'G16PREOth', 'otherVotes'], 'votes'),
+]
+
+# The .idx fields (DEMOGRAPHICS_F, and the v2 VOTE section), each the sum of these merged frame columns
+PACKED_DEMOGRAPHICS = [
+    ['totalPop'],
+    ['blackPop'],
+    ['nativeAPop'],
+    ['asianPop'],
+    ['whitePop'],
+    ['otherPop', 'pacisPop', 'multiPop'],
+]
+PACKED_VOTES = [
+    ['demVotes'],
+    ['repVotes'],
+    ['otherVotes'],
+]
+
+def getAttributes(dataset: str):
+    "Returns the attributes of one dataset, in schema order"
+    return [attribute for attribute in ATTRIBUTES if attribute.dataset == dataset]
+
+def getPackedColumns(packed):
+    "Returns every merged frame column a PACKED_* list reads"
+    return [column for columns in packed for column in columns]
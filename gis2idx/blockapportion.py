@@ -0,0 +1,182 @@
+"""
+Block level apportionment: every census block's population goes to the VTD that holds the
+block's interior point, instead of spreading tract populations over VTDs by overlapping area.
+
+A state has hundreds of thousands of blocks, so they are never held in memory at once:
+    1. The block interior points (from the TIGER tabblock shapefile's INTPTLON10/INTPTLAT10)
+       and the block demographics CSV are streamed, BATCH_SIZE rows at a time, into a scratch
+       SQLite database, each point tagged with the TILE_SIZE degree tile it falls in
+    2. SQLite joins the two and hands the blocks back sorted by tile
+    3. One tile at a time, the blocks are matched against the VTDs whose bounding box
+       overlaps the tile, through a spatial index over the VTDs
+Memory is bounded by the blocks in a tile, not by the size of the state.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+
+import fiona
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, box
+from shapely.prepared import prep
+
+from exceptions import (
+    NoGISFilesFoundException,
+    NoCSVFilesFoundException
+)
+
+from attributes import getAttributes
+from geoindex import GeometryIndex
+from util import (
+    # Constants
+    STATEPARSER_CACHE_LOCATION,
+    BLOCKS_LOCATION,
+    BLOCK_DEMOGRAPHIC_LOCATION,
+
+    # Functions
+    getShapefileSource,
+    shapefileExists
+)
+
+BLOCKS_DATABASE = STATEPARSER_CACHE_LOCATION + '{state}.blocks.sqlite'
+
+# The P3 columns of the block CSV, in stateparser.POPULATION_COLUMNS order
+BLOCK_COLUMNS = [attribute.sources[0] for attribute in getAttributes('demographics')]
+GEOID_LENGTH = 15   # state, county, tract and block
+
+TILE_SIZE = 0.05    # degrees
+BATCH_SIZE = 50000  # rows read, inserted or fetched at a time
+
+def createDatabase(path: str):
+    "Returns a connection to a fresh scratch database"
+    if os.path.isfile(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE points (geoid TEXT PRIMARY KEY, tileX INTEGER, tileY INTEGER, x REAL, y REAL)")
+    connection.execute("CREATE TABLE populations (geoid TEXT PRIMARY KEY, "
+                       + ', '.join(f"{column} INTEGER" for column in BLOCK_COLUMNS) + ")")
+    return connection
+
+def loadPoints(connection, location: str):
+    "Streams the block interior points of a tabblock shapefile into the database"
+    count = 0
+    with fiona.open(getShapefileSource(location)) as blocks:
+        batch = []
+        for feature in blocks:
+            properties = feature['properties']
+            x, y = float(properties['INTPTLON10']), float(properties['INTPTLAT10'])
+            batch.append((properties['GEOID10'], math.floor(x / TILE_SIZE), math.floor(y / TILE_SIZE), x, y))
+            if len(batch) == BATCH_SIZE:
+                connection.executemany("INSERT INTO points VALUES (?, ?, ?, ?, ?)", batch)
+                count += len(batch)
+                batch = []
+        connection.executemany("INSERT INTO points VALUES (?, ?, ?, ?, ?)", batch)
+        count += len(batch)
+    connection.commit()
+    return count
+
+def loadPopulations(connection, path: str):
+    "Streams the block demographics CSV into the database"
+    count = 0
+    placeholders = ', '.join('?' * (len(BLOCK_COLUMNS) + 1))
+    for chunk in pd.read_csv(path, usecols=['GEOID'] + BLOCK_COLUMNS, dtype={'GEOID': str}, chunksize=BATCH_SIZE):
+        # Some GEOID's that begin with 0 get shortened
+        chunk['GEOID'] = chunk['GEOID'].str.zfill(GEOID_LENGTH)
+        rows = zip(chunk['GEOID'], *(chunk[column].astype(int).tolist() for column in BLOCK_COLUMNS))
+        connection.executemany(f"INSERT INTO populations VALUES ({placeholders})", rows)
+        count += len(chunk)
+    connection.commit()
+    return count
+
+def findUnmatched(connection, sample: int = 5):
+    "Returns (the number of blocks without a population row, the GEOIDs of the first few of them)"
+    query = " FROM points LEFT JOIN populations ON points.geoid = populations.geoid WHERE populations.geoid IS NULL"
+    count, = connection.execute("SELECT COUNT(*)" + query).fetchone()
+    geoids = [row[0] for row in connection.execute(f"SELECT points.geoid{query} ORDER BY points.geoid LIMIT {sample}")]
+    return count, geoids
+
+def streamTiles(connection):
+    "Yields ((tileX, tileY), [(x, y, populations...), ...]) for every tile holding a block"
+    cursor = connection.execute(
+        "SELECT points.tileX, points.tileY, points.x, points.y, "
+        + ', '.join(f"populations.{column}" for column in BLOCK_COLUMNS)
+        + " FROM points JOIN populations ON points.geoid = populations.geoid"
+        + " ORDER BY points.tileX, points.tileY")
+    tile, blocks = None, []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            if row[:2] != tile:
+                if blocks:
+                    yield tile, blocks
+                tile, blocks = row[:2], []
+            blocks.append(row[2:])
+    if blocks:
+        yield tile, blocks
+
+def nearest(geometries, candidates, point):
+    "Returns the candidate (or any geometry, without candidates) nearest to point"
+    pool = candidates if len(candidates) else range(len(geometries))
+    return min(pool, key=lambda position: geometries[position].distance(point))
+
+def apportion(state: str, vtd_df, columns):
+    """
+        Returns the population of every VTD as a frame of geoid + columns (in BLOCK_COLUMNS
+        order), in vtd_df order, summed from the blocks whose interior point it holds
+    """
+    blocksLocation = BLOCKS_LOCATION.format(state=state)
+    csvLocation = BLOCK_DEMOGRAPHIC_LOCATION.format(state=state)
+    if not shapefileExists(blocksLocation):
+        logging.warning(f"Census block gis files not found for {state}")
+        raise NoGISFilesFoundException()
+    if not os.path.isfile(csvLocation):
+        logging.warning(f"Census block demographics CSV file not found for {state}")
+        raise NoCSVFilesFoundException()
+
+    geometries = vtd_df['geometry'].tolist()
+    index = GeometryIndex(geometries)
+    totals = np.zeros((len(geometries), len(BLOCK_COLUMNS)), dtype=np.int64)
+
+    databasePath = BLOCKS_DATABASE.format(state=state)
+    connection = createDatabase(databasePath)
+    try:
+        logging.info(f"Streamed {loadPoints(connection, blocksLocation)} block points of {state}")
+        logging.info(f"Streamed {loadPopulations(connection, csvLocation)} block populations of {state}")
+        numUnmatched, unmatched = findUnmatched(connection)
+        if numUnmatched:
+            # The join below leaves them out, their population (if any) is lost
+            logging.warning(f"{numUnmatched} blocks of {state} have no row in {csvLocation} and are left out, "
+                            f"the first: {', '.join(unmatched)}")
+
+        numBlocks, numOutside = 0, 0
+        for (tileX, tileY), blocks in streamTiles(connection):
+            tile = box(tileX * TILE_SIZE, tileY * TILE_SIZE, (tileX + 1) * TILE_SIZE, (tileY + 1) * TILE_SIZE)
+            candidates = index.query(tile)
+            bounds = np.array([geometries[c].bounds for c in candidates]).reshape(-1, 4)
+            prepared = [prep(geometries[c]) for c in candidates]
+
+            for block in blocks:
+                x, y = block[0], block[1]
+                point = Point(x, y)
+                hits = np.nonzero((bounds[:, 0] <= x) & (x <= bounds[:, 2]) & (bounds[:, 1] <= y) & (y <= bounds[:, 3]))[0]
+                owner = next((candidates[hit] for hit in hits if prepared[hit].contains(point)), None)
+                if owner is None:
+                    # Points right on (or just outside) the VTD boundaries
+                    owner = nearest(geometries, candidates, point)
+                    numOutside += 1
+                totals[owner] += block[2:]
+                numBlocks += 1
+    finally:
+        connection.close()
+        os.remove(databasePath)
+
+    logging.info(f"Assigned {numBlocks} blocks of {state}, {numOutside} to the nearest VTD")
+    table = {'geoid': vtd_df['GEOID'].tolist()}
+    for position, column in enumerate(columns):
+        table[column] = totals[:, position]
+    return pd.DataFrame(data=table)
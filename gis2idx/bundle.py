@@ -0,0 +1,205 @@
+# Usage: python gis2idx/bundle.py [state ...] [Options]
+# Packs every state's .idx (or just the given states') into output/national.bundle, so a
+# backend serving every state maps one file at startup instead of opening dozens.
+# States already in the bundle are swapped for their new build, the others are left as they are.
+# Options:
+# -lookup   -> also pack each state's .lookup
+# -dmap     -> also pack each state's .dmap
+# -compact  -> rewrite the bundle without the space left behind by swapped out entries
+#
+# Layout (big endian):
+#     BUNDLE_HEADER_F at offset 0, padded to a page
+#     entries, each starting on a page boundary
+#     the directory: numEntries BUNDLE_ENTRY_F, sorted by state code then kind
+# Appending writes the new entries and a new directory after the end of the file, then
+# rewrites the header to point at it, so a bundle is never left without a valid directory.
+# Every entry carries its own CRC32, checked when (and only if) it's asked for.
+
+import csv
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from util import (
+    # Constants
+    OUTPUT_PREFIX,
+    OUTPUT_IDX_LOCATION,
+    STATEKEY_LOCATION,
+    BUNDLE_MAGIC_NUMBER,
+
+    # Functions
+    atomicOpen
+)
+
+from idxformat import (
+    IdxFile,
+    DistrictMap
+)
+
+BUNDLE_LOCATION = OUTPUT_PREFIX + 'national.bundle'
+BUNDLE_VERSION = 1
+BUNDLE_HEADER_F = '>IIHHQQ'     # 28 bytes: magic, directory CRC32, version, numEntries, directory offset, directory length
+BUNDLE_ENTRY_F = '>2sB4sxQQI'   # 28 bytes: stCode, fips, kind, offset, length, CRC32
+PAGE_SIZE = 4096
+
+# Entry kind -> artifact location
+KINDS = {
+    b'IDX ': OUTPUT_IDX_LOCATION,
+    b'LKUP': OUTPUT_PREFIX + '{state}/{state}.lookup',
+    b'DMAP': OUTPUT_PREFIX + '{state}/{state}.dmap',
+}
+OPTIONAL_KINDS = {'-lookup': b'LKUP', '-dmap': b'DMAP'}
+
+def readStateKeys():
+    "Returns {state directory name: (stCode, fips)} from stateKeys.csv"
+    keys = {}
+    with open(STATEKEY_LOCATION) as handle:
+        for row in csv.reader(handle):
+            keys[row[2].lower().replace(' ', '_')] = (row[1], int(row[0]))
+    return keys
+
+def alignToPage(position: int):
+    return -(-position // PAGE_SIZE) * PAGE_SIZE
+
+class Bundle(object):
+    "A memory mapped bundle, entries are looked up by state code or FIPS"
+
+    def __init__(self, path: str = BUNDLE_LOCATION):
+        with open(path, 'rb') as handle:
+            self._buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, checkSum, self.version, numEntries, offset, length = struct.unpack_from(BUNDLE_HEADER_F, self._buffer)
+        if magic != BUNDLE_MAGIC_NUMBER:
+            raise ValueError(f"{path} is not a bundle (magic number {hex(magic)})")
+        if zlib.crc32(self._buffer[offset:offset + length]) != checkSum:
+            raise ValueError(f"The directory of {path} is damaged")
+
+        self.entries = {}
+        self._codes = {}
+        for i in range(numEntries):
+            stCode, fips, kind, start, size, crc = struct.unpack_from(
+                BUNDLE_ENTRY_F, self._buffer, offset + i * struct.calcsize(BUNDLE_ENTRY_F))
+            stCode = stCode.decode()
+            self.entries[(stCode, kind)] = (fips, start, size, crc)
+            self._codes[fips] = stCode
+
+    def close(self):
+        try:
+            self._buffer.close()
+        except BufferError:
+            # Arrays handed out still point into the map, it's released once they're gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def states(self):
+        "Returns the state codes in the bundle"
+        return sorted(set(stCode for stCode, _ in self.entries))
+
+    def stCode(self, key):
+        "Returns the state code for a state code or FIPS"
+        return self._codes[key] if isinstance(key, int) else key
+
+    def data(self, key, kind: bytes = b'IDX ', verify: bool = True):
+        "Returns a memoryview of one entry of a state (by state code or FIPS)"
+        fips, start, size, crc = self.entries[(self.stCode(key), kind)]
+        view = memoryview(self._buffer)[start:start + size]
+        if verify and zlib.crc32(view) != crc:
+            raise ValueError(f"The {kind.decode().strip()} entry of {self.stCode(key)} is damaged")
+        return view
+
+    def idx(self, key, verify: bool = True):
+        "Returns the IdxFile of a state"
+        return IdxFile(None, buffer=self.data(key, b'IDX ', verify))
+
+    def districtMap(self, key, verify: bool = True):
+        "Returns the DistrictMap of a state"
+        return DistrictMap(None, buffer=self.data(key, b'DMAP', verify))
+
+def readDirectory(path: str):
+    "Returns the entries of a bundle, as (stCode, fips, kind, offset, length, crc) tuples"
+    with Bundle(path) as bundle:
+        return [(stCode, fips, kind, start, size, crc)
+                for (stCode, kind), (fips, start, size, crc) in bundle.entries.items()]
+
+def writeDirectory(handle, entries, offset: int):
+    "Writes the directory at offset, then points the header at it"
+    entries = sorted(entries, key=lambda entry: (entry[0], entry[2]))
+    directory = b''.join(struct.pack(BUNDLE_ENTRY_F, stCode.encode(), fips, kind, start, size, crc)
+                         for stCode, fips, kind, start, size, crc in entries)
+    handle.seek(offset)
+    handle.write(directory)
+    handle.truncate()
+    handle.flush()
+    os.fsync(handle.fileno())
+
+    handle.seek(0)
+    handle.write(struct.pack(BUNDLE_HEADER_F, BUNDLE_MAGIC_NUMBER, zlib.crc32(directory), BUNDLE_VERSION,
+                             len(entries), offset, len(directory)))
+    handle.flush()
+    os.fsync(handle.fileno())
+
+def pack(path: str, artifacts, compact: bool = False):
+    """
+        Adds artifacts, a list of (stCode, fips, kind, bytes), to the bundle at path (creating it
+        if needed), replacing the entries they share a state code and kind with
+    """
+    if os.path.isfile(path) and not compact:
+        # Everything goes after the end of the file, the current directory stays valid until the header moves
+        entries, end, mode = readDirectory(path), os.path.getsize(path), 'r+b'
+    else:
+        entries, end, mode = [], PAGE_SIZE, 'wb'
+        if os.path.isfile(path):
+            # Carry the live entries over into the rewritten bundle
+            with Bundle(path) as bundle:
+                artifacts = [(stCode, fips, kind, bytes(bundle.data(stCode, kind)))
+                             for (stCode, kind), (fips, _, _, _) in bundle.entries.items()
+                             if not any(a[0] == stCode and a[2] == kind for a in artifacts)] + list(artifacts)
+
+    replaced = set((stCode, kind) for stCode, _, kind, _ in artifacts)
+    entries = [entry for entry in entries if (entry[0], entry[2]) not in replaced]
+
+    # A rewrite goes to a temporary file renamed over the bundle, an append goes into the bundle itself
+    with atomicOpen(path, mode) if mode == 'wb' else open(path, mode) as handle:
+        if mode == 'wb':
+            handle.write(bytes(PAGE_SIZE))
+        position = alignToPage(end)
+        for stCode, fips, kind, data in artifacts:
+            handle.seek(position)
+            handle.write(data)
+            entries.append((stCode, fips, kind, position, len(data), zlib.crc32(data)))
+            position = alignToPage(position + len(data))
+        writeDirectory(handle, entries, position)
+    return len(entries)
+
+def main(argv):
+    states = [arg for arg in argv if not arg.startswith('-')]
+    kinds = [b'IDX '] + [kind for option, kind in OPTIONAL_KINDS.items() if option in argv]
+    stateKeys = readStateKeys()
+    if not states:
+        states = [state for state in sorted(stateKeys) if os.path.isfile(OUTPUT_IDX_LOCATION.format(state=state))]
+
+    artifacts = []
+    for state in states:
+        stCode, fips = stateKeys[state]
+        for kind in kinds:
+            location = KINDS[kind].format(state=state)
+            if not os.path.isfile(location):
+                logging.warning(f"{location} not found, skipping it")
+                continue
+            with open(location, 'rb') as handle:
+                artifacts.append((stCode, fips, kind, handle.read()))
+
+    numEntries = pack(BUNDLE_LOCATION, artifacts, '-compact' in argv)
+    logging.info(f"Packed {len(artifacts)} artifacts of {len(states)} states, {BUNDLE_LOCATION} holds {numEntries} entries")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+# Usage: python gis2idx/daemon.py serve
+#        python gis2idx/daemon.py [state] [Options]
+# 'serve' starts a resident build worker listening on DAEMON_SOCKET_LOCATION.
+# Anything else is submitted to the running worker as a build job, with the same
+# options the command line entry point takes. Progress is printed as it arrives.
+#
+# The worker imports the geo stack, configures Django and keeps the database
+# connection and congressional districts loaded between jobs. Jobs run one at a
+# time, since the datamerger tables are reset by each state.
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from util import (
+    # Constants
+    DAEMON_SOCKET_LOCATION,
+    LOGMODE,
+)
+
+class JobLogHandler(logging.Handler):
+    "Forwards the log records of a running job back to the client that submitted it"
+
+    def __init__(self, report):
+        super().__init__(logging.INFO)
+        self._report = report
+
+    def emit(self, record):
+        self._report({"event": "log", "message": record.getMessage()})
+
+def runJob(state: str, args, report):
+    "Run one build job, reporting progress through report(event)"
+    import pipeline
+    startTime = time.time()
+
+    handler = JobLogHandler(report)
+    logging.getLogger().addHandler(handler)
+    try:
+        report({"event": "started", "state": state})
+        pipeline.sanityChecks(state, set(args))
+        artifacts = pipeline.processState(state, set(args))
+        report({
+            "event": "done",
+            "state": state,
+            "artifacts": artifacts,
+            "seconds": round(time.time() - startTime, 1)
+        })
+    except Exception as e:
+        logging.exception(f"Job for {state} failed")
+        report({"event": "error", "state": state, "message": repr(e)})
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+def worker(jobs: queue.Queue):
+    "Pull jobs off the queue and run them one at a time"
+    while True:
+        state, args, events = jobs.get()
+        runJob(state, args, events.put)
+        events.put(None)
+        jobs.task_done()
+
+class JobHandler(socketserver.StreamRequestHandler):
+    "Reads one job per connection and streams its events back as JSON lines"
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            state, args = request['state'], request.get('args', [])
+        except (ValueError, KeyError):
+            self.send({"event": "error", "message": "Malformed job"})
+            return
+
+        events = queue.Queue()
+        self.send({"event": "queued", "state": state, "position": self.server.jobs.qsize()})
+        self.server.jobs.put((state, args, events))
+
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            self.send(event)
+
+    def send(self, event):
+        try:
+            self.wfile.write((json.dumps(event) + '\n').encode())
+            self.wfile.flush()
+        except OSError:
+            # The client went away, the job still runs to completion
+            pass
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve():
+    "Warm up the pipeline and serve build jobs until interrupted"
+    startTime = time.time()
+    logging.info("Loading the pipeline")
+    import pipeline
+    import stateparser
+    import merged2output
+    stateparser.setupDjango()
+    logging.info(f"Pipeline loaded in {round(time.time() - startTime, 1)} seconds")
+
+    os.makedirs(os.path.dirname(DAEMON_SOCKET_LOCATION), exist_ok=True)
+    if os.path.exists(DAEMON_SOCKET_LOCATION):
+        os.remove(DAEMON_SOCKET_LOCATION)
+
+    server = JobServer(DAEMON_SOCKET_LOCATION, JobHandler)
+    server.jobs = queue.Queue()
+    threading.Thread(target=worker, args=(server.jobs,), daemon=True).start()
+
+    logging.info(f"Listening on {DAEMON_SOCKET_LOCATION}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(DAEMON_SOCKET_LOCATION)
+
+def submit(state: str, args):
+    "Send a build job to the running worker, yields its events as they arrive"
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(DAEMON_SOCKET_LOCATION)
+    with client, client.makefile('rwb') as stream:
+        stream.write((json.dumps({"state": state, "args": list(args)}) + '\n').encode())
+        stream.flush()
+        for line in stream:
+            yield json.loads(line)
+
+def main(argv):
+    if len(argv) == 0:
+        raise ValueError("No state specified")
+
+    if argv[0] == 'serve':
+        serve()
+        return 0
+
+    state, args = argv[0], [arg for arg in argv[1:] if arg.startswith('-')]
+    status = 0
+    for event in submit(state, args):
+        if event['event'] == 'log':
+            print(event['message'])
+        elif event['event'] == 'done':
+            print(f"Finished {state} in {event['seconds']} seconds:")
+            for artifact in event['artifacts']:
+                print(f"    {artifact}")
+        elif event['event'] == 'error':
+            print(f"Failed: {event['message']}")
+            status = 1
+        else:
+            print(f"{event['event'].capitalize()}: {state}")
+    return status
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        logging.basicConfig(filename='daemon.log', level=logging.INFO, filemode=LOGMODE)
+        logging.getLogger().addHandler(logging.StreamHandler())
+    sys.exit(main(sys.argv[1:]))
@@ -11,6 +11,9 @@ import io
 import json
 import pickle
 
+# The congressional districts, kept between runs when the command is called in process
+DISTRICTS = None
+
 class Command(BaseCommand):
     help = "Add a column to a dataframe, that describes the district the precinct is in"
 
@@ -28,6 +31,15 @@ class Command(BaseCommand):
         ))
 
 
+    def get_districts(self, congress_path):
+        "Load the congressional districts once per process"
+        global DISTRICTS
+        if DISTRICTS is None:
+            if len(DistrictBlock.objects.all()) == 0:
+                self.load_congressional_districts(congress_path)
+            DISTRICTS = list(DistrictBlock.objects.all().order_by('pk'))
+        return DISTRICTS
+
     def reset_table(self):
         VTDBlock.objects.all().delete()
 
@@ -36,8 +48,7 @@ class Command(BaseCommand):
         output = options['output']
         congress_path = options['congress_path']
 
-        if len(DistrictBlock.objects.all()) == 0:
-            self.load_congressional_districts(congress_path)
+        districts = self.get_districts(congress_path)
 
         # Load up the dataframes
         with io.open(filepath, 'rb') as handle:
@@ -63,9 +74,10 @@ class Command(BaseCommand):
 
         tabledict = {}
 
-        # Leverage PostGIS to generate the intersection
-        for district in DistrictBlock.objects.all():
-            related_tracts = VTDBlock.objects.filter(geometry__bboverlaps=district.geometry) # The magical fast function
+        # Leverage PostGIS to generate the intersection. Both are walked in primary key (shapefile) order,
+        # so the rows come out in the same order every run, which stateparser.update relies on
+        for district in districts:
+            related_tracts = VTDBlock.objects.filter(geometry__bboverlaps=district.geometry).order_by('pk') # The magical fast function
 
             for vtd in related_tracts: #VTDBlock.objects.all():
                 intersect = vtd.geometry.intersection(district.geometry).area
@@ -0,0 +1,315 @@
+# Usage: python gis2idx/distribute.py coordinate <workdir> [state ...] [Options]
+#        python gis2idx/distribute.py work <workdir>
+# Spreads a multi-state build over workers on any number of hosts, through a work directory they
+# all see (a shared filesystem, or a local directory standing in for a queue). Run workers from
+# the repository root, with output/ shared between the hosts too.
+#
+# 'coordinate' queues one job per state (every state under data/ by default), waits until all of
+# them finished and writes <workdir>/report.json, the combined report.
+# 'work' claims jobs until none are left, building each one with the pipeline.
+#
+# Options (coordinate):
+# -workers=<n>  -> also start n worker processes on this host
+# Every other option is passed on to every job, as for `python gis2idx`.
+#
+# Work directory:
+#     jobs/{state}.json       queued by the coordinator: the state and the build options
+#     leases/{state}.lease    a claim, created exclusively by one worker, which touches it every
+#                             HEARTBEAT_INTERVAL seconds. A lease untouched for LEASE_TIMEOUT seconds
+#                             belongs to a dead worker, the first worker to rename it away reclaims the job
+#     done/{state}.json       the outcome of a job: its worker, status, artifacts, seconds and error
+#     report.json             the outcome of every job, and what every worker did
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from util import (
+    # Constants
+    INPUT_PREFIX,
+
+    # Functions
+    atomicOpen
+)
+
+JOBS_DIRECTORY = 'jobs'
+LEASES_DIRECTORY = 'leases'
+DONE_DIRECTORY = 'done'
+REPORT_NAME = 'report.json'
+
+HEARTBEAT_INTERVAL = 10     # seconds between touches of a held lease
+LEASE_TIMEOUT = 60          # seconds without a touch before a lease is reclaimed
+POLL_INTERVAL = 2           # seconds between checks of the coordinator (and of idle workers)
+
+def jobPath(workdir: str, state: str):
+    return os.path.join(workdir, JOBS_DIRECTORY, state + '.json')
+
+def leasePath(workdir: str, state: str):
+    return os.path.join(workdir, LEASES_DIRECTORY, state + '.lease')
+
+def donePath(workdir: str, state: str):
+    return os.path.join(workdir, DONE_DIRECTORY, state + '.json')
+
+def readJSON(path: str):
+    "Returns the JSON in path, or None if it's missing or not completely written"
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+def writeJSON(path: str, data):
+    with atomicOpen(path, 'w') as handle:
+        handle.write(json.dumps(data, indent=4))
+
+def getWorkerId():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def getStates():
+    "Returns every state with a directory under data/"
+    return [state for state in sorted(os.listdir(INPUT_PREFIX))
+            if '.' not in state and '_' not in state and os.path.isdir(INPUT_PREFIX + state)]
+
+def runState(state: str, args):
+    "Builds one state with the pipeline, returns the paths it wrote"
+    import pipeline
+    pipeline.sanityChecks(state, args)
+    return pipeline.processState(state, args)
+
+class Lease(object):
+    "A claim on one job, kept alive by a heartbeat thread while it's held"
+
+    def __init__(self, workdir: str, state: str, worker: str, heartbeat: float = HEARTBEAT_INTERVAL):
+        self.path = leasePath(workdir, state)
+        self.state = state
+        self.worker = worker
+        self.lost = False
+        self._heartbeat = heartbeat
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def claim(cls, workdir: str, state: str, worker: str, heartbeat: float = HEARTBEAT_INTERVAL):
+        "Returns the lease on the job if this worker created it, None if someone else holds it"
+        lease = cls(workdir, state, worker, heartbeat)
+        try:
+            descriptor = os.open(lease.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(descriptor, 'w') as handle:
+            handle.write(json.dumps({"worker": worker, "claimed": round(time.time(), 3)}))
+        lease._thread = threading.Thread(target=lease._beat, daemon=True)
+        lease._thread.start()
+        return lease
+
+    def held(self):
+        "Checks that the lease file is still this worker's"
+        owner = readJSON(self.path)
+        return owner is not None and owner.get("worker") == self.worker
+
+    def _beat(self):
+        while not self._stopped.wait(self._heartbeat):
+            if not self.held():
+                logging.warning(f"Lost the lease on {self.state}, it was reclaimed")
+                self.lost = True
+                return
+            os.utime(self.path)
+
+    def release(self):
+        "Stops the heartbeat and removes the lease, if it's still this worker's"
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.held():
+            os.remove(self.path)
+
+def reclaimStale(workdir: str, state: str, worker: str, timeout: float = LEASE_TIMEOUT):
+    """
+        Moves the lease on a job out of the way if its worker stopped touching it, returns the dead
+        worker's id (None if the lease is alive, or another worker reclaimed it first)
+    """
+    path = leasePath(workdir, state)
+    try:
+        modified = os.stat(path).st_mtime_ns
+        if time.time() - modified / 1e9 < timeout:
+            return None
+        owner = readJSON(path) or {}
+        stale = f"{path}.stale-{worker}"
+        # Renaming is atomic, only one of the workers racing for it gets the file
+        os.rename(path, stale)
+    except FileNotFoundError:
+        return None
+
+    # Another worker may have reclaimed the lease and claimed a fresh one between the check and the
+    # rename, then this moved its live lease. Put it back, unless someone claimed the job meanwhile
+    if os.stat(stale).st_mtime_ns != modified or (readJSON(stale) or {}) != owner:
+        try:
+            os.link(stale, path)
+        except FileExistsError:
+            pass
+        os.remove(stale)
+        return None
+    os.remove(stale)
+    return owner.get("worker", "unknown")
+
+class Worker(object):
+    "Claims and builds jobs from a work directory until none are left"
+
+    def __init__(self, workdir: str, run=runState, heartbeat: float = HEARTBEAT_INTERVAL,
+                 timeout: float = LEASE_TIMEOUT, poll: float = POLL_INTERVAL):
+        self.workdir = workdir
+        self.worker = getWorkerId()
+        self._run = run
+        self._heartbeat = heartbeat
+        self._timeout = timeout
+        self._poll = poll
+
+    def pending(self):
+        "Returns the jobs without an outcome, in state order"
+        if not os.path.isdir(os.path.join(self.workdir, JOBS_DIRECTORY)):
+            return []
+        jobs = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.workdir, JOBS_DIRECTORY))
+                      if name.endswith('.json'))
+        return [state for state in jobs if not os.path.isfile(donePath(self.workdir, state))]
+
+    def claimNext(self):
+        "Returns (state, lease, the dead worker it was reclaimed from) for a job, or None if all are claimed"
+        for state in self.pending():
+            reclaimedFrom = None
+            if os.path.exists(leasePath(self.workdir, state)):
+                reclaimedFrom = reclaimStale(self.workdir, state, self.worker, self._timeout)
+                if reclaimedFrom is None:
+                    continue
+                logging.warning(f"Reclaimed {state} from {reclaimedFrom}, which stopped heartbeating")
+            lease = Lease.claim(self.workdir, state, self.worker, self._heartbeat)
+            if lease is not None:
+                if os.path.isfile(donePath(self.workdir, state)):
+                    # Finished between listing the jobs and claiming it
+                    lease.release()
+                    continue
+                return state, lease, reclaimedFrom
+        return None
+
+    def runJob(self, state: str, lease, reclaimedFrom=None):
+        "Builds one claimed job and records its outcome, unless the lease was lost meanwhile"
+        job = readJSON(jobPath(self.workdir, state))
+        startTime = time.time()
+        outcome = {"state": state, "worker": self.worker, "reclaimedFrom": reclaimedFrom}
+        try:
+            logging.info(f"{self.worker} building {state}")
+            artifacts = self._run(state, set(job["args"]))
+            outcome.update(status="done", artifacts=artifacts or [])
+        except Exception as e:
+            logging.exception(f"Job for {state} failed")
+            outcome.update(status="failed", error=repr(e), traceback=traceback.format_exc())
+        outcome["seconds"] = round(time.time() - startTime, 1)
+
+        if lease.lost or not lease.held():
+            logging.warning(f"Not recording {state}, its lease went to another worker")
+        else:
+            writeJSON(donePath(self.workdir, state), outcome)
+        lease.release()
+        return outcome
+
+    def work(self):
+        "Runs jobs until every one of them has an outcome, returns the outcomes of the ones run here"
+        outcomes = []
+        while True:
+            claimed = self.claimNext()
+            if claimed is not None:
+                outcomes.append(self.runJob(*claimed))
+            elif not self.pending():
+                return outcomes
+            else:
+                # Everything left is leased, wait for it to finish (or for its worker to die)
+                time.sleep(self._poll)
+
+def queueJobs(workdir: str, states, args):
+    "Creates the work directory and queues a job per state, clearing earlier outcomes of those states"
+    for directory in [JOBS_DIRECTORY, LEASES_DIRECTORY, DONE_DIRECTORY]:
+        os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+    for state in states:
+        for path in [donePath(workdir, state), leasePath(workdir, state)]:
+            if os.path.exists(path):
+                os.remove(path)
+        writeJSON(jobPath(workdir, state), {"state": state, "args": sorted(args)})
+
+def collectReport(workdir: str, states, seconds: float):
+    "Returns the combined report of the outcomes of the given states"
+    outcomes = dict((state, readJSON(donePath(workdir, state))) for state in states)
+    workers = {}
+    for state, outcome in outcomes.items():
+        summary = workers.setdefault(outcome["worker"], {"states": [], "seconds": 0})
+        summary["states"].append(state)
+        summary["seconds"] = round(summary["seconds"] + outcome["seconds"], 1)
+    return {
+        "states": outcomes,
+        "workers": workers,
+        "failed": sorted(state for state, outcome in outcomes.items() if outcome["status"] != "done"),
+        "reclaimed": sorted(state for state, outcome in outcomes.items() if outcome.get("reclaimedFrom")),
+        "seconds": round(seconds, 1),
+    }
+
+def coordinate(workdir: str, states, args, workers: int = 0, poll: float = POLL_INTERVAL):
+    "Queues the states, waits for every outcome, writes and returns the report"
+    startTime = time.time()
+    queueJobs(workdir, states, args)
+    logging.info(f"Queued {len(states)} states in {workdir}")
+
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', workdir])
+                 for _ in range(workers)]
+
+    remaining = list(states)
+    while remaining:
+        time.sleep(poll)
+        left = [state for state in remaining if not os.path.isfile(donePath(workdir, state))]
+        if len(left) != len(remaining):
+            logging.info(f"{len(states) - len(left)} of {len(states)} states finished")
+        remaining = left
+    for process in processes:
+        process.wait()
+
+    report = collectReport(workdir, states, time.time() - startTime)
+    writeJSON(os.path.join(workdir, REPORT_NAME), report)
+    logging.info(f"Built {len(states) - len(report['failed'])} of {len(states)} states on {len(report['workers'])} "
+                 f"workers in {report['seconds']} seconds, report in " + os.path.join(workdir, REPORT_NAME))
+    for state in report['failed']:
+        logging.error(f"{state} failed: {report['states'][state].get('error')}")
+    return report
+
+def main(argv):
+    if len(argv) < 2 or argv[0] not in ['coordinate', 'work']:
+        print("Usage: python gis2idx/distribute.py coordinate <workdir> [state ...] [Options]\n"
+              "       python gis2idx/distribute.py work <workdir>")
+        return 2
+    command, workdir = argv[0], argv[1]
+    if command == 'work':
+        outcomes = Worker(workdir).work()
+        return 1 if any(outcome["status"] != "done" for outcome in outcomes) else 0
+
+    from pipeline import unknownArguments
+    workers = 0
+    args = set()
+    for arg in argv[2:]:
+        if arg.startswith('-workers='):
+            workers = int(arg.split('=')[1])
+        elif arg.startswith('-'):
+            args.add(arg)
+    unknown = unknownArguments(args)
+    if unknown:
+        print("Unknown argument: " + ', '.join(unknown))
+        return 2
+
+    states = [arg for arg in argv[2:] if not arg.startswith('-')] or getStates()
+    report = coordinate(workdir, states, args, workers)
+    return 1 if report['failed'] else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s {getWorkerId()} %(levelname)s %(message)s")
+    sys.exit(main(sys.argv[1:]))
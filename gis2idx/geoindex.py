@@ -0,0 +1,26 @@
+"""
+A spatial index over a list of geometries, answering queries with positions in that list.
+"""
+
+from shapely.strtree import STRtree
+
+class GeometryIndex(object):
+    "An STRtree over a list of geometries"
+
+    def __init__(self, geometries):
+        self._geometries = list(geometries)
+        self._tree = STRtree(self._geometries) if self._geometries else None
+        self._positions = {id(g): i for i, g in enumerate(self._geometries)}
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def query(self, geometry):
+        "Returns the (sorted) positions of the geometries whose bounding box intersects geometry's"
+        if self._tree is None:
+            return []
+        result = self._tree.query(geometry)
+        if len(result) and not hasattr(result[0], 'geom_type'):
+            # Newer shapely answers with positions already
+            return sorted(int(i) for i in result)
+        return sorted(self._positions[id(g)] for g in result)
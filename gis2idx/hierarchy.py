@@ -0,0 +1,114 @@
+"""
+A multi-resolution hierarchy of the precinct graph, for coarse to fine search: precincts
+(level 0), counties (level 1) and, optionally, regions of neighboring counties (level 2).
+Every coarser level contracts the one below it: a node's demographics and area are the sums
+of its children's, and two nodes are neighbors if any of their children are, weighted by how
+many precinct adjacencies cross between them.
+
+The hierarchy is written as a v2 .idx (see idxformat.py): TOPO, ATTR and DEMO hold the precinct
+graph as usual, and level l >= 1 adds the sections
+    PARl    u4[N(l-1)] parent of every node of level l - 1, in level l
+    TOPl    u4[N(l) + 1] CSR row offsets, then u4[E(l)] neighbor ids
+    ATRl    u8[N(l)] area
+    DEMl    u4[N(l)][6] demographics
+    EWTl    u4[E(l)] precinct adjacencies between every pair of TOPl neighbors
+where l is the level as an ASCII digit.
+"""
+
+import logging
+
+import numpy as np
+
+import partition
+from idxformat import (
+    U4,
+    U8,
+    encodeCSR
+)
+
+REGION_NODES_PER_DISTRICT = 4   # Stop merging regions at about this many per district
+REGION_NODE_SHARE = 0.5         # Don't merge regions past this share of a district's ideal population
+
+def contract(neighborsLists, parents, numParents: int, edgeWeights=None):
+    """
+        Returns the graph of the parents: (neighbor lists, edge weights in the same layout),
+        the weight of a parent edge being the sum of the child edges it replaces
+    """
+    weights = [dict() for _ in range(numParents)]
+    for i, neighbors in enumerate(neighborsLists):
+        for position, j in enumerate(neighbors):
+            a, b = parents[i], parents[j]
+            if a != b:
+                weight = edgeWeights[i][position] if edgeWeights is not None else 1
+                weights[a][b] = weights[a].get(b, 0) + weight
+    coarseNeighbors = [sorted(w) for w in weights]
+    coarseWeights = [[w[b] for b in n] for w, n in zip(weights, coarseNeighbors)]
+    return coarseNeighbors, coarseWeights
+
+def aggregate(values, parents, numParents: int):
+    "Sums the rows of values into their parents"
+    values = np.asarray(values, dtype=np.int64)
+    totals = np.zeros((numParents,) + values.shape[1:], dtype=np.int64)
+    np.add.at(totals, np.asarray(parents, dtype=np.int64), values)
+    return totals
+
+def groupParents(keys):
+    "Returns (parent of every node, number of parents), parents numbered in sorted key order"
+    uniqueKeys, parents = np.unique(np.asarray(keys).astype(str), return_inverse=True)
+    return parents.astype(np.int64), len(uniqueKeys)
+
+def regionParents(neighborsLists, edgeWeights, populations, numDistricts: int):
+    """
+        Returns (parent of every node, number of parents) from repeatedly contracting heavy
+        edge matchings, like the partitioner's coarsening, until there are about
+        REGION_NODES_PER_DISTRICT regions per district or nothing is left to merge
+    """
+    rng = np.random.RandomState(partition.SEED)
+    weights = [int(p) for p in populations]
+    maxWeight = sum(weights) / numDistricts * REGION_NODE_SHARE
+    graph = partition.toWeightedGraph(neighborsLists, edgeWeights)
+    parents = np.arange(len(graph))
+    while len(graph) > REGION_NODES_PER_DISTRICT * numDistricts:
+        coarseGraph, coarseWeights, coarseIds = partition.coarsen(graph, weights, maxWeight, rng)
+        if len(coarseGraph) == len(graph):
+            break
+        parents = np.asarray(coarseIds)[parents]
+        graph, weights = coarseGraph, coarseWeights
+    return parents, len(graph)
+
+def buildSections(neighborsLists, areas, demographics, counties, numDistricts: int):
+    """
+        Returns the level sections (see above) for the precinct graph: counties from the county
+        key of every precinct (None to skip them), then regions. Levels that wouldn't merge
+        anything (a state already dissolved into counties, or too few counties) are left out.
+    """
+    sections = []
+    graph, weights = neighborsLists, None
+    areas = np.asarray(areas, dtype=np.int64)
+    demographics = np.asarray(demographics, dtype=np.int64)
+    level = 0
+    for grouping in [counties, 'region']:
+        if grouping is None:
+            continue
+        if isinstance(grouping, str):
+            parents, numParents = regionParents(graph, weights, demographics[:, 0], numDistricts)
+        else:
+            parents, numParents = groupParents(grouping)
+        if numParents == len(graph):
+            continue
+        level += 1
+
+        graph, weights = contract(graph, parents, numParents, weights)
+        areas = aggregate(areas, parents, numParents)
+        demographics = aggregate(demographics, parents, numParents)
+        logging.info(f"Level {level} of the hierarchy has {numParents} nodes")
+
+        digit = str(level).encode()
+        sections += [
+            (b'PAR' + digit, np.asarray(parents, dtype=U4).tobytes()),
+            (b'TOP' + digit, encodeCSR(graph)),
+            (b'ATR' + digit, areas.astype(U8).tobytes()),
+            (b'DEM' + digit, demographics.astype(U4).tobytes()),
+            (b'EWT' + digit, np.array([w for ws in weights for w in ws], dtype=U4).tobytes()),
+        ]
+    return sections
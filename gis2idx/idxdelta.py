@@ -0,0 +1,191 @@
+# Usage: python gis2idx/idxdelta.py diff <old.idx> <new.idx> <out.patch>
+#        python gis2idx/idxdelta.py apply <old.idx> <patch> <out.idx>
+#
+# Binary delta patches between two builds of a state's .idx. Node ids are kept stable
+# across builds by the GEOID registry (.geoids.json), so a patch only needs to carry the
+# nodes whose area, demographics or neighbors changed, plus the node count.
+#
+# Patch layout (everything after the magic number is zlib compressed):
+#     PATCH_HEADER_F, then numSections of (tag, length, data):
+#         AREA    u4 count, u4[count] node ids, u8[count] areas
+#         DEMO    u4 count, u4[count] node ids, u4[count][6] demographics
+#         TOPO    u4 count, u4[count] node ids, u4[count] neighbor counts, u4[] neighbors
+#         SECT    a whole v2 section that isn't covered above: 4s tag, then its raw bytes
+#         ORDR    v2 only: u1 compressed flag, then the section tags in file order
+
+import logging
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from util import (
+    # Constants
+    PATCH_MAGIC_NUMBER,
+)
+
+from idxformat import (
+    ENDIAN,
+    HEADER1_F,
+    NUM_DEMOGRAPHICS,
+    COMPRESSION_NONE,
+    U4,
+    U8,
+    IdxFile,
+    encodeV1,
+    encodeV2,
+    encodeCSR
+)
+
+PATCH_HEADER_F = ENDIAN + 'HIIBBIIIH'   # 26 bytes: version, base checksum, result checksum, stCode,
+                                        # old numNodes, new numNodes, numDistricts, numSections
+PATCH_SECTION_F = ENDIAN + '4sQ'        # 12 bytes: tag, length
+CORE_SECTIONS = [b'TOPO', b'ATTR', b'DEMO']
+
+class PatchError(ValueError):
+    "Raised if a patch doesn't apply to the given .idx"
+
+def changedIds(old, new, numCommon):
+    "Returns the node ids whose rows differ between two per-node arrays, including added nodes"
+    old, new = np.asarray(old), np.asarray(new)
+    changed = np.nonzero(old[:numCommon] != new[:numCommon])[0] if old.ndim == 1 else \
+        np.nonzero((old[:numCommon] != new[:numCommon]).any(axis=1))[0]
+    return np.concatenate([changed, np.arange(numCommon, len(new))]).astype(U4)
+
+def packSection(tag: bytes, data: bytes):
+    return struct.pack(PATCH_SECTION_F, tag, len(data)) + data
+
+def diff(old: IdxFile, new: IdxFile):
+    "Returns the patch that turns old into new"
+    if old.stCode != new.stCode:
+        raise PatchError(f"Can't patch {old.stCode} into {new.stCode}")
+    numCommon = min(old.numNodes, new.numNodes)
+    sections = []
+
+    # Areas and demographics
+    newAreas = new.areas()
+    ids = changedIds(old.areas(), newAreas, numCommon)
+    sections.append(packSection(b'AREA', struct.pack(ENDIAN + 'I', len(ids)) + ids.tobytes()
+                                + newAreas[ids].astype(U8).tobytes()))
+
+    newDemographics = new.demographics()
+    ids = changedIds(old.demographics(), newDemographics, numCommon)
+    sections.append(packSection(b'DEMO', struct.pack(ENDIAN + 'I', len(ids)) + ids.tobytes()
+                                + newDemographics[ids].astype(U4).tobytes()))
+
+    # Adjacency
+    oldNeighbors, newNeighbors = old.neighborsLists(), new.neighborsLists()
+    ids = [i for i in range(numCommon) if oldNeighbors[i] != newNeighbors[i]] + list(range(numCommon, new.numNodes))
+    counts = np.array([len(newNeighbors[i]) for i in ids], dtype=U4)
+    neighbors = np.array([j for i in ids for j in newNeighbors[i]], dtype=U4)
+    sections.append(packSection(b'TOPO', struct.pack(ENDIAN + 'I', len(ids)) + np.array(ids, dtype=U4).tobytes()
+                                + counts.tobytes() + neighbors.tobytes()))
+
+    # Anything else a v2 file carries goes whole, when it changed
+    if new.version != 1:
+        compressed = any(entry[0] != COMPRESSION_NONE for entry in new.sections.values())
+        sections.append(packSection(b'ORDR', struct.pack('B', compressed) + b''.join(new.sections)))
+        for tag in new.sections:
+            data = bytes(new.section(tag))
+            if tag not in CORE_SECTIONS and (tag not in old.sections or bytes(old.section(tag)) != data):
+                sections.append(packSection(b'SECT', tag + data))
+
+    header = struct.pack(PATCH_HEADER_F, new.version, old.checkSum, new.checkSum, ord(new.stCode[0]),
+                         ord(new.stCode[1]), old.numNodes, new.numNodes, new.numDistricts, len(sections))
+    return struct.pack(ENDIAN + 'I', PATCH_MAGIC_NUMBER) + zlib.compress(header + b''.join(sections), 9)
+
+def apply(old: IdxFile, patch: bytes):
+    "Returns the bytes of the .idx that the patch turns old into"
+    magic, = struct.unpack_from(ENDIAN + 'I', patch)
+    if magic != PATCH_MAGIC_NUMBER:
+        raise PatchError(f"Not an .idx patch (magic number {hex(magic)})")
+    body = zlib.decompress(patch[4:])
+    (version, baseCheckSum, resultCheckSum, stCode0, stCode1, oldNumNodes,
+        numNodes, numDistricts, numSections) = struct.unpack_from(PATCH_HEADER_F, body)
+    if baseCheckSum != old.checkSum or oldNumNodes != old.numNodes:
+        raise PatchError("The patch was made against a different build of this .idx")
+
+    # Start from the old graph, cut or extended to the new node count
+    areas = np.zeros(numNodes, dtype=np.int64)
+    demographics = np.zeros((numNodes, NUM_DEMOGRAPHICS), dtype=np.int64)
+    neighborsLists = [[] for _ in range(numNodes)]
+    numCommon = min(oldNumNodes, numNodes)
+    areas[:numCommon] = old.areas()[:numCommon]
+    demographics[:numCommon] = old.demographics()[:numCommon]
+    neighborsLists[:numCommon] = old.neighborsLists()[:numCommon]
+
+    order, compressed, extra = [], False, {}
+    position = struct.calcsize(PATCH_HEADER_F)
+    for _ in range(numSections):
+        tag, length = struct.unpack_from(PATCH_SECTION_F, body, position)
+        position += struct.calcsize(PATCH_SECTION_F)
+        data = body[position:position + length]
+        position += length
+
+        if tag == b'ORDR':
+            compressed = bool(data[0])
+            order = [data[i:i + 4] for i in range(1, len(data), 4)]
+            continue
+        if tag == b'SECT':
+            extra[data[:4]] = data[4:]
+            continue
+
+        count, = struct.unpack_from(ENDIAN + 'I', data)
+        ids = np.frombuffer(data, dtype=U4, count=count, offset=4).astype(np.int64)
+        values = 4 + 4 * count
+        if tag == b'AREA':
+            areas[ids] = np.frombuffer(data, dtype=U8, count=count, offset=values)
+        elif tag == b'DEMO':
+            demographics[ids] = np.frombuffer(data, dtype=U4, offset=values).reshape(count, NUM_DEMOGRAPHICS)
+        elif tag == b'TOPO':
+            counts = np.frombuffer(data, dtype=U4, count=count, offset=values).tolist()
+            neighbors = np.frombuffer(data, dtype=U4, offset=values + 4 * count).tolist()
+            start = 0
+            for i, n in zip(ids.tolist(), counts):
+                neighborsLists[i] = neighbors[start:start + n]
+                start += n
+
+    stCode = chr(stCode0) + chr(stCode1)
+    if version == 1:
+        result = encodeV1(stCode, numDistricts, range(numNodes), areas, neighborsLists, demographics)
+        checkSum = struct.unpack_from(HEADER1_F, result)[1]
+    else:
+        core = {
+            b'TOPO': encodeCSR(neighborsLists),
+            b'ATTR': areas.astype(U8).tobytes(),
+            b'DEMO': demographics.astype(U4).tobytes(),
+        }
+        sections = []
+        for tag in order:
+            if tag in core:
+                sections.append((tag, core[tag]))
+            else:
+                sections.append((tag, extra[tag] if tag in extra else bytes(old.section(tag))))
+        result = encodeV2(stCode, numNodes, numDistricts, sections, compressed)
+        checkSum = struct.unpack_from(HEADER1_F, result)[1]
+
+    if checkSum != resultCheckSum:
+        raise PatchError("The patched .idx doesn't match the build the patch was made from")
+    return result
+
+def main(argv):
+    if len(argv) != 4 or argv[0] not in ('diff', 'apply'):
+        raise ValueError("Usage: idxdelta.py diff <old.idx> <new.idx> <out.patch> | apply <old.idx> <patch> <out.idx>")
+
+    command, oldPath, inputPath, outputPath = argv
+    with IdxFile(oldPath) as old:
+        if command == 'diff':
+            with IdxFile(inputPath) as new:
+                output = diff(old, new)
+        else:
+            with open(inputPath, 'rb') as handle:
+                output = apply(old, handle.read())
+
+    with open(outputPath, 'wb') as handle:
+        written = handle.write(output)
+    logging.info(f"Finished writing {written} bytes to {outputPath}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
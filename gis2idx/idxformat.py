@@ -0,0 +1,377 @@
+"""
+The binary layouts of the .idx (v1 and v2), .edges and .dmap artifacts, and readers for them.
+
+v1 is a single stream: HEADER_F, every node record, then every variable length node.
+
+v2 is sectioned:
+    HEADER_V2_F, then a directory of numSections SECTION_F entries, then the sections.
+    Every section starts on a SECTION_ALIGN boundary, so a consumer can mmap just the
+    sections it needs. The header checksum covers the header (after the checksum) and
+    the directory, each section carries its own CRC32 of its stored bytes.
+
+    Sections (all big endian, N = numNodes, E = number of directed edges):
+        TOPO    u4[N + 1] CSR row offsets, then u4[E] neighbor ids
+        ATTR    u8[N] area (land + water, square meters)
+        DEMO    u4[N][6] demographics, in DEMOGRAPHICS_F order
+        PERI    u4[N][2] total and exterior perimeter (meters)          (optional)
+        EDGE    u4[E] shared border length of every TOPO neighbor       (optional)
+        SYNT    u4[S][2] synthetic edges (i < j) added by -connect      (optional)
+        VOTE    u4[N][3] democratic, republican and other votes         (optional, see attributes.py)
+        CNTY    u4[N] county of every node, an index into CTAB          (optional)
+        CTAB    u4[C][COUNTY_FIELDS] every county, in FIPS order: its   (optional, with CNTY)
+                FIPS code, number of nodes, then its DEMOGRAPHICS_F totals
+        PAR1, TOP1, ATR1, DEM1, EWT1, ... coarser levels of the graph, in a .hier.idx (see hierarchy.py)
+
+.dmap is a district map, to load a plan with a single mmap:
+    HEADER1_F, DMAP_HEADER_F, then aligned to DMAP_ALIGN: the district of every node
+    (u1[N], or u2[N] past 255 districts), then u8[numDistricts][DISTRICT_TOTALS] totals of
+    every district (district d in row d - 1): the DEMOGRAPHICS_F fields, area and node count.
+    The checksum covers everything after HEADER1_F.
+
+CNTY and CTAB let a consumer count split counties without touching geometry: keeping a
+count of nodes per (county, district), a move only updates the two entries of the node's
+county, and a county is split while more than one of its districts has nodes.
+"""
+
+import logging
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from util import (
+    # Constants
+    MAGIC_NUMBER,
+    MAGIC_NUMBER_V2,
+    DMAP_MAGIC_NUMBER,
+)
+
+# .idx data formats
+"""
+Key:
+Used:
+    > ->    big endian
+    B ->    unsigned char   -> 1 byte
+    H ->    unsigned short  -> 2 bytes
+    I ->    unsigned int    -> 4 bytes
+    Q ->    u-long long     -> 8 bytes
+    s ->    char[]
+    x ->    pad byte
+Others:
+    h ->    short       -> 2 bytes
+    i ->    int         -> 4 bytes
+    l ->    long        -> 4 or 8 bytes
+    q ->    long long   -> 8 bytes
+    d ->    double      -> 8 bytes
+    < ->    little endian
+"""
+ENDIAN = '>'
+HEADER_F = ENDIAN + 'IQQBBII'           # 18 bytes
+NODE_RECORD_F = ENDIAN + 'II'           # 8 bytes
+NODE_ID_F = ENDIAN + 'I'                # 4 bytes
+AREA_F = ENDIAN + 'I'                   # 4 bytes
+NEIGHBOR_F = NODE_ID_F                  # 4 bytes
+DEMOGRAPHICS_F = ENDIAN + 'IIIIII'      # 24 bytes
+
+# .edges data formats
+EDGES_HEADER_F = ENDIAN + 'BBII'        # 10 bytes, + HEADER1_F
+PERIMETER_F = ENDIAN + 'II'             # 8 bytes, total and exterior perimeter (meters)
+EDGE_WEIGHT_F = ENDIAN + 'I'            # 4 bytes, shared border length (meters)
+
+#Used to break up header for checksum calculation
+HEADER1_F = ENDIAN + 'II' # Just magic num, checksum doesnt need reformatting packing
+HEADER2_F = ENDIAN + 'BBII'
+
+# .dmap data formats
+DMAP_HEADER_F = ENDIAN + 'BBIHBx'       # 10 bytes, + HEADER1_F: stCode, numNodes, numDistricts, district width
+DMAP_ALIGN = 8
+
+# .idx v2 data formats
+IDX_VERSION = 2
+HEADER_V2_F = ENDIAN + 'IIHBBIIH'       # 22 bytes: magic, checksum, version, stCode, numNodes, numDistricts, numSections
+HEADER2_V2_F = ENDIAN + 'HBBIIH'        # The part of HEADER_V2_F after HEADER1_F
+SECTION_F = ENDIAN + '4sB3xQQQI'        # 36 bytes: tag, compression, offset, length, raw length, crc
+SECTION_ALIGN = 64
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+# numpy dtypes of the v2 sections
+U4 = np.dtype(ENDIAN + 'u4')
+U8 = np.dtype(ENDIAN + 'u8')
+NUM_DEMOGRAPHICS = len(DEMOGRAPHICS_F) - 1
+DISTRICT_TOTALS = NUM_DEMOGRAPHICS + 2  # demographics, area, node count
+COUNTY_FIELDS = NUM_DEMOGRAPHICS + 2    # FIPS, node count, demographics
+
+def calcNodeSize(numN):
+    "Returns the size of the node record in bytes"
+    IDSize = struct.calcsize(NODE_ID_F)
+    areaSize = struct.calcsize(AREA_F)
+    neighborsSize = struct.calcsize(NEIGHBOR_F) * numN
+    demoSize = struct.calcsize(DEMOGRAPHICS_F)
+    return IDSize + areaSize + neighborsSize + demoSize
+
+def encodeV1(stCode: str, numDistricts: int, nodeIds, areas, neighborsLists, demographics):
+    "Returns the bytes of a v1 .idx"
+    records = []
+    nodes = []
+    nodePos = 0
+    for nodeId, area, neighbors, demo in zip(nodeIds, areas, neighborsLists, demographics):
+        records.append(struct.pack(NODE_RECORD_F, len(neighbors), nodePos))
+        nodes.append(struct.pack(NODE_ID_F, int(nodeId)))
+        nodes.append(struct.pack(AREA_F, int(area)))
+        nodes += [struct.pack(NEIGHBOR_F, int(n)) for n in neighbors]
+        nodes.append(struct.pack(DEMOGRAPHICS_F, *[int(d) for d in demo]))
+        nodePos += calcNodeSize(len(neighbors))
+
+    body = struct.pack(HEADER2_F, ord(stCode[0]), ord(stCode[1]), len(records), numDistricts)
+    body += b''.join(records) + b''.join(nodes)
+    return struct.pack(HEADER1_F, MAGIC_NUMBER, zlib.crc32(body)) + body
+
+def alignTo(position: int, alignment: int = SECTION_ALIGN):
+    "Rounds position up to the next multiple of alignment"
+    return -(-position // alignment) * alignment
+
+def encodeCSR(neighborsLists):
+    "Returns the TOPO section for a list of neighbor lists"
+    offsets = np.zeros(len(neighborsLists) + 1, dtype=U4)
+    offsets[1:] = np.cumsum([len(n) for n in neighborsLists])
+    neighbors = np.array([j for n in neighborsLists for j in n], dtype=U4)
+    return offsets.tobytes() + neighbors.tobytes()
+
+def encodeV2(stCode: str, numNodes: int, numDistricts: int, sections, compress: bool = False):
+    """
+        Returns the bytes of a v2 .idx
+        sections is a list of (tag, bytes) pairs, written in order
+    """
+    headerSize = struct.calcsize(HEADER_V2_F) + struct.calcsize(SECTION_F) * len(sections)
+
+    directory = []
+    payload = []
+    position = alignTo(headerSize)
+    for tag, data in sections:
+        compression = COMPRESSION_NONE
+        stored = data
+        if compress:
+            deflated = zlib.compress(data, 9)
+            if len(deflated) < len(data):
+                compression, stored = COMPRESSION_ZLIB, deflated
+
+        directory.append(struct.pack(SECTION_F, tag, compression, position, len(stored), len(data), zlib.crc32(stored)))
+        payload.append(stored)
+        position = alignTo(position + len(stored))
+
+    header = struct.pack(HEADER2_V2_F, IDX_VERSION, ord(stCode[0]), ord(stCode[1]),
+                         numNodes, numDistricts, len(sections)) + b''.join(directory)
+    output = bytearray(struct.pack(HEADER1_F, MAGIC_NUMBER_V2, zlib.crc32(header)) + header)
+    for data in payload:
+        output += b'\0' * (alignTo(len(output)) - len(output))
+        output += data
+    return bytes(output)
+
+def encodeCounties(counties, demographics):
+    """
+        Returns the CNTY and CTAB sections for the county code (countyfp) of every node and the
+        (numNodes, 6) demographics. A county code that isn't a number is stored as FIPS 0
+    """
+    codes, index = np.unique(np.asarray(counties).astype(str), return_inverse=True)
+    table = np.zeros((len(codes), COUNTY_FIELDS), dtype=np.int64)
+    table[:, 0] = [int(code) if code.isdigit() else 0 for code in codes]
+    invalid = [position for position, code in enumerate(codes) if not code.isdigit()]
+    if invalid:
+        logging.warning(f"{int(np.isin(index, invalid).sum())} nodes have a county code that isn't a FIPS number "
+                        f"({', '.join(codes[invalid][:5])}), their counties are stored as FIPS 0")
+    table[:, 1] = np.bincount(index, minlength=len(codes))
+    np.add.at(table[:, 2:], index, np.asarray(demographics, dtype=np.int64))
+    return index.astype(U4).tobytes(), table.astype(U4).tobytes()
+
+class IdxFile(object):
+    """
+        A memory mapped .idx, of either version. Nothing is decoded until it's asked for,
+        so opening a file only costs reading its header (and directory).
+    """
+
+    def __init__(self, path: str, buffer=None):
+        "Maps the file at path, or reads an .idx already in memory from buffer"
+        self._path = path
+        if buffer is not None:
+            self._buffer = buffer
+        else:
+            with open(path, 'rb') as handle:
+                self._buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.magic, self.checkSum = struct.unpack_from(HEADER1_F, self._buffer, 0)
+        if self.magic == MAGIC_NUMBER:
+            self.version = 1
+            stCode0, stCode1, self.numNodes, self.numDistricts = struct.unpack_from(
+                HEADER2_F, self._buffer, struct.calcsize(HEADER1_F))
+            self.sections = {}
+        elif self.magic == MAGIC_NUMBER_V2:
+            (_, _, self.version, stCode0, stCode1, self.numNodes,
+                self.numDistricts, numSections) = struct.unpack_from(HEADER_V2_F, self._buffer, 0)
+            self.sections = {}
+            for i in range(numSections):
+                entry = struct.unpack_from(SECTION_F, self._buffer,
+                                           struct.calcsize(HEADER_V2_F) + i * struct.calcsize(SECTION_F))
+                self.sections[entry[0]] = entry[1:]
+        else:
+            raise ValueError(f"{path} is not an .idx file (magic number {hex(self.magic)})")
+        self.stCode = chr(stCode0) + chr(stCode1)
+
+    def close(self):
+        try:
+            if isinstance(self._buffer, mmap.mmap):
+                self._buffer.close()
+        except BufferError:
+            # Arrays handed out still point into the map, it's released once they're gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def verifyChecksum(self):
+        "Returns True if the header checksum (and in v2, every section's CRC) matches"
+        start = struct.calcsize(HEADER1_F)
+        if self.version == 1:
+            return zlib.crc32(self._buffer[start:]) == self.checkSum
+
+        end = struct.calcsize(HEADER_V2_F) + struct.calcsize(SECTION_F) * len(self.sections)
+        if zlib.crc32(self._buffer[start:end]) != self.checkSum:
+            return False
+        for tag, (compression, offset, length, rawLength, crc) in self.sections.items():
+            if zlib.crc32(self._buffer[offset:offset + length]) != crc:
+                return False
+        return True
+
+    def section(self, tag: bytes):
+        "Returns the raw bytes of a v2 section, a zero copy view unless it's compressed"
+        compression, offset, length, rawLength, crc = self.sections[tag]
+        view = memoryview(self._buffer)[offset:offset + length]
+        if compression == COMPRESSION_ZLIB:
+            return zlib.decompress(view)
+        return view
+
+    def array(self, tag: bytes, dtype=U4):
+        "Returns a v2 section as a numpy array"
+        return np.frombuffer(self.section(tag), dtype=dtype)
+
+    def nodeRecords(self):
+        "Returns the (numNeighbors, nodePos) columns of a v1 file's node records"
+        recordsStart = struct.calcsize(HEADER1_F) + struct.calcsize(HEADER2_F)
+        records = np.frombuffer(self._buffer, dtype=U4, count=2 * self.numNodes, offset=recordsStart)
+        return records[0::2].astype(np.int64), records[1::2].astype(np.int64)
+
+    def _v1Words(self):
+        "Returns (numNeighbors, word offset of every node, node data as u4 words) of a v1 file"
+        nodesStart = (struct.calcsize(HEADER1_F) + struct.calcsize(HEADER2_F)
+                      + struct.calcsize(NODE_RECORD_F) * self.numNodes)
+        numNeighbors, nodePos = self.nodeRecords()
+        words = np.frombuffer(self._buffer, dtype=U4, offset=nodesStart)
+        return numNeighbors, nodePos // 4, words
+
+    def topology(self):
+        "Returns the graph as CSR (row offsets, neighbor ids)"
+        if self.version != 1:
+            data = self.array(b'TOPO')
+            return data[:self.numNodes + 1].astype(np.int64), data[self.numNodes + 1:]
+
+        numNeighbors, starts, words = self._v1Words()
+        offsets = np.zeros(self.numNodes + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(numNeighbors)
+
+        # Position of every neighbor word: the node's start, past its id and area
+        within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], numNeighbors)
+        positions = np.repeat(starts + 2, numNeighbors) + within
+        return offsets, words[positions]
+
+    def neighborsLists(self):
+        "Returns the graph as a list of neighbor lists"
+        offsets, neighbors = self.topology()
+        neighbors = neighbors.tolist()
+        return [neighbors[offsets[i]:offsets[i + 1]] for i in range(self.numNodes)]
+
+    def nodeIds(self):
+        "Returns the node id stored in every v1 node (v2 nodes are implicit)"
+        if self.version != 1:
+            return np.arange(self.numNodes)
+        numNeighbors, starts, words = self._v1Words()
+        return words[starts]
+
+    def areas(self):
+        "Returns the area of every node"
+        if self.version != 1:
+            return self.array(b'ATTR', U8)
+        numNeighbors, starts, words = self._v1Words()
+        return words[starts + 1]
+
+    def counties(self):
+        "Returns (the county index of every node, the (numCounties, COUNTY_FIELDS) county table) of a v2 file"
+        table = self.array(b'CTAB')
+        return self.array(b'CNTY'), table.reshape(len(table) // COUNTY_FIELDS, COUNTY_FIELDS)
+
+    def demographics(self):
+        "Returns the demographics of every node, as a (numNodes, 6) array"
+        if self.version != 1:
+            return self.array(b'DEMO').reshape(self.numNodes, NUM_DEMOGRAPHICS)
+        numNeighbors, starts, words = self._v1Words()
+        positions = (starts + 2 + numNeighbors)[:, None] + np.arange(NUM_DEMOGRAPHICS)
+        return words[positions]
+
+def encodeDistrictMap(stCode: str, numDistricts: int, districts, totals):
+    """
+        Returns the bytes of a .dmap
+        districts is the district (1 to numDistricts) of every node, totals a (numDistricts, DISTRICT_TOTALS) array
+    """
+    width = 1 if numDistricts <= 0xFF else 2
+    header = struct.pack(DMAP_HEADER_F, ord(stCode[0]), ord(stCode[1]), len(districts), numDistricts, width)
+    start = alignTo(struct.calcsize(HEADER1_F) + len(header), DMAP_ALIGN)
+    body = header + bytes(start - struct.calcsize(HEADER1_F) - len(header))
+
+    ids = np.asarray(districts, dtype=np.dtype(ENDIAN + f'u{width}')).tobytes()
+    body += ids + bytes(alignTo(len(ids), DMAP_ALIGN) - len(ids))
+    body += np.asarray(totals, dtype=U8).reshape(numDistricts, DISTRICT_TOTALS).tobytes()
+    return struct.pack(HEADER1_F, DMAP_MAGIC_NUMBER, zlib.crc32(body)) + body
+
+class DistrictMap(object):
+    "A memory mapped .dmap, districts and totals are views into the map"
+
+    def __init__(self, path: str, buffer=None):
+        "Maps the file at path, or reads a .dmap already in memory from buffer"
+        if buffer is not None:
+            self._buffer = buffer
+        else:
+            with open(path, 'rb') as handle:
+                self._buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.magic, self.checkSum = struct.unpack_from(HEADER1_F, self._buffer, 0)
+        if self.magic != DMAP_MAGIC_NUMBER:
+            raise ValueError(f"{path} is not a .dmap file (magic number {hex(self.magic)})")
+        stCode0, stCode1, self.numNodes, self.numDistricts, width = struct.unpack_from(
+            DMAP_HEADER_F, self._buffer, struct.calcsize(HEADER1_F))
+        self.stCode = chr(stCode0) + chr(stCode1)
+
+        position = alignTo(struct.calcsize(HEADER1_F) + struct.calcsize(DMAP_HEADER_F), DMAP_ALIGN)
+        self.districts = np.frombuffer(self._buffer, dtype=np.dtype(ENDIAN + f'u{width}'),
+                                       count=self.numNodes, offset=position)
+        position += alignTo(width * self.numNodes, DMAP_ALIGN)
+        self.totals = np.frombuffer(self._buffer, dtype=U8, count=self.numDistricts * DISTRICT_TOTALS,
+                                    offset=position).reshape(self.numDistricts, DISTRICT_TOTALS)
+
+    def close(self):
+        self.districts = self.totals = None
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def verifyChecksum(self):
+        "Returns True if the checksum matches"
+        return zlib.crc32(self._buffer[struct.calcsize(HEADER1_F):]) == self.checkSum
@@ -0,0 +1,106 @@
+"""
+The run journal: an append-only log of the pipeline stages each state finished in a run, with the
+sha256 of every artifact they wrote, so an interrupted multi-state batch can pick up where it stopped.
+
+Every line of RUN_JOURNAL_LOCATION is a JSON record, written and fsynced in one go:
+    {"event": "start", "run": key, "time": ...}                 a run (not a -resume) started
+    {"event": "done", "run": key, "state": ..., "stage": ...,
+     "artifacts": {path: sha256}, "time": ...}                  a stage of a state finished
+where key is the run's sorted options (besides -resume and -plan). Resuming only trusts the records of
+the latest run with the same options, and only while every artifact still hashes the same. A line cut
+short by a crash doesn't parse and is skipped.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from util import (
+    # Constants
+    RUN_JOURNAL_LOCATION,
+)
+
+# Options that don't change what a run builds
+UNKEYED_ARGUMENTS = set(['-resume', '-plan'])
+HASH_BLOCK_SIZE = 1 << 20
+
+def runKey(args):
+    "Returns the key of a run's options"
+    return ' '.join(sorted(set(args) - UNKEYED_ARGUMENTS))
+
+def hashPath(path: str):
+    "Returns the sha256 of a file, or of every file (name and contents) in a directory"
+    digest = hashlib.sha256()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for filePath in paths:
+        if filePath != path:
+            digest.update(os.path.relpath(filePath, path).encode())
+        with open(filePath, 'rb') as handle:
+            for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def readRecords(path: str):
+    "Returns every record of the journal that parses"
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path) as handle:
+        for line in handle:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+class RunJournal(object):
+    "The journal of one run, resuming the latest run with the same options if asked to"
+
+    def __init__(self, args, resume: bool = False, path: str = RUN_JOURNAL_LOCATION):
+        self.path = path
+        self.key = runKey(args)
+        self._done = {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        if resume:
+            for record in readRecords(path):
+                if record.get('run') != self.key:
+                    continue
+                if record.get('event') == 'start':
+                    self._done = {}
+                elif record.get('event') == 'done':
+                    self._done[(record['state'], record['stage'])] = record['artifacts']
+            logging.info(f"Resuming a run of {len(set(state for state, _ in self._done))} states with options '{self.key}'")
+        else:
+            self._append({"event": "start", "run": self.key})
+
+    def _append(self, record):
+        record["time"] = round(time.time(), 3)
+        with open(self.path, 'a') as handle:
+            handle.write(json.dumps(record) + '\n')
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def completed(self, state: str, stage: str):
+        """
+            Returns the artifacts of the stage if this run already finished it and they're all
+            unchanged on disk, otherwise None
+        """
+        artifacts = self._done.get((state, stage))
+        if artifacts is None:
+            return None
+        for path, digest in artifacts.items():
+            if not os.path.exists(path) or hashPath(path) != digest:
+                logging.info(f"{path} changed since {stage} finished for {state}, running it again")
+                return None
+        return list(artifacts)
+
+    def record(self, state: str, stage: str, artifacts):
+        "Records that the stage finished for the state, having written artifacts"
+        digests = dict((path, hashPath(path)) for path in artifacts if os.path.exists(path))
+        self._done[(state, stage)] = digests
+        self._append({"event": "done", "run": self.key, "state": state, "stage": stage, "artifacts": digests})
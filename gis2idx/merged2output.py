@@ -7,6 +7,34 @@
 # -novert  -> create the state's .novert.json file
 # -readable -> create a .idx.json that contains the data that is encoded in the .idx
 #                (will also recreate the .idx file)
+# -hilbert  -> renumber the nodes along a hilbert curve through the precinct centroids
+# -rcm      -> renumber the nodes in reverse Cuthill-McKee order of the adjacency graph
+#                (without either, node ids stay the same as in the last build's .geoids.json,
+#                 which maps node ids back to GEOIDs and is rewritten on every run)
+# -edges    -> create the state's .edges file, with shared border lengths and perimeters
+# -v2       -> write the .idx in the sectioned v2 format (see idxformat.py) instead of v1
+#                (includes the edge weights when -edges is given too)
+# -deflate  -> zlib compress the sections of a v2 .idx
+# -seed     -> create a .seed.districts.json, a contiguous population balanced districting
+# -patch    -> create a .idx.patch that turns the previous build's .idx into the new one
+# -rook     -> build the graph with rook contiguity (shared boundary, not just a corner) from hashed
+#                boundary segments, instead of touches(). '-rook=<meters>' sets the minimum shared length
+# -connect  -> link islands and other disconnected parts of the graph to the nearest precinct of the
+#                main component. The synthetic edges are logged, written to the state's .synthetic.json
+#                (a v1 .idx stores them as ordinary neighbors), listed in the readable .idx.json
+#                and stored in a SYNT section of a v2 .idx
+# -precompress -> also write gzip, brotli and zstd variants of the JSON outputs (brotli/zstd need their packages),
+#                compressed in the background, and a .manifest.json with sizes and sha256 hashes
+# -gpkg     -> create the state's .gpkg (GeoPackage, with an R-tree spatial index)
+# -fgb      -> create the state's .fgb (FlatGeobuf, with a packed Hilbert R-tree), needs GDAL 3.1+
+# -dmap     -> create the state's .dmap, the district of every node plus every district's totals
+#                (demographics, area, node count), see idxformat.py
+# -hierarchy -> create the state's .hier.idx, a v2 .idx that also holds the county graph and a coarser
+#                region graph contracted from it, with parents and summed demographics (see hierarchy.py)
+# -lookup   -> create the state's .lookup, a grid bucket index of precinct bounding boxes that
+#                resolves a point to its candidate node ids (read it with pointindex.PointIndex)
+# -parallel -> find the neighbors across every core, from a geometry arena the workers map
+#                instead of pickled geometries (see arena.py)
 # -all      -> create all 4 file types
 
 
@@ -14,6 +42,7 @@ import pickle
 import io
 import json
 import struct
+import numpy as np
 import pandas as pd
 import geopandas
 import logging
@@ -23,54 +52,88 @@ import hashlib
 import time
 import csv
 import zlib
-from shapely.geometry import mapping
+from shapely.geometry import mapping, MultiPolygon
+import fiona
+from fiona.crs import from_epsg
+
+import reorder
+import adjacency
+from geoindex import GeometryIndex
+import idxdelta
+import partition
+import precompress
+import pointindex
+import hierarchy
+from attributes import (
+    PACKED_DEMOGRAPHICS,
+    PACKED_VOTES,
+    getPackedColumns
+)
+from idxformat import (
+    # .idx formats
+    NEIGHBOR_F,
+    DEMOGRAPHICS_F,
+    HEADER1_F,
+    EDGES_HEADER_F,
+    PERIMETER_F,
+    EDGE_WEIGHT_F,
+    U4,
+    U8,
+
+    # Functions
+    IdxFile,
+    encodeDistrictMap,
+    calcNodeSize,
+    encodeV1,
+    encodeCSR,
+    encodeV2,
+    encodeCounties
+)
 
 from util import (
     # Constants
     STATEPARSER_CACHE_LOCATION,
+    MERGED_DF_INPUT,
+    NEIGHBORS_CACHE,
+    GEOMETRY_ARENA_LOCATION,
+    OUTPUT_ARGUMENTS,
     OUTPUT_PREFIX,
     OUTPUT_IDX_LOCATION,
     OUTPUT_JSON_LOCATION,
     MAGIC_NUMBER,
+    EDGES_MAGIC_NUMBER,
     STATEKEY_LOCATION,
     LOGMODE,
 
     # Functions
+    atomicOpen,
+    replacePath,
+    temporaryPath,
     parseState
 )
-MERGED_DF_INPUT = STATEPARSER_CACHE_LOCATION + '{state}.state.pk'
+OUTPUT_GEOIDS_LOCATION = OUTPUT_PREFIX + '{state}/{state}.geoids.json'
+OUTPUT_EDGES_LOCATION = OUTPUT_PREFIX + '{state}/{state}.edges'
+OUTPUT_PATCH_LOCATION = OUTPUT_IDX_LOCATION + '.patch'
+OUTPUT_SEED_LOCATION = OUTPUT_PREFIX + '{state}/{state}.seed.districts.json'
+OUTPUT_MANIFEST_LOCATION = OUTPUT_PREFIX + '{state}/{state}.manifest.json'
+OUTPUT_LOOKUP_LOCATION = OUTPUT_PREFIX + '{state}/{state}.lookup'
+OUTPUT_DMAP_LOCATION = OUTPUT_PREFIX + '{state}/{state}.dmap'
+OUTPUT_HIERARCHY_LOCATION = OUTPUT_PREFIX + '{state}/{state}.hier.idx'
+OUTPUT_SYNTHETIC_LOCATION = OUTPUT_PREFIX + '{state}/{state}.synthetic.json'
+
+GIS_CRS = 'EPSG:4269'       # NAD83, what the TIGER shapefiles come in
+LENGTH_CRS = 'EPSG:5070'    # NAD83 / Conus Albers, measured in meters
 SHP_OUTPUT = OUTPUT_PREFIX + '{state}/shp/'
+LOOKUP_PADDING = 0.0001     # degrees (~10m) added around every box in the .lookup, for simplified outlines
 
-ARGUMENTS = set(['-idx', '-json', '-novert', '-readable', '-districts', '-shp'])
-
-# .idx data formats
-"""
-Key:
-Used:
-    > ->    big endian
-    B ->    unsigned char   -> 1 byte
-    I ->    unsigned int    -> 4 bytes
-    Q ->    u-long long     -> 8 bytes
-Others:
-    h ->    short       -> 2 bytes
-    i ->    int         -> 4 bytes
-    l ->    long        -> 4 or 8 bytes
-    q ->    long long   -> 8 bytes
-    d ->    double      -> 8 bytes
-    < ->    little endian
-"""
-ENDIAN = '>'
-HEADER_F = ENDIAN + 'IQQBBII'           # 18 bytes
-NODE_RECORD_F = ENDIAN + 'II'           # 8 bytes
-NODE_ID_F = ENDIAN + 'I'                # 4 bytes
-AREA_F = ENDIAN + 'I'                   # 4 bytes
-NEIGHBOR_F = NODE_ID_F                  # 4 bytes
-DEMOGRAPHICS_F = ENDIAN + 'IIIIII'      # 24 bytes
-
-#Used to break up header for checksum calculation
-HEADER1_F = ENDIAN + 'II' # Just magic num, checksum doesnt need reformatting packing               
-HEADER2_F = ENDIAN + 'BBII'
+# Spatially indexed exports: option -> (OGR driver, output location)
+VECTOR_FORMATS = {
+    '-gpkg': ('GPKG', OUTPUT_PREFIX + '{state}/{state}.gpkg'),
+    '-fgb': ('FlatGeobuf', OUTPUT_PREFIX + '{state}/{state}.fgb'),
+}
+VECTOR_BATCH_SIZE = 4096    # features handed to OGR per writerecords call
 
+ARGUMENTS = OUTPUT_ARGUMENTS | set(reorder.ORDERINGS)
 
 def readLastArtifact(state: str):
     "Load the previous artifact into memory"
@@ -91,9 +154,14 @@ def initializeOutput(state):
         logging.info(f"Creating {outloc}")
         os.mkdir(outloc)
 
-def getNeighbors(df):
-    "Returns a 2D list that stores a list of neighbors for each precinct"
+def getNeighbors(df, arenaPath=None):
+    """
+        Returns a 2D list that stores a list of neighbors for each precinct.
+        With arenaPath, they're found across a process pool through a geometry arena written there
+    """
     geo = df['geometry'].tolist()
+    if arenaPath is not None:
+        return adjacency.getParallelNeighbors(geo, arenaPath)
     
     neighbors = [[] for i in range(len(geo))]
     for i in range(len(geo)):
@@ -104,6 +172,85 @@ def getNeighbors(df):
     
     return neighbors
 
+def projectedGeometry(df):
+    "Returns the precinct geometries projected into a CRS measured in meters"
+    crs = getattr(df['geometry'], 'crs', None) or GIS_CRS
+    return geopandas.GeoSeries(df['geometry'].tolist(), crs=crs).to_crs(LENGTH_CRS)
+
+def getEdgeLengths(df, neighborsLists):
+    """
+        Returns the shared border length for each neighbor, in the same layout as neighborsLists,
+        and the total and exterior (not shared with another precinct) perimeter of every precinct
+    """
+    geometry = projectedGeometry(df)
+    boundaries = geometry.boundary
+
+    # Intersect the boundaries of every adjacent pair at once
+    pairs = [(i, j) for i in range(len(neighborsLists)) for j in neighborsLists[i] if i < j]
+    first = geopandas.GeoSeries(boundaries.iloc[[i for i, _ in pairs]].tolist())
+    second = geopandas.GeoSeries(boundaries.iloc[[j for _, j in pairs]].tolist())
+    shared = dict(zip(pairs, first.intersection(second).length.tolist()))
+
+    edgeLengths = []
+    for i, neighbors in enumerate(neighborsLists):
+        edgeLengths.append([shared[(min(i, j), max(i, j))] for j in neighbors])
+
+    perimeters = geometry.length.tolist()
+    exteriors = [max(perimeters[i] - sum(edgeLengths[i]), 0) for i in range(len(perimeters))]
+
+    return edgeLengths, perimeters, exteriors
+
+def getCachedNeighbors(df, state, parallel=False):
+    """
+        Returns the same neighbor lists as getNeighbors, but only recomputes them for precincts whose
+        geometry changed since the last run. touches() only depends on the two geometries, so every
+        pair of unchanged precincts keeps its cached answer.
+    """
+    arenaPath = GEOMETRY_ARENA_LOCATION.format(state=state) if parallel else None
+    if 'GEOID' not in df.columns or df['GEOID'].duplicated().any():
+        return getNeighbors(df, arenaPath)
+
+    geoids = df['GEOID'].tolist()
+    geometries = df['geometry'].tolist()
+    fingerprints = [hashlib.sha1(g.wkb).hexdigest() for g in geometries]
+
+    cached = None
+    if os.path.isfile(NEIGHBORS_CACHE.format(state=state)):
+        with io.open(NEIGHBORS_CACHE.format(state=state), 'rb') as handle:
+            cached = pickle.load(handle)
+
+    changed = [] if cached is None else \
+        [i for i, geoid in enumerate(geoids) if cached['fingerprints'].get(geoid) != fingerprints[i]]
+    if cached is None or len(changed) > len(geoids) // 2:
+        neighborsLists = getNeighbors(df, arenaPath)
+    else:
+        logging.info(f"Recomputing the neighbors of {len(changed)} changed precincts")
+        positions = dict((geoid, i) for i, geoid in enumerate(geoids))
+        changedSet = set(changed)
+        neighbors = [set() for _ in geoids]
+        for i, geoid in enumerate(geoids):
+            if i in changedSet:
+                continue
+            for other in cached['neighbors'][geoid]:
+                j = positions.get(other)
+                if j is not None and j not in changedSet:
+                    neighbors[i].add(j)
+
+        index = GeometryIndex(geometries)
+        for i in changed:
+            for j in index.query(geometries[i]):
+                if j != i and geometries[i].touches(geometries[j]):
+                    neighbors[i].add(j)
+                    neighbors[j].add(i)
+        neighborsLists = [sorted(n) for n in neighbors]
+
+    with atomicOpen(NEIGHBORS_CACHE.format(state=state), 'wb') as handle:
+        pickle.dump({
+            'fingerprints': dict(zip(geoids, fingerprints)),
+            'neighbors': dict((geoid, [geoids[j] for j in n]) for geoid, n in zip(geoids, neighborsLists)),
+        }, handle)
+    return neighborsLists
+
 def getPolyCoords(geo):
     "Returns a tuple of x,y coords from a POLYGON in the form ((x1,y1),...,(xn,yn))"
     coordsList = []
@@ -126,45 +273,12 @@ def getNeighborStructList(neighborsList):
 
 def packDemograpchics(prec):
     "Returns a byte structs that each contains the demographic data for the precinct"
-    # Sum otherpop and add data in correct order
-    otherpop = prec['otherPop'] + prec['pacisPop'] + prec['multiPop']
-    packed = struct.pack(DEMOGRAPHICS_F, int(prec['totalPop']),
-                                        int(prec['blackPop']),
-                                        int(prec['nativeAPop']),
-                                        int(prec['asianPop']),
-                                        int(prec['whitePop']),
-                                        int(otherpop))
-    readable = [int(prec['totalPop']),
-                int(prec['blackPop']),
-                int(prec['nativeAPop']),
-                int(prec['asianPop']),
-                int(prec['whitePop']),
-                int(otherpop)]
+    # Sum the columns of every field, in DEMOGRAPHICS_F order
+    readable = [int(sum(prec[column] for column in columns)) for columns in PACKED_DEMOGRAPHICS]
+    packed = struct.pack(DEMOGRAPHICS_F, *readable)
 
     return packed, readable
 
-def calcNodeSize(numN):
-    "Returns the size of the node record in bytes"
-    IDSize = struct.calcsize(NODE_ID_F)
-    areaSize = struct.calcsize(AREA_F)
-    neighborsSize = struct.calcsize(NEIGHBOR_F) * numN
-    demoSize = struct.calcsize(DEMOGRAPHICS_F)
-    return IDSize + areaSize + neighborsSize + demoSize
-
-def calcCheckSum(state):
-    "Calculates a checksum to be included in the data header"
-    prev = 0
-    with open(OUTPUT_IDX_LOCATION.format(state=state)+'.temp', 'rb') as idx:
-        while True:
-            data = idx.read(2**20)
-            if not data:
-                break
-            prev = zlib.crc32(data, prev)
-
-    idx.close()
-
-    return prev
-
 def getStateMeta(state):
     state = state[:1].upper() + state[1:]
 
@@ -178,14 +292,11 @@ def getStateMeta(state):
 def getTimeDiff(start):
     return round(time.time()-start, 1)
 
-def toIdx(df, state: str, stCode: str, numDistricts: int, readable=False):
+def toIdx(df, state: str, stCode: str, numDistricts: int, readable=False, neighborsLists=None, synthetic=None):
     "Formats and outputs a .idx from the data in the dataframe"
     # Get lists of neighbors for each precinct
-    neighborsLists = getNeighbors(df)
-
-    # Used to store records for printing later
-    nodeRecords = []
-    nodes = []
+    if neighborsLists is None:
+        neighborsLists = getNeighbors(df)
 
     # In case the user wants readable output for testing
     readableRecs = []
@@ -194,85 +305,107 @@ def toIdx(df, state: str, stCode: str, numDistricts: int, readable=False):
     # To keep track of position of node records, cumulative length of previous records
     nodePos = 0
 
-    for index, precinct in df.iterrows():
-        # Pack node #[index]'s data
-
-        # Create and Store Node Record
-        numNeighbors = len(neighborsLists[index])
-        nodeRecord = struct.pack(NODE_RECORD_F, numNeighbors, nodePos)
-        nodeRecords.append(nodeRecord)
-
-        # Pack node data
-        nodeID = struct.pack(NODE_ID_F, int(index))
-        area = struct.pack(AREA_F, precinct.land + precinct.water)
-
-        # neighbor_id #1 - neighbor_id #n_4h
-        neighborsPacked = getNeighborStructList(neighborsLists[index])
-
-        # demographics
-        demoPacked, readableDemo = packDemograpchics(precinct)
-
-        # Create and Store Node
-        node = [nodeID] + [area] + neighborsPacked + [demoPacked]
-        nodes.append(node)
-
-        
-
-        if (readable):
+    if (readable):
+        for index, precinct in df.iterrows():
+            numNeighbors = len(neighborsLists[index])
+            _, readableDemo = packDemograpchics(precinct)
             readableRecs.append((int(index), numNeighbors, nodePos))
             readableNodes.append((int(index), 
                                 precinct.land + precinct.water,
                                 neighborsLists[index],
                                 readableDemo))
 
-        # recalculate nodePos for next record
-        nodePos = nodePos + calcNodeSize(numNeighbors)
-
-        #END OF FORLOOP
+            # recalculate nodePos for next record
+            nodePos = nodePos + calcNodeSize(numNeighbors)
 
-    # Create second half of State Header, missing magic_number, checksum
+    # Output Struct Byte data to idx file
     numNodes = len(df)
-    header2 = struct.pack(HEADER2_F, ord(stCode[0]), ord(stCode[1]), numNodes, numDistricts)
+    data = encodeV1(stCode, numDistricts, range(numNodes), df['land'] + df['water'],
+                    neighborsLists, packDemographicsTable(df))
+    checkSum = struct.unpack_from(HEADER1_F, data)[1]
 
-    # Output Struct Byte data to idx file
-    tempOut = open(OUTPUT_IDX_LOCATION.format(state=state)+'.temp', 'wb')
-    tempTotal = 0
-    tempTotal += tempOut.write(header2)
-    for record in nodeRecords:
-        tempTotal += tempOut.write(record)
-    for node in nodes: # will be list of entries (id, area, neighbor1, ..., demographics)
-        for data in node:
-            tempTotal += tempOut.write(data)
-    tempOut.close()
-
-    # Calculate and pack checksum
-    checkSum = calcCheckSum(state)
-    header1 = struct.pack(HEADER1_F, MAGIC_NUMBER, checkSum)
-
-    # Write Out new header including magic_num and checksum
-    idxOut = open(OUTPUT_IDX_LOCATION.format(state=state), 'wb')
-    idxTotal = 0
-    idxTotal += idxOut.write(header1)
-
-    #write out everything else that was stored in temp
-    with open(OUTPUT_IDX_LOCATION.format(state=state)+'.temp', 'rb') as tempIn:
-        data = tempIn.read()
-        idxTotal += idxOut.write(data)
-    tempIn.close()
+    with atomicOpen(OUTPUT_IDX_LOCATION.format(state=state), 'wb') as idxOut:
+        idxTotal = idxOut.write(data)
 
     logging.info(f"Finished writing {idxTotal} bytes to {state}.idx")
 
-    # Remove temp
-    os.remove(OUTPUT_IDX_LOCATION.format(state=state)+'.temp')
-
     # print readable .idx.json
     if(readable):
         logging.info(f"Writing to " + OUTPUT_IDX_LOCATION.format(state=state) + '.json')
-        written = readableIDX(state, checkSum, stCode, numNodes, numDistricts, readableRecs, readableNodes)
+        written = readableIDX(state, checkSum, stCode, numNodes, numDistricts, readableRecs, readableNodes, synthetic)
         logging.info(f"Finished writing {written} bytes to {state}.idx.json")
     
 
-def readableIDX(state, checkSum, stCode, numNodes, numDistricts, nodeRecords, nodesList):
+def toEdges(df, state: str, stCode: str, neighborsLists, edges):
+    """
+        Formats and outputs a .edges file, next to the .idx:
+            header, the (perimeter, exterior perimeter) of every node,
+            then the shared border length of every neighbor in the order the .idx lists them
+    """
+    edgeLengths, perimeters, exteriors = edges
+
+    numEdges = sum(len(n) for n in neighborsLists)
+    body = [struct.pack(EDGES_HEADER_F, ord(stCode[0]), ord(stCode[1]), len(df), numEdges)]
+    for perimeter, exterior in zip(perimeters, exteriors):
+        body.append(struct.pack(PERIMETER_F, round(perimeter), round(exterior)))
+    for lengths in edgeLengths:
+        body += [struct.pack(EDGE_WEIGHT_F, round(length)) for length in lengths]
+    body = b''.join(body)
+
+    with atomicOpen(OUTPUT_EDGES_LOCATION.format(state=state), 'wb') as edgesOut:
+        written = edgesOut.write(struct.pack(HEADER1_F, EDGES_MAGIC_NUMBER, zlib.crc32(body)))
+        return written + edgesOut.write(body)
+
+def packTable(df, packed):
+    """
+        Returns a (numNodes, len(packed)) array, every field the sum of its columns of a PACKED_* list.
+        Columns are summed before they're truncated, the apportioned populations are fractional
+    """
+    return np.stack([np.array(df[columns], dtype=np.float64).sum(axis=1).astype(np.int64) for columns in packed], axis=1)
+
+def packDemographicsTable(df):
+    "Returns the demographics of every precinct as a (numNodes, 6) array, in DEMOGRAPHICS_F order"
+    return packTable(df, PACKED_DEMOGRAPHICS)
+
+def getV2Sections(df, neighborsLists, edges=None, synthetic=None):
+    "Returns the (tag, bytes) sections of a v2 .idx for the dataframe"
+    sections = [
+        (b'TOPO', encodeCSR(neighborsLists)),
+        (b'ATTR', np.array(df['land'] + df['water'], dtype=U8).tobytes()),
+        (b'DEMO', packDemographicsTable(df).astype(U4).tobytes()),
+    ]
+    if edges is not None:
+        edgeLengths, perimeters, exteriors = edges
+        sections.append((b'PERI', np.round(np.stack([perimeters, exteriors], axis=1)).astype(U4).tobytes()))
+        sections.append((b'EDGE', np.round([l for lengths in edgeLengths for l in lengths]).astype(U4).tobytes()))
+    if all(column in df.columns for column in getPackedColumns(PACKED_VOTES)):
+        sections.append((b'VOTE', packTable(df, PACKED_VOTES).astype(U4).tobytes()))
+    if 'countyfp' in df.columns:
+        counties, countyTable = encodeCounties(df['countyfp'], packDemographicsTable(df))
+        sections += [(b'CNTY', counties), (b'CTAB', countyTable)]
+    if synthetic:
+        sections.append((b'SYNT', np.array([(i, j) for i, j, _ in synthetic], dtype=U4).tobytes()))
+    return sections
+
+def toIdxV2(df, state: str, stCode: str, numDistricts: int, neighborsLists, edges=None, compress=False, synthetic=None):
+    "Formats and outputs a sectioned v2 .idx from the data in the dataframe"
+    sections = getV2Sections(df, neighborsLists, edges, synthetic)
+
+    with atomicOpen(OUTPUT_IDX_LOCATION.format(state=state), 'wb') as idxOut:
+        written = idxOut.write(encodeV2(stCode, len(df), numDistricts, sections, compress))
+    logging.info(f"Finished writing {written} bytes ({len(sections)} sections) to {state}.idx")
+    return written
+
+def toHierarchy(df, state: str, stCode: str, numDistricts: int, neighborsLists, compress=False):
+    "Formats and outputs the .hier.idx, the precinct graph plus its county and region levels"
+    counties = df['countyfp'] if 'countyfp' in df.columns else None
+    sections = getV2Sections(df, neighborsLists)
+    sections += hierarchy.buildSections(neighborsLists, df['land'] + df['water'],
+                                        packDemographicsTable(df), counties, numDistricts)
+    with atomicOpen(OUTPUT_HIERARCHY_LOCATION.format(state=state), 'wb') as hierOut:
+        return hierOut.write(encodeV2(stCode, len(df), numDistricts, sections, compress))
+
+def readableIDX(state, checkSum, stCode, numNodes, numDistricts, nodeRecords, nodesList, synthetic=None):
     records = []
     for rec in nodeRecords:
         record = {
@@ -306,8 +439,10 @@ def readableIDX(state, checkSum, stCode, numNodes, numDistricts, nodeRecords, no
         "node_records": records,
         "nodes": nodes
     }
+    if synthetic:
+        header["synthetic_edges"] = [{"from": i, "to": j, "distance": round(distance)} for i, j, distance in synthetic]
 
-    with open(OUTPUT_IDX_LOCATION.format(state=state)+'.json', "w") as outfile:
+    with atomicOpen(OUTPUT_IDX_LOCATION.format(state=state)+'.json', "w") as outfile:
         return outfile.write(json.dumps(header, indent = 4))
 
 
@@ -348,7 +483,7 @@ def toJSON(df, state: str, stCode: str, maxDistricts: int, fips: int, includeV=T
     if not includeV:
         json_loc = json_loc[:-5]+'.novert.json'
 
-    with open(json_loc, "w") as outfile:
+    with atomicOpen(json_loc, "w") as outfile:
         return outfile.write(json.dumps(dictionary, indent = 4))
 
 def checkArgs(args) :
@@ -359,7 +494,7 @@ def checkArgs(args) :
     for arg in args:
         if arg == '-all':
             return set([arg])
-        if arg not in ARGUMENTS:
+        if arg.split('=')[0] not in ARGUMENTS:
             print("Unknown argument: " + arg)
         else:
             clean.append(arg)
@@ -368,33 +503,189 @@ def checkArgs(args) :
     return set(clean) 
 
 def toJSONDict(df, state, stCode):
-    mapping = []
-    for index, prec in df.iterrows():
-        # mapping.append(
-        #     {"Precinct:": int(index), "District": prec['district']}
-        # )
-        mapping.append([int(index), prec['district']])
+    mapping = [[int(index), int(district)] for index, district in zip(df.index, df['district'])]
     output = {
         "state": stCode,
         "map": mapping
     }
     districtsLoc = OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.districts.json'
-    with open(districtsLoc, "w") as outfile:
+    with atomicOpen(districtsLoc, "w") as outfile:
         return outfile.write(json.dumps(output, indent = 4))
 
 
+def getDistrictTotals(df, numDistricts: int):
+    "Returns the (numDistricts, DISTRICT_TOTALS) totals of every district: demographics, area, node count"
+    table = pd.DataFrame(packDemographicsTable(df))
+    table['area'] = np.array(df['land'] + df['water'], dtype=np.int64)
+    table['nodes'] = 1
+    totals = table.groupby(np.array(df['district'], dtype=np.int64)).sum()
+    if len(totals) and (totals.index.min() < 1 or totals.index.max() > numDistricts):
+        raise ValueError(f"Districts run from {totals.index.min()} to {totals.index.max()}, not 1 to {numDistricts}")
+    return totals.reindex(range(1, numDistricts + 1), fill_value=0).to_numpy()
+
+def toDistrictMap(df, state, stCode, numDistricts: int):
+    "Formats and outputs the .dmap, the district of every node and the totals of every district"
+    data = encodeDistrictMap(stCode, numDistricts, np.array(df['district'], dtype=np.int64),
+                             getDistrictTotals(df, numDistricts))
+    with atomicOpen(OUTPUT_DMAP_LOCATION.format(state=state), 'wb') as dmapOut:
+        return dmapOut.write(data)
+
+def toGeoidMap(df, state, stCode, ordering):
+    "Writes the node id -> GEOID map of a renumbered graph"
+    if 'GEOID' not in df.columns:
+        logging.warning(f"The cached artifact for {state} has no GEOIDs, rerun the stateparser to map node ids")
+        return 0
+    output = {
+        "state": stCode,
+        "ordering": ordering,
+        "geoids": df['GEOID'].tolist()
+    }
+    with atomicOpen(OUTPUT_GEOIDS_LOCATION.format(state=state), "w") as outfile:
+        return outfile.write(json.dumps(output, indent = 4))
+
+def toSynthetic(state, stCode, synthetic):
+    "Writes the synthetic edges -connect added, so consumers of a v1 .idx can tell them from real neighbors"
+    output = {
+        "state": stCode,
+        "synthetic_edges": [{"from": i, "to": j, "distance": round(distance)} for i, j, distance in synthetic]
+    }
+    with atomicOpen(OUTPUT_SYNTHETIC_LOCATION.format(state=state), "w") as outfile:
+        return outfile.write(json.dumps(output, indent = 4))
+
+def loadRegistry(df, state):
+    "Returns the last build's .geoids.json, if node ids can be kept stable against it"
+    location = OUTPUT_GEOIDS_LOCATION.format(state=state)
+    if 'GEOID' not in df.columns or not os.path.isfile(location):
+        return None
+    if df['GEOID'].duplicated().any():
+        logging.warning(f"Duplicate GEOIDs in the cached artifact for {state}, node ids can't be kept stable")
+        return None
+    with open(location) as infile:
+        return json.load(infile)
+
+def toPatch(previous, state: str):
+    "Writes the patch from the previous build's .idx (bytes) to the one just written"
+    with IdxFile(OUTPUT_IDX_LOCATION.format(state=state)) as new:
+        patch = idxdelta.diff(IdxFile(OUTPUT_IDX_LOCATION.format(state=state), previous), new)
+    with atomicOpen(OUTPUT_PATCH_LOCATION.format(state=state), 'wb') as patchOut:
+        return patchOut.write(patch)
+
+def getRookThreshold(args):
+    "Returns the minimum shared boundary length asked for with -rook, None if it wasn't"
+    if args is None:
+        return None
+    for arg in args:
+        if arg == '-rook':
+            return adjacency.MIN_SHARED_LENGTH
+        if arg.startswith('-rook='):
+            return float(arg.split('=')[1])
+    return None
+
+def getOrdering(args):
+    "Returns the node ordering asked for in the arguments, if any"
+    if args is None:
+        return None
+    orderings = [reorder.ORDERINGS[arg] for arg in args if arg in reorder.ORDERINGS]
+    if len(orderings) > 1:
+        raise ValueError("Only one node ordering can be used at a time")
+    return orderings[0] if orderings else None
+
+def toSeedDistricts(df, state, stCode, numDistricts, neighborsLists, edges=None):
+    "Partitions the graph into population balanced districts, written in the .districts.json format"
+    edgeWeights = edges[0] if edges is not None else None
+    districts = partition.partition(neighborsLists, df['totalPop'].tolist(), numDistricts, edgeWeights)
+    output = {
+        "state": stCode,
+        "map": [[index, district] for index, district in enumerate(districts)]
+    }
+    with atomicOpen(OUTPUT_SEED_LOCATION.format(state=state), "w") as outfile:
+        return outfile.write(json.dumps(output, indent = 4))
+
 def toSHP(df, state):
+    "Writes the shp directory into a temporary directory, then swaps it in"
     shpDir = SHP_OUTPUT.format(state=state)
-    if not os.path.isdir(shpDir):
-        logging.info(f"Creating {shpDir}")
-        os.mkdir(shpDir)
+    temporary = temporaryPath(shpDir)
+    os.mkdir(temporary)
     geodf = geopandas.GeoDataFrame(df, geometry='geometry')
-    geodf.to_file((SHP_OUTPUT + '{state}.shp').format(state=state))
+    # The cache keeps names and counties as categoricals, which geopandas can't infer a field type for
+    for column, dtype in geodf.dtypes.items():
+        if str(dtype) == 'category':
+            geodf[column] = geodf[column].astype(str)
+    geodf.to_file(os.path.join(temporary, f'{state}.shp'))
+    logging.info(f"Moving the shapefile into {shpDir}")
+    replacePath(temporary, shpDir)
+
+def toLookup(df, state: str, stCode: str):
+    "Formats and outputs the .lookup point-in-precinct index, keyed to node ids"
+    boxes = np.array([geometry.bounds for geometry in df['geometry']], dtype=np.float64)
+    with atomicOpen(OUTPUT_LOOKUP_LOCATION.format(state=state), 'wb') as lookupOut:
+        return lookupOut.write(pointindex.encode(stCode, boxes, LOOKUP_PADDING))
+
+def getVectorSchema(df):
+    "Returns the fiona schema of the frame, every geometry written as a MultiPolygon"
+    properties = {}
+    for column, dtype in df.dtypes.items():
+        if column == 'geometry':
+            continue
+        if dtype.kind in 'iub':
+            properties[column] = 'int'
+        elif dtype.kind == 'f':
+            properties[column] = 'float'
+        else:
+            properties[column] = 'str'
+    return {'geometry': 'MultiPolygon', 'properties': properties}
+
+def toVectorRecord(row, schema):
+    "Returns a fiona record for one row of the frame"
+    properties = {}
+    for column, kind in schema['properties'].items():
+        value = row[column]
+        if value is None or (kind != 'str' and pd.isna(value)):
+            properties[column] = None
+        elif kind == 'int':
+            properties[column] = int(value)
+        elif kind == 'float':
+            properties[column] = float(value)
+        else:
+            properties[column] = str(value)
+    geometry = row['geometry']
+    if geometry.geom_type == 'Polygon':
+        geometry = MultiPolygon([geometry])
+    return {'geometry': mapping(geometry), 'properties': properties}
+
+def toVectorFile(df, state, option):
+    """
+        Writes the frame as a spatially indexed GeoPackage or FlatGeobuf (option is a key of
+        VECTOR_FORMATS), in batches of VECTOR_BATCH_SIZE features, returns the path written or
+        None if this GDAL doesn't have the driver
+    """
+    driver, location = VECTOR_FORMATS[option]
+    if driver not in fiona.supported_drivers:
+        logging.warning(f"This GDAL can't write {driver}, skipping the {option} export")
+        return None
+
+    path = location.format(state=state)
+    temporary = temporaryPath(path, keepExtension=True)
+    schema = getVectorSchema(df)
+    columns = list(schema['properties']) + ['geometry']
+    with fiona.open(temporary, 'w', driver=driver, schema=schema, crs=from_epsg(int(GIS_CRS.split(':')[1])),
+                    layer=state, SPATIAL_INDEX='YES') as sink:
+        batch = []
+        for values in zip(*(df[column] for column in columns)):
+            batch.append(toVectorRecord(dict(zip(columns, values)), schema))
+            if len(batch) == VECTOR_BATCH_SIZE:
+                sink.writerecords(batch)
+                batch = []
+        if batch:
+            sink.writerecords(batch)
+    replacePath(temporary, path)
+    return path
         
     
 def main(args):
-    "Creates the output .idx and json files from the cleaned and merged dataframe"
+    "Creates the output .idx and json files from the cleaned and merged dataframe, returns the written paths"
     startTime = time.time()
+    artifacts = []
 
     # Get state
     state = args[0]
@@ -416,37 +707,167 @@ def main(args):
     #initialize output directory
     initializeOutput(state)
 
+    # Compresses the JSON outputs in the background, as soon as each is written
+    compressor = None
+    if (args != None and '-precompress' in args):
+        compressor = precompress.Precompressor()
+
+    # Get lists of neighbors for each precinct, if anything needs them
+    ordering = getOrdering(args)
+    neighborsLists = None
+    if args == None or ordering == 'rcm' or len(args & set(['-all', '-readable', '-idx', '-edges', '-v2', '-seed', '-patch', '-hierarchy'])) > 0:
+        rookThreshold = getRookThreshold(args)
+        if rookThreshold is not None:
+            logging.info(f"Finding rook neighbors sharing at least {rookThreshold}m of boundary")
+            neighborsLists = adjacency.getRookNeighbors(projectedGeometry(df).tolist(), rookThreshold)
+        else:
+            neighborsLists = getCachedNeighbors(df, state, '-parallel' in args)
+
+    # Renumber the nodes before anything is encoded, so all outputs agree on node ids
+    registry = loadRegistry(df, state)
+    if ordering is not None:
+        logging.info(f"Renumbering nodes in {ordering} order")
+        order = reorder.getOrder(ordering, df, neighborsLists)
+        df, neighborsLists = reorder.applyOrder(df, neighborsLists, order)
+    elif registry is not None:
+        logging.info(f"Keeping node ids stable against " + OUTPUT_GEOIDS_LOCATION.format(state=state))
+        order = reorder.stableOrder(df['GEOID'].tolist(), registry['geoids'])
+        df, neighborsLists = reorder.applyOrder(df, neighborsLists, order)
+        ordering = registry['ordering']
+
+    # Link up islands, after renumbering so the synthetic edges use the final node ids
+    synthetic = []
+    if (args != None and '-connect' in args and neighborsLists is not None):
+        neighborsLists, synthetic = adjacency.connectComponents(projectedGeometry(df).tolist(), neighborsLists)
+        for i, j, distance in synthetic:
+            logging.warning(f"Linked disconnected node {i} to node {j}, {round(distance)}m apart")
+        logging.info(f"Added {len(synthetic)} synthetic edges")
+        logging.info(f"Writing to " + OUTPUT_SYNTHETIC_LOCATION.format(state=state))
+        written = toSynthetic(state, stCode, synthetic)
+        logging.info(f"Finished writing {written} bytes to {state}.synthetic.json")
+        artifacts.append(OUTPUT_SYNTHETIC_LOCATION.format(state=state))
+
+    if 'GEOID' in df.columns:
+        logging.info(f"Writing to " + OUTPUT_GEOIDS_LOCATION.format(state=state))
+        written = toGeoidMap(df, state, stCode, ordering)
+        logging.info(f"Finished writing {written} bytes to {state}.geoids.json")
+        artifacts.append(OUTPUT_GEOIDS_LOCATION.format(state=state))
+
     # Output to .shp file
     if (args != None and ('-shp' in args or '-all' in args)):
         toSHP(df, state)
+        artifacts.append(SHP_OUTPUT.format(state=state))
+
+    # Output to spatially indexed .gpkg/.fgb files
+    for option in sorted(VECTOR_FORMATS):
+        if (args != None and option in args):
+            logging.info(f"Writing to " + VECTOR_FORMATS[option][1].format(state=state))
+            path = toVectorFile(df, state, option)
+            if path is not None:
+                artifacts.append(path)
+
+    # Compute the edge weights once, for both the .edges and the v2 .idx
+    edges = None
+    if (args != None and '-edges' in args):
+        edges = getEdgeLengths(df, neighborsLists)
+
+    # Keep the last build's .idx around to diff against
+    previous = None
+    if (args != None and '-patch' in args and os.path.isfile(OUTPUT_IDX_LOCATION.format(state=state))):
+        with open(OUTPUT_IDX_LOCATION.format(state=state), 'rb') as idxIn:
+            previous = idxIn.read()
 
     # Output to .idx file
-    if (args != None and ('-all' in args or '-readable' in args)):
+    if (args != None and '-v2' in args):
+        logging.info(f"Writing to " + OUTPUT_IDX_LOCATION.format(state=state) + " (v2)")
+        if '-all' in args or '-readable' in args:
+            logging.warning(f"The readable .idx.json describes the v1 layout, skipping it")
+        written = toIdxV2(df, state, stCode, numDistricts, neighborsLists, edges, '-deflate' in args, synthetic)
+        artifacts.append(OUTPUT_IDX_LOCATION.format(state=state))
+    elif (args != None and ('-all' in args or '-readable' in args)):
         logging.info(f"Writing to " + OUTPUT_IDX_LOCATION.format(state=state))
-        written = toIdx(df, state, stCode, numDistricts, True)
+        written = toIdx(df, state, stCode, numDistricts, True, neighborsLists, synthetic)
+        artifacts.append(OUTPUT_IDX_LOCATION.format(state=state))
+        artifacts.append(OUTPUT_IDX_LOCATION.format(state=state) + '.json')
+        if compressor is not None:
+            compressor.submit(OUTPUT_IDX_LOCATION.format(state=state) + '.json')
     elif (args == None or '-idx' in args):
         logging.info(f"Writing to " + OUTPUT_IDX_LOCATION.format(state=state))
-        written = toIdx(df, state, stCode, numDistricts)
+        written = toIdx(df, state, stCode, numDistricts, neighborsLists=neighborsLists)
+        artifacts.append(OUTPUT_IDX_LOCATION.format(state=state))
     
 
+    if previous is not None:
+        logging.info(f"Writing to " + OUTPUT_PATCH_LOCATION.format(state=state))
+        written = toPatch(previous, state)
+        logging.info(f"Finished writing {written} bytes to {state}.idx.patch")
+        artifacts.append(OUTPUT_PATCH_LOCATION.format(state=state))
+
+    # Output to .edges file
+    if (args != None and '-edges' in args):
+        logging.info(f"Writing to " + OUTPUT_EDGES_LOCATION.format(state=state))
+        written = toEdges(df, state, stCode, neighborsLists, edges)
+        logging.info(f"Finished writing {written} bytes to {state}.edges")
+        artifacts.append(OUTPUT_EDGES_LOCATION.format(state=state))
+
     # Output to .JSON file
     if (args == None or '-json' in args or '-all' in args):
         logging.info(f"Writing to " + OUTPUT_JSON_LOCATION.format(state=state))
         written = toJSON(df, state, stCode, numDistricts, fips)
         logging.info(f"Finished writing {written} bytes to {state}.json")
+        artifacts.append(OUTPUT_JSON_LOCATION.format(state=state))
+        if compressor is not None:
+            compressor.submit(OUTPUT_JSON_LOCATION.format(state=state))
 
     if (args == None or '-novert' in args or '-all' in args):
         # Chang where to write to
         logging.info(f"Writing to " + OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.novert.json')
         written = toJSON(df, state, stCode, numDistricts, fips, False)
         logging.info(f"Finished writing {written} bytes to {state}.novert.json")
+        artifacts.append(OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.novert.json')
+        if compressor is not None:
+            compressor.submit(OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.novert.json')
 
     if (args == None or '-districts' in args or '-all in args'):
         logging.info(f"Writing to " + OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.districts.json')
         written = toJSONDict(df, state, stCode)
         logging.info(f"Finished writing {written} bytes to {state}.districts.json")
+        artifacts.append(OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.districts.json')
+        if compressor is not None:
+            compressor.submit(OUTPUT_JSON_LOCATION.format(state=state)[:-5]+'.districts.json')
+
+    if (args != None and '-hierarchy' in args):
+        logging.info(f"Writing to " + OUTPUT_HIERARCHY_LOCATION.format(state=state))
+        written = toHierarchy(df, state, stCode, numDistricts, neighborsLists, '-deflate' in args)
+        logging.info(f"Finished writing {written} bytes to {state}.hier.idx")
+        artifacts.append(OUTPUT_HIERARCHY_LOCATION.format(state=state))
+
+    if (args != None and ('-dmap' in args or '-all' in args)):
+        logging.info(f"Writing to " + OUTPUT_DMAP_LOCATION.format(state=state))
+        written = toDistrictMap(df, state, stCode, numDistricts)
+        logging.info(f"Finished writing {written} bytes to {state}.dmap")
+        artifacts.append(OUTPUT_DMAP_LOCATION.format(state=state))
+
+    if (args != None and '-seed' in args):
+        logging.info(f"Writing to " + OUTPUT_SEED_LOCATION.format(state=state))
+        written = toSeedDistricts(df, state, stCode, numDistricts, neighborsLists, edges)
+        logging.info(f"Finished writing {written} bytes to {state}.seed.districts.json")
+        artifacts.append(OUTPUT_SEED_LOCATION.format(state=state))
+
+    if (args != None and '-lookup' in args):
+        logging.info(f"Writing to " + OUTPUT_LOOKUP_LOCATION.format(state=state))
+        written = toLookup(df, state, stCode)
+        logging.info(f"Finished writing {written} bytes to {state}.lookup")
+        artifacts.append(OUTPUT_LOOKUP_LOCATION.format(state=state))
+
+    if compressor is not None:
+        logging.info(f"Writing to " + OUTPUT_MANIFEST_LOCATION.format(state=state))
+        compressed = set(compressor.submitted)
+        others = [path for path in artifacts if path not in compressed and os.path.isfile(path)]
+        artifacts += compressor.finish(OUTPUT_MANIFEST_LOCATION.format(state=state), others)
 
     logging.info(f"Finished writing {state} output in {getTimeDiff(startTime)} seconds\n\n")
+    return artifacts
 
 
 if __name__ == "__main__":
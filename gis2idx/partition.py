@@ -0,0 +1,232 @@
+"""
+A multilevel graph partitioner that produces a contiguous, population balanced seed
+districting, so Rakan can start from a valid plan.
+
+    1. Coarsen: repeatedly contract a heavy edge matching, until the graph is small
+    2. Partition: grow numDistricts regions from far apart seeds on the coarsest graph
+    3. Refine: project the regions back down one level at a time, moving boundary nodes
+       between districts to balance population (and shorten the cut) without ever
+       disconnecting a district
+"""
+
+import logging
+from collections import deque
+
+import numpy as np
+
+COARSEST_NODES_PER_DISTRICT = 8  # Stop coarsening at about this many nodes per district
+MIN_COARSEN_RATIO = 0.95          # Stop coarsening once a level shrinks the graph less than this
+MAX_NODE_SHARE = 0.25             # Don't merge nodes past this share of a district's ideal population
+MAX_REFINE_PASSES = 32
+TOLERANCE = 0.01                  # Acceptable deviation from the ideal population, for cut moves
+SEED = 0
+
+def toWeightedGraph(neighborsLists, edgeWeights=None):
+    "Returns the graph as a list of {neighbor: edge weight} dicts"
+    graph = []
+    for i, neighbors in enumerate(neighborsLists):
+        weights = edgeWeights[i] if edgeWeights is not None else [1] * len(neighbors)
+        graph.append({j: max(w, 1) for j, w in zip(neighbors, weights) if j != i})
+    return graph
+
+def coarsen(graph, weights, maxNodeWeight, rng):
+    "Contracts a heavy edge matching, returns (coarse graph, coarse weights, fine -> coarse map)"
+    match = [-1] * len(graph)
+    for u in rng.permutation(len(graph)).tolist():
+        if match[u] != -1:
+            continue
+        best, bestScore = u, None
+        for v, w in graph[u].items():
+            if match[v] != -1 or weights[u] + weights[v] > maxNodeWeight:
+                continue
+            # Heaviest edge first, lighter partner on ties
+            score = (w, -weights[v])
+            if bestScore is None or score > bestScore:
+                best, bestScore = v, score
+        match[u] = best
+        match[best] = u
+
+    coarseIds = [-1] * len(graph)
+    numCoarse = 0
+    for u in range(len(graph)):
+        if coarseIds[u] == -1:
+            coarseIds[u] = coarseIds[match[u]] = numCoarse
+            numCoarse += 1
+
+    coarseWeights = [0] * numCoarse
+    coarseGraph = [{} for _ in range(numCoarse)]
+    for u in range(len(graph)):
+        cu = coarseIds[u]
+        coarseWeights[cu] += weights[u]
+        for v, w in graph[u].items():
+            cv = coarseIds[v]
+            if cv != cu:
+                coarseGraph[cu][cv] = coarseGraph[cu].get(cv, 0) + w
+    return coarseGraph, coarseWeights, coarseIds
+
+def bfsDistances(graph, sources):
+    "Returns the hop distance of every node from the nearest source (-1 if unreachable)"
+    distances = [-1] * len(graph)
+    queue = deque(sources)
+    for s in sources:
+        distances[s] = 0
+    while queue:
+        u = queue.popleft()
+        for v in graph[u]:
+            if distances[v] == -1:
+                distances[v] = distances[u] + 1
+                queue.append(v)
+    return distances
+
+def growRegions(graph, weights, numDistricts):
+    "Initial partition: grows numDistricts regions from far apart seeds, lightest region first"
+    # Farthest point seeds, starting from the node farthest from node 0
+    distances = bfsDistances(graph, [0])
+    seeds = [int(np.argmax(distances))]
+    while len(seeds) < numDistricts:
+        distances = bfsDistances(graph, seeds)
+        candidates = [u for u in range(len(graph)) if u not in seeds]
+        seeds.append(max(candidates, key=lambda u: distances[u]))
+
+    part = [-1] * len(graph)
+    regionWeights = [0] * numDistricts
+    frontiers = [dict() for _ in range(numDistricts)]
+    for d, s in enumerate(seeds):
+        part[s] = d
+        regionWeights[d] += weights[s]
+    for d, s in enumerate(seeds):
+        for v, w in graph[s].items():
+            if part[v] == -1:
+                frontiers[d][v] = frontiers[d].get(v, 0) + w
+
+    open_ = set(range(numDistricts))
+    while open_:
+        d = min(open_, key=lambda r: regionWeights[r])
+        frontier = frontiers[d]
+        for v in [v for v in frontier if part[v] != -1]:
+            del frontier[v]
+        if not frontier:
+            open_.discard(d)
+            continue
+
+        # Take the unassigned node most strongly connected to the region
+        u = max(frontier, key=lambda v: (frontier[v], -v))
+        del frontier[u]
+        part[u] = d
+        regionWeights[d] += weights[u]
+        for v, w in graph[u].items():
+            if part[v] == -1:
+                frontier[v] = frontier.get(v, 0) + w
+
+    # Whatever is left can't be reached from any seed (islands), give it to the lightest region
+    unassigned = [u for u in range(len(graph)) if part[u] == -1]
+    if unassigned:
+        logging.warning(f"{len(unassigned)} nodes are disconnected from every seed, the seed plan won't be contiguous")
+    for u in unassigned:
+        d = min(range(numDistricts), key=lambda r: regionWeights[r])
+        part[u] = d
+        regionWeights[d] += weights[u]
+    return part
+
+def staysConnected(graph, part, u):
+    "Returns True if u's district is still connected without u"
+    district = part[u]
+    same = [v for v in graph[u] if part[v] == district]
+    if len(same) <= 1:
+        return True
+
+    # Search from one neighbor until every other neighbor in the district has been reached
+    remaining = set(same[1:])
+    seen = set([u, same[0]])
+    queue = deque([same[0]])
+    while queue and remaining:
+        v = queue.popleft()
+        for x in graph[v]:
+            if x not in seen and part[x] == district:
+                seen.add(x)
+                remaining.discard(x)
+                queue.append(x)
+    return not remaining
+
+def refine(graph, weights, part, numDistricts, ideal):
+    "Moves boundary nodes between districts to balance population, then to shorten the cut"
+    districtWeights = [0] * numDistricts
+    districtSizes = [0] * numDistricts
+    for u, d in enumerate(part):
+        districtWeights[d] += weights[u]
+        districtSizes[d] += 1
+    limit = ideal * TOLERANCE
+
+    for _ in range(MAX_REFINE_PASSES):
+        moved = 0
+        # Heaviest districts give nodes away first
+        for u in sorted(range(len(graph)), key=lambda v: -districtWeights[part[v]]):
+            src = part[u]
+            connections = {}
+            for v, w in graph[u].items():
+                connections[part[v]] = connections.get(part[v], 0) + w
+            internal = connections.pop(src, 0)
+            if not connections or districtSizes[src] == 1:
+                continue
+
+            best, bestKey = None, None
+            for dst, external in connections.items():
+                before = max(abs(districtWeights[src] - ideal), abs(districtWeights[dst] - ideal))
+                after = max(abs(districtWeights[src] - weights[u] - ideal),
+                            abs(districtWeights[dst] + weights[u] - ideal))
+                gain = external - internal
+                balances = districtWeights[src] - districtWeights[dst] > weights[u] and after < before
+                shortens = gain > 0 and after <= max(before, limit)
+                if not (balances or shortens):
+                    continue
+                key = (before - after, gain)
+                if bestKey is None or key > bestKey:
+                    best, bestKey = dst, key
+
+            if best is None or not staysConnected(graph, part, u):
+                continue
+            part[u] = best
+            districtWeights[src] -= weights[u]
+            districtWeights[best] += weights[u]
+            districtSizes[src] -= 1
+            districtSizes[best] += 1
+            moved += 1
+        if moved == 0:
+            break
+    return part
+
+def partition(neighborsLists, populations, numDistricts: int, edgeWeights=None):
+    """
+        Returns a district (1 to numDistricts) for every node, contiguous wherever the graph is,
+        with population as balanced as the node sizes allow
+    """
+    if len(neighborsLists) < numDistricts:
+        raise ValueError(f"Can't split {len(neighborsLists)} nodes into {numDistricts} districts")
+    rng = np.random.RandomState(SEED)
+    weights = [int(p) for p in populations]
+    ideal = sum(weights) / numDistricts
+
+    # Coarsen
+    levels = []
+    graph = toWeightedGraph(neighborsLists, edgeWeights)
+    while len(graph) > COARSEST_NODES_PER_DISTRICT * numDistricts:
+        coarseGraph, coarseWeights, coarseIds = coarsen(graph, weights, ideal * MAX_NODE_SHARE, rng)
+        if len(coarseGraph) > MIN_COARSEN_RATIO * len(graph):
+            break
+        levels.append((graph, weights, coarseIds))
+        graph, weights = coarseGraph, coarseWeights
+    logging.info(f"Coarsened {len(neighborsLists)} nodes to {len(graph)} in {len(levels)} levels")
+
+    # Partition the coarsest graph, then refine it on the way back down
+    part = refine(graph, weights, growRegions(graph, weights, numDistricts), numDistricts, ideal)
+    for graph, weights, coarseIds in reversed(levels):
+        part = [part[c] for c in coarseIds]
+        part = refine(graph, weights, part, numDistricts, ideal)
+
+    districtWeights = [0] * numDistricts
+    for u, d in enumerate(part):
+        districtWeights[d] += weights[u]
+    deviation = max(abs(w - ideal) for w in districtWeights) / ideal if ideal else 0
+    logging.info(f"Seed districting has a max population deviation of {round(100 * deviation, 2)}%")
+
+    return [d + 1 for d in part]
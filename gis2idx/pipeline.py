@@ -0,0 +1,187 @@
+"""
+The per-state build pipeline (stateparser -> merged2output), shared by the
+command line entry point and the build daemon.
+
+Only the standard library and util are imported up front: options, inputs and the cache are
+checked (and a -plan printed) before stateparser and merged2output bring in the geo stack.
+"""
+
+import logging
+import os
+
+from exceptions import (
+    NoGISFilesFoundException,
+    NoCSVFilesFoundException
+)
+
+from util import (
+    # Constants
+    OUTPUT_IDX_LOCATION,
+    OUTPUT_JSON_LOCATION,
+    VTD_LOCATION,
+    TRACTS_LOCATION,
+    VOTES_LOCATION,
+    DEMOGRAPHIC_LOCATION,
+    BLOCKS_LOCATION,
+    BLOCK_DEMOGRAPHIC_LOCATION,
+    CONGRESSIONAL_DISTRICTS_LOCATION,
+    MERGED_DF_INPUT,
+    NEIGHBORS_CACHE,
+    OUTPUT_ARGUMENTS,
+
+    # Functions
+    getCachedApportionment,
+    getGranularity,
+    shapefileExists
+)
+
+# Options handled here, rather than passed on to merged2output
+PARSER_ARGUMENTS = set(['-use_cache', '-update', '-blocks'])
+# Options of the entry point itself
+CLI_ARGUMENTS = set(['-parse', '-plan', '-resume'])
+
+def processState(state: str, args, journal=None):
+    """
+        Converts a state directory (location of GIS and CSV file) and produces an .idx and .json file.
+        Assumes the proper state GIS/CSV files exist.
+        Returns the list of artifacts that were written.
+        With a journal.RunJournal, stages it has recorded as finished (with unchanged artifacts) are
+        skipped, and every stage that finishes is recorded in it.
+    """
+    if journal is not None and '-parse' not in args:
+        artifacts = journal.completed(state, 'merged2output')
+        if artifacts is not None:
+            logging.info(f"{state} was already built in this run, skipping it")
+            return artifacts
+    parsed = journal is not None and journal.completed(state, 'stateparser') is not None
+
+    import stateparser
+    import merged2output
+
+    logging.info(f"Processing state: {state}")
+    blocks = '-blocks' in args
+    if parsed:
+        logging.info(f"The stateparser already ran for {state} in this run, reusing its cache")
+    elif '-update' in args:
+        logging.info(f"Running stateparser.update({state})")
+        stateparser.update(state, blocks=blocks)
+    elif '-use_cache' in args:
+        logging.info(f"Attempting to use previously cached stateparser data..")
+        if not os.path.exists(MERGED_DF_INPUT.format(state=state)):
+            logging.info(f"Cannot find cached data for {state}")
+            logging.info(f"Running stateparser({state})")
+            stateparser.main(state, blocks)
+        elif getCachedApportionment(state) != getApportionment(args):
+            logging.info(f"The cached data for {state} was apportioned from {getCachedApportionment(state)}, "
+                         f"not {getApportionment(args)}")
+            logging.info(f"Running stateparser({state})")
+            stateparser.main(state, blocks)
+        else:
+            logging.info(f"Found cached data for {state}!")
+    else:
+        logging.info(f"Running stateparser({state})")
+        stateparser.main(state, blocks)
+    if journal is not None and not parsed:
+        journal.record(state, 'stateparser', [MERGED_DF_INPUT.format(state=state)])
+
+    #-idx, -readable, -json, -novert, -all, or NONE, Documentation in merged2output.py
+    # default merged2output args
+    outputArgs = [state] # default merged2output args
+    for arg in args:
+        if arg.startswith('-') and arg not in PARSER_ARGUMENTS | CLI_ARGUMENTS:
+            outputArgs.append(arg)
+
+    if '-parse' in args:
+        return [MERGED_DF_INPUT.format(state=state)]
+
+    logging.info(f"Running merged2output({str(outputArgs)[1:-1]})")
+    artifacts = merged2output.main(outputArgs)
+    if journal is not None:
+        journal.record(state, 'merged2output', artifacts)
+    return artifacts
+
+def getApportionment(args):
+    "Returns what the population is apportioned from with these options"
+    return 'blocks' if '-blocks' in args else 'tracts'
+
+def unknownArguments(args):
+    "Returns the options no stage of the pipeline takes"
+    known = PARSER_ARGUMENTS | CLI_ARGUMENTS | OUTPUT_ARGUMENTS | set(['-all'])
+    return sorted(arg for arg in args if arg.split('=')[0] not in known)
+
+def getInputs(state: str, args):
+    "Returns (description, location, exists, exception) for every input a build of the state reads"
+    inputs = [
+        ("VTD gis files", VTD_LOCATION, shapefileExists, NoGISFilesFoundException),
+        ("Voting data gis files", VOTES_LOCATION, os.path.isdir, NoGISFilesFoundException),
+    ]
+    if '-blocks' not in args:
+        inputs += [
+            ("Census tract gis files", TRACTS_LOCATION, shapefileExists, NoGISFilesFoundException),
+            ("Demographics CSV file", DEMOGRAPHIC_LOCATION, os.path.isfile, NoCSVFilesFoundException),
+        ]
+    else:
+        inputs += [
+            ("Census block gis files", BLOCKS_LOCATION, shapefileExists, NoGISFilesFoundException),
+            ("Census block demographics CSV file", BLOCK_DEMOGRAPHIC_LOCATION, os.path.isfile, NoCSVFilesFoundException),
+        ]
+    return [(description, location.format(state=state), exists(location.format(state=state)), exception)
+            for description, location, exists, exception in inputs]
+
+def sanityChecks(state: str, args=()):
+    for description, location, exists, exception in getInputs(state, args):
+        if not exists:
+            logging.warning(f"{description} not found for {state}")
+            raise exception()
+
+    if os.path.isfile(OUTPUT_IDX_LOCATION.format(state=state)):
+        logging.warning(f"Overwriting existing IDX file for {state}")
+
+    if os.path.isfile(OUTPUT_JSON_LOCATION.format(state=state)):
+        logging.warning(f"Overwriting existing JSON file for {state}")
+
+def planParser(state: str, args):
+    "Returns what the stateparser stage would do for the state, and why"
+    cached = os.path.isfile(MERGED_DF_INPUT.format(state=state))
+    mismatch = cached and getCachedApportionment(state) != getApportionment(args)
+    if '-update' in args:
+        if not cached:
+            return "run in full (nothing cached to update)"
+        if '-blocks' in args or mismatch:
+            return "run in full (block level builds aren't updated incrementally)"
+        if getGranularity(state) is not None:
+            return f"run in full (dissolved into {getGranularity(state)}s)"
+        return "update the VTDs changed since " + MERGED_DF_INPUT.format(state=state)
+    if '-use_cache' in args and mismatch:
+        return f"run (the cache was apportioned from {getCachedApportionment(state)}, not {getApportionment(args)})"
+    if '-use_cache' in args and cached:
+        return "reuse " + MERGED_DF_INPUT.format(state=state)
+    if '-use_cache' in args:
+        return "run (nothing cached)"
+    return "run"
+
+def planState(state: str, args, journal=None):
+    "Returns the lines of the build plan of a state, without loading any of its data"
+    lines = [f"{state}:"]
+    if journal is not None and '-parse' not in args and journal.completed(state, 'merged2output') is not None:
+        return lines + ["    already built in the run being resumed, skipped"]
+    missing = [(description, location) for description, location, exists, _ in getInputs(state, args) if not exists]
+    if not shapefileExists(CONGRESSIONAL_DISTRICTS_LOCATION):
+        missing.append(("Congressional district gis files", CONGRESSIONAL_DISTRICTS_LOCATION))
+    for description, location in missing:
+        lines.append(f"    missing input: {description} ({location})")
+
+    parsed = journal is not None and journal.completed(state, 'stateparser') is not None
+    lines.append(f"    stateparser: {'reuse what the run being resumed parsed' if parsed else planParser(state, args)}")
+    if '-parse' in args:
+        lines.append("    merged2output: skipped (-parse)")
+    else:
+        options = ['-all'] if '-all' in args else \
+            sorted(arg for arg in args if arg not in PARSER_ARGUMENTS | CLI_ARGUMENTS) or ['(default outputs)']
+        lines.append(f"    merged2output: run with {' '.join(options)}")
+        neighbors = NEIGHBORS_CACHE.format(state=state)
+        lines.append("    neighbors: " + ("reuse " + neighbors + " for unchanged VTDs"
+                                          if os.path.isfile(neighbors) else "compute"))
+    if missing:
+        lines.append("    the build would stop at the first missing input")
+    return lines
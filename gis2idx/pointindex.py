@@ -0,0 +1,175 @@
+# Usage: python gis2idx/pointindex.py <state.lookup> <lng> <lat> [state.json]
+#
+# The .lookup artifact: a grid bucket index of precinct bounding boxes, so resolving a click
+# to a precinct only tests the few polygons whose box holds the point, not every precinct.
+#
+# Layout (big endian):
+#     LOOKUP_HEADER_F
+#     f4[N][4]              bounding box of every node (minx, miny, maxx, maxy), rounded outwards
+#     u4[cols * rows + 1]   offset of every cell's bucket (cells row major, from the bottom left)
+#     u4[]                  node ids in each bucket
+#
+# Boxes are padded by the padding in the header, so points on the edge of a simplified
+# outline (which can stray a little outside the full geometry) still find their precinct.
+# A node's box can span several cells, it is listed in every one of them.
+
+import json
+import logging
+import math
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from util import (
+    # Constants
+    LOOKUP_MAGIC_NUMBER,
+)
+
+LOOKUP_HEADER_F = '>IIBBIHHddddd'   # 56 bytes: magic, CRC32 of the rest, stCode, numNodes, cols, rows,
+                                    # grid minx, miny, maxx, maxy, padding
+NODES_PER_CELL = 2                  # about this many nodes per cell, for the grid size
+MAX_GRID_SIDE = 4096
+F4 = np.dtype('>f4')
+U4 = np.dtype('>u4')
+
+def gridShape(bounds, numNodes: int):
+    "Returns (cols, rows) so the cells are about square and hold about NODES_PER_CELL nodes"
+    minx, miny, maxx, maxy = bounds
+    width, height = max(maxx - minx, 1e-9), max(maxy - miny, 1e-9)
+    cells = max(numNodes / NODES_PER_CELL, 1)
+    cols = int(min(max(round(math.sqrt(cells * width / height)), 1), MAX_GRID_SIDE))
+    rows = int(min(max(round(cells / cols), 1), MAX_GRID_SIDE))
+    return cols, rows
+
+def encode(stCode: str, boxes, padding: float = 0.0):
+    "Returns the .lookup bytes for the (N, 4) array of node bounding boxes"
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    boxes = boxes + np.array([-padding, -padding, padding, padding])
+    numNodes = len(boxes)
+
+    if numNodes:
+        bounds = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+    else:
+        bounds = (0.0, 0.0, 0.0, 0.0)
+    cols, rows = gridShape(bounds, numNodes)
+    cellWidth = max(bounds[2] - bounds[0], 1e-9) / cols
+    cellHeight = max(bounds[3] - bounds[1], 1e-9) / rows
+
+    # The range of cells every box covers
+    firstCol = np.clip(((boxes[:, 0] - bounds[0]) / cellWidth).astype(np.int64), 0, cols - 1)
+    lastCol = np.clip(((boxes[:, 2] - bounds[0]) / cellWidth).astype(np.int64), 0, cols - 1)
+    firstRow = np.clip(((boxes[:, 1] - bounds[1]) / cellHeight).astype(np.int64), 0, rows - 1)
+    lastRow = np.clip(((boxes[:, 3] - bounds[1]) / cellHeight).astype(np.int64), 0, rows - 1)
+
+    cells, nodes = [], []
+    for node in range(numNodes):
+        colRange = np.arange(firstCol[node], lastCol[node] + 1)
+        rowRange = np.arange(firstRow[node], lastRow[node] + 1)
+        covered = (rowRange[:, None] * cols + colRange[None, :]).ravel()
+        cells.append(covered)
+        nodes.append(np.full(len(covered), node, dtype=np.int64))
+    cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+    nodes = np.concatenate(nodes) if nodes else np.zeros(0, dtype=np.int64)
+
+    # Bucket the node ids by cell, nodes in id order within a cell
+    order = np.lexsort((nodes, cells))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=cols * rows))])
+
+    # Round the boxes outwards, so the f4 box always holds the f8 one
+    lower = boxes[:, :2].astype(np.float32)
+    lower = np.where(lower > boxes[:, :2], np.nextafter(lower, np.float32(-np.inf)), lower)
+    upper = boxes[:, 2:].astype(np.float32)
+    upper = np.where(upper < boxes[:, 2:], np.nextafter(upper, np.float32(np.inf)), upper)
+    packedBoxes = np.hstack([lower, upper]).astype(F4)
+
+    body = packedBoxes.tobytes() + offsets.astype(U4).tobytes() + nodes[order].astype(U4).tobytes()
+    header = struct.pack(LOOKUP_HEADER_F, LOOKUP_MAGIC_NUMBER, 0, ord(stCode[0]), ord(stCode[1]),
+                         numNodes, cols, rows, *bounds, padding)
+    checkSum = zlib.crc32(header[8:] + body)
+    return header[:4] + struct.pack('>I', checkSum) + header[8:] + body
+
+class PointIndex(object):
+    "Reads a .lookup, answering which nodes might hold a point"
+
+    def __init__(self, path: str = None, buffer: bytes = None):
+        if buffer is None:
+            with open(path, 'rb') as handle:
+                buffer = handle.read()
+        (magic, checkSum, stCode0, stCode1, self.numNodes, self.cols, self.rows,
+            minx, miny, maxx, maxy, self.padding) = struct.unpack_from(LOOKUP_HEADER_F, buffer)
+        if magic != LOOKUP_MAGIC_NUMBER:
+            raise ValueError(f"Not a .lookup file (magic number {hex(magic)})")
+        if zlib.crc32(buffer[8:]) != checkSum:
+            raise ValueError("The .lookup checksum doesn't match its contents")
+
+        self.stCode = chr(stCode0) + chr(stCode1)
+        self.bounds = (minx, miny, maxx, maxy)
+        self._cellWidth = max(maxx - minx, 1e-9) / self.cols
+        self._cellHeight = max(maxy - miny, 1e-9) / self.rows
+
+        position = struct.calcsize(LOOKUP_HEADER_F)
+        self.boxes = np.frombuffer(buffer, dtype=F4, count=4 * self.numNodes, offset=position) \
+            .reshape(self.numNodes, 4).astype(np.float64)
+        position += 16 * self.numNodes
+        numCells = self.cols * self.rows
+        self.offsets = np.frombuffer(buffer, dtype=U4, count=numCells + 1, offset=position).astype(np.int64)
+        position += 4 * (numCells + 1)
+        self.nodes = np.frombuffer(buffer, dtype=U4, offset=position).astype(np.int64)
+
+    def candidates(self, x: float, y: float):
+        "Returns the ids of the nodes whose (padded) bounding box holds the point (lng, lat)"
+        minx, miny, maxx, maxy = self.bounds
+        if not (minx <= x <= maxx and miny <= y <= maxy):
+            return []
+        col = min(int((x - minx) / self._cellWidth), self.cols - 1)
+        row = min(int((y - miny) / self._cellHeight), self.rows - 1)
+        cell = row * self.cols + col
+        bucket = self.nodes[self.offsets[cell]:self.offsets[cell + 1]]
+        boxes = self.boxes[bucket]
+        inside = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+        return bucket[inside].tolist()
+
+    def locate(self, x: float, y: float, rings):
+        """
+            Returns the id of the node holding the point, testing the candidates against rings
+            (node id -> list of (x, y) vertices, full or simplified), or None
+        """
+        for node in self.candidates(x, y):
+            if containsPoint(rings[node], x, y):
+                return node
+        return None
+
+def containsPoint(ring, x: float, y: float):
+    "Even-odd ray casting test of a point against a ring of (x, y) vertices"
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def jsonRings(path: str):
+    "Returns node id -> list of (lng, lat) vertices from a state's .json"
+    with open(path) as handle:
+        precincts = json.load(handle)['precincts']
+    return dict((p['id'], [(v['lng'], v['lat']) for v in p['vertices']]) for p in precincts)
+
+def main(argv):
+    if len(argv) not in (3, 4):
+        raise ValueError("Usage: pointindex.py <state.lookup> <lng> <lat> [state.json]")
+
+    index = PointIndex(argv[0])
+    x, y = float(argv[1]), float(argv[2])
+    if len(argv) == 4:
+        print(index.locate(x, y, jsonRings(argv[3])))
+    else:
+        print(index.candidates(x, y))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
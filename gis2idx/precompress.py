@@ -0,0 +1,117 @@
+"""
+Pre-compressed variants of the output artifacts, so the CDN can serve them as they are
+instead of compressing on every cache miss, and a manifest of sizes and content hashes
+for ETags and cache busting.
+
+Every artifact handed to a Precompressor is compressed on a thread pool (zlib, brotli and
+zstd release the GIL while they work) while merged2output keeps encoding the others.
+brotli and zstandard are in requirements.txt; where they aren't installed, only gzip is written
+(with a warning per missing encoder).
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from util import (
+    # Functions
+    atomicOpen
+)
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+ZSTD_LEVEL = 19
+MAX_WORKERS = 4
+
+def gzipCompress(data: bytes):
+    # mtime=0 keeps the output (and its hash) the same across builds
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+def brotliCompress(data: bytes):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+def zstdCompress(data: bytes):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+def getEncodings():
+    "Returns {file extension: compress function} for every encoding that can be written here"
+    encodings = {'.gz': gzipCompress}
+    if brotli is not None:
+        encodings['.br'] = brotliCompress
+    else:
+        logging.warning("brotli isn't installed, skipping the .br variants")
+    if zstandard is not None:
+        encodings['.zst'] = zstdCompress
+    else:
+        logging.warning("zstandard isn't installed, skipping the .zst variants")
+    return encodings
+
+def describe(path: str, data: bytes):
+    "Returns the manifest entry of a file"
+    return {
+        "path": os.path.basename(path),
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest()
+    }
+
+def compressFile(path: str, encodings):
+    "Writes every compressed variant of path next to it, returns its manifest entry"
+    with open(path, 'rb') as handle:
+        data = handle.read()
+
+    entry = describe(path, data)
+    entry["variants"] = {}
+    for extension, compress in encodings.items():
+        compressed = compress(data)
+        with atomicOpen(path + extension, 'wb') as handle:
+            handle.write(compressed)
+        entry["variants"][extension[1:]] = describe(path + extension, compressed)
+    return entry
+
+class Precompressor(object):
+    "Compresses artifacts in the background as they are submitted"
+
+    def __init__(self, maxWorkers: int = MAX_WORKERS):
+        self.encodings = getEncodings()
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.jobs = []
+        self.submitted = []
+
+    def submit(self, path: str):
+        "Starts compressing a finished artifact"
+        self.submitted.append(path)
+        self.jobs.append(self.pool.submit(compressFile, path, self.encodings))
+
+    def finish(self, manifestPath: str, others=()):
+        """
+            Waits for every artifact, writes the manifest (which also lists others, artifacts
+            served as they are) and returns the paths of the variants and the manifest
+        """
+        entries = [job.result() for job in self.jobs]
+        self.pool.shutdown()
+        for path in others:
+            with open(path, 'rb') as handle:
+                entries.append(describe(path, handle.read()))
+
+        manifest = {"artifacts": entries}
+        with atomicOpen(manifestPath, 'w') as handle:
+            written = handle.write(json.dumps(manifest, indent=4))
+        logging.info(f"Finished writing {written} bytes to {manifestPath}")
+
+        directory = os.path.dirname(manifestPath)
+        paths = [os.path.join(directory, variant["path"])
+                 for entry in entries for variant in entry.get("variants", {}).values()]
+        return paths + [manifestPath]
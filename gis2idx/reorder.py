@@ -0,0 +1,116 @@
+"""
+Node renumbering for the output graph.
+
+The merged dataframe comes out of mergeTables in whatever order the merges left
+it in, which means a precinct's neighbors are scattered across the node table.
+These orderings renumber the nodes so that precincts close to each other get
+close node ids, before anything is encoded.
+"""
+
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+HILBERT_BITS = 16 # Resolution of the hilbert curve on each axis
+
+ORDERINGS = {
+    '-hilbert': 'hilbert',
+    '-rcm': 'rcm',
+}
+
+def hilbertIndex(x, y, bits: int = HILBERT_BITS):
+    "Vectorized position along a hilbert curve for integer grid coordinates in [0, 2**bits)"
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = 1 << (bits - 1)
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant so the curve stays continuous
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+def hilbertOrder(df):
+    "Returns the node order that follows a hilbert curve through the precinct centroids"
+    centroids = df['geometry'].centroid
+    xs = np.array(centroids.x, dtype=float)
+    ys = np.array(centroids.y, dtype=float)
+
+    # Scale the centroids onto the curve's grid
+    side = (1 << HILBERT_BITS) - 1
+    span = max(xs.max() - xs.min(), ys.max() - ys.min()) or 1.0
+    gridX = ((xs - xs.min()) / span * side).astype(np.int64)
+    gridY = ((ys - ys.min()) / span * side).astype(np.int64)
+
+    return np.argsort(hilbertIndex(gridX, gridY), kind='stable').tolist()
+
+def adjacencyMatrix(neighborsLists):
+    "Returns the sparse adjacency matrix of a list of neighbor lists"
+    numNodes = len(neighborsLists)
+    rows = np.repeat(np.arange(numNodes), [len(n) for n in neighborsLists])
+    cols = np.array([j for n in neighborsLists for j in n], dtype=np.int64)
+    data = np.ones(len(cols), dtype=np.int8)
+    return csr_matrix((data, (rows, cols)), shape=(numNodes, numNodes))
+
+def rcmOrder(neighborsLists):
+    "Returns the reverse Cuthill-McKee order of the adjacency graph, which keeps neighbors' ids close"
+    return reverse_cuthill_mckee(adjacencyMatrix(neighborsLists), symmetric_mode=True).tolist()
+
+def getOrder(method: str, df, neighborsLists):
+    "Returns the new node order, a list of old node ids in their new position"
+    if method == 'hilbert':
+        return hilbertOrder(df)
+    if method == 'rcm':
+        return rcmOrder(neighborsLists)
+    raise ValueError(f"Unknown ordering: {method}")
+
+def applyOrder(df, neighborsLists, order):
+    "Renumbers the dataframe rows and the neighbor lists to follow the given order"
+    newIds = [0] * len(order)
+    for newId, oldId in enumerate(order):
+        newIds[oldId] = newId
+
+    df = df.iloc[order].reset_index(drop=True)
+    if neighborsLists is not None:
+        neighborsLists = [sorted(newIds[j] for j in neighborsLists[oldId]) for oldId in order]
+    return df, neighborsLists
+
+def stableOrder(geoids, registry):
+    """
+        Returns the node order that keeps every precinct in the registry (a list of GEOIDs by
+        node id, from the last build) on its old node id. Ids stay dense: the ids freed by removed
+        precincts go to the precincts whose old id is past the end of the new graph, then to new ones.
+    """
+    numNodes = len(geoids)
+    previousIds = {geoid: nodeId for nodeId, geoid in enumerate(registry)}
+
+    order = [None] * numNodes
+    displaced = []
+    added = []
+    for row, geoid in enumerate(geoids):
+        nodeId = previousIds.get(geoid)
+        if nodeId is None:
+            added.append(row)
+        elif nodeId >= numNodes:
+            displaced.append((nodeId, row))
+        else:
+            order[nodeId] = row
+
+    freeIds = [nodeId for nodeId in range(numNodes) if order[nodeId] is None]
+    rows = [row for _, row in sorted(displaced)] + added
+    for nodeId, row in zip(freeIds, rows):
+        order[nodeId] = row
+
+    logging.info(f"Kept {numNodes - len(rows)} node ids, moved {len(displaced)}, added {len(added)}, "
+                 f"removed {len(registry) - numNodes + len(added)}")
+    return order
@@ -2,26 +2,54 @@ import io
 import os
 import logging
 import sys
-import csv
+import json
 import geopandas as gpd
 import pandas as pd
 
 import pickle
 
 from typing import List
+from geoindex import GeometryIndex
+import blockapportion
+from attributes import getAttributes
+from votes import readVoteTables, matchVotes
 from util import (
     CACHE_LOCATION,
     INPUT_PREFIX,
     CACHE_LOCATION,
     STATEPARSER_CACHE_LOCATION,
-    STATEGRANULARITY_LOCATION,
+    VTD_LOCATION,
+    TRACTS_LOCATION,
+    VOTES_LOCATION,
+    DEMOGRAPHIC_LOCATION,
+    CONGRESSIONAL_DISTRICTS_LOCATION,
+    SCHEMA_LOCATION,
+    atomicOpen,
+    getCachedApportionment,
+    getGranularity,
+    getShapefileSource,
     parseState
 )
 
-VTD_LOCATION = INPUT_PREFIX + '{state}/vtd/'
-TRACTS_LOCATION = INPUT_PREFIX + '{state}/tracts/'
-VOTES_LOCATION = INPUT_PREFIX + '{state}/votes/'
-DEMOGRAPHIC_LOCATION = INPUT_PREFIX + '{state}/{state}.csv'
+DATAMERGER_LOCATION = 'gis2idx/datamerger'
+
+# The apportioned columns, and the demographic columns they're spread from (see attributes.py)
+POPULATION_COLUMNS = [attribute.name for attribute in getAttributes('demographics')]
+POPULATION_SOURCES = [attribute.column for attribute in getAttributes('demographics')]
+VOTE_COLUMNS = [attribute.name for attribute in getAttributes('votes')]
+
+# The dtypes the cached merged frame is stored with, see State.enforceSchema
+MERGED_SCHEMA = dict([
+    ('name', 'category'),
+    ('countyfp', 'category'),
+    ('district', 'uint8'),
+    ('land', 'uint64'),
+    ('water', 'uint64'),
+] + [(column, 'float64') for column in POPULATION_COLUMNS] + [(column, 'uint32') for column in VOTE_COLUMNS])
+KEPT_COLUMNS = ['GEOID', 'geometry']    # Kept as they are
+
+# Set once the datamerger Django project is configured in this process
+DJANGO_READY = False
 
 class State(object):
 
@@ -31,13 +59,18 @@ class State(object):
 
         self._state = state
         self._callStack: List[str] = []
+        self._votes_df = None
+        # Block level builds never load the tracts or their demographics
+        self._tract_df = None
+        self._demographic_df = None
+        self._apportionment = 'tracts'
 
         if loadFromCache:
             self.load()
        
     def loadVtd(self):
         "Load the VTD data into this state"
-        df = gpd.read_file(VTD_LOCATION.format(state=self._state))
+        df = gpd.read_file(getShapefileSource(VTD_LOCATION.format(state=self._state)))
         for col2del in [
             'STATEFP10', # 2010 Census state Federal Information Processing Standards (FIPS) code
             'NAME10', # 2010 Census voting district name (numerical)
@@ -65,7 +98,7 @@ class State(object):
         
     def loadTracts(self):
         "Load Census Tracts into this state"
-        df = gpd.read_file(TRACTS_LOCATION.format(state=self._state))
+        df = gpd.read_file(getShapefileSource(TRACTS_LOCATION.format(state=self._state)))
 
         for col2del in [
             'STATEFP', # 2010 Census state Federal Information Processing Standards (FIPS) code
@@ -88,22 +121,9 @@ class State(object):
         "Load the CSV of demographics"
         df = pd.read_csv(DEMOGRAPHIC_LOCATION.format(state=self._state))
         
-        # Add the relavent columns to the main dataframe (df)
-        """
-        *******      Key to P00300X labels:      ******
-        P003001 => Total
-        P003002 => White alone
-        P003003 => Black or African American alone
-        P003004 => American Indian and Alaska Native alone
-        P003005 => Asian alone
-        P003006 => Native Hawaiian and Other Pacific Islander alone
-        P003007 => Some Other Race alone
-        P003008 => Two or More Races
-        """
-        colsToAdd = ['GEOID', 'P003001', 'P003002', 'P003003', 'P003004',
-                    'P003005','P003006', 'P003007', 'P003008']
-        readableNames = ['GEOID', 'TotalPop', 'WhitePop', 'BlackPop', 'NativeAPop',
-                        'AsianPop', 'PacIsPop', 'OtherPop', 'MultiPop']
+        # Add the relavent columns to the main dataframe (df), the P00300X labels are keyed in attributes.py
+        colsToAdd = ['GEOID'] + [attribute.sources[0] for attribute in getAttributes('demographics')]
+        readableNames = ['GEOID'] + POPULATION_SOURCES
 
         df = df[colsToAdd]
 
@@ -124,8 +144,12 @@ class State(object):
         self._demographic_df = df
 
     def loadVotes(self):
-        "Load the voter data into this state"
-        pass
+        "Load the election results and match their precincts to the VTDs, if the state has any"
+        votes = readVoteTables(VOTES_LOCATION.format(state=self._state))
+        if votes is None:
+            logging.warning(f"No vote CSVs found for {self._state}, leaving out the vote columns")
+            return
+        self._votes_df = matchVotes(votes, self._vtd_df)
 
     def dropWater(self):
         "Drop all rows where it's a river"
@@ -143,6 +167,7 @@ class State(object):
     def dissolveGranularity(self, level):
         "Dissolve into counties, cities, etc"
         if level == 'county':
+            statefp = self._demographic_df['GEOID'].iloc[0][:2]
             geometries = gpd.GeoDataFrame(self._demographic_df).dissolve('countyfp')
             self._demographic_df = self._demographic_df.groupby('countyfp').agg(sum)
             self._demographic_df['geometry'] = geometries['geometry']
@@ -150,53 +175,165 @@ class State(object):
             self._demographic_df = self._demographic_df.reset_index()
             self._demographic_df['name'] = 'county '
             self._demographic_df['name'] += self._demographic_df['countyfp']
+            self._demographic_df['GEOID'] = statefp + self._demographic_df['countyfp'] # County GEOID
         elif level is not None:
             raise ValueError("Unknown level")
 
 
-    def mergeTables(self, state):
-        "Use PostGIS to merge all datasets into one df"
+    def mergeTables(self, state, blocks: bool = False):
+        """
+            Use PostGIS to merge all datasets into one df. With blocks, the population comes from
+            census blocks (see blockapportion.py) instead of the tracts
+        """
         # merge demographics + tracts
         self.save()
         abs_path = os.path.abspath(STATEPARSER_CACHE_LOCATION + self._state + '.state.pk')
         output_path = os.path.abspath(STATEPARSER_CACHE_LOCATION + self._state + '.demographics.pk')
         district_output_path = os.path.abspath(STATEPARSER_CACHE_LOCATION + self._state + '.districts.pk')
-        district_shapes = os.path.abspath(INPUT_PREFIX + "116_congressional_districts")
-        os.system(f"cd gis2idx/datamerger && python3.7 manage.py parse_census_df \"{abs_path}\" \"{output_path}\"")
-        os.system(f"cd gis2idx/datamerger && python3.7 manage.py merge_districts_df \"{abs_path}\" \"{district_output_path}\" {district_shapes}")
+        district_shapes = getShapefileSource(os.path.abspath(CONGRESSIONAL_DISTRICTS_LOCATION))
+        if blocks:
+            self._apportionment = 'blocks'
+            census_df = blockapportion.apportion(self._state, self._vtd_df, POPULATION_COLUMNS)
+        else:
+            runManagementCommand('parse_census_df', abs_path, output_path)
+        runManagementCommand('merge_districts_df', abs_path, district_output_path, district_shapes)
         
-        with io.open(output_path, 'rb') as handle:
-            census_df = pickle.load(handle)
+        if not blocks:
+            with io.open(output_path, 'rb') as handle:
+                census_df = pickle.load(handle)
     
         with io.open(district_output_path, 'rb') as handle:
             district_df = pickle.load(handle)
 
+        self.finishMerge(census_df, district_df)
+
+    def finishMerge(self, census_df, district_df):
+        "Join the apportioned demographics and the districts onto the VTDs, then cache the result"
+        self.joinTables(census_df, district_df)
+
+        # Check if we need to dissolve the granularity
+        level = getGranularity(self._state)
+        if level is not None:
+            self.dissolveGranularity(level)
+
+        self.dropUnusedColumns()
+        self.enforceSchema()
+        self.save()
+        self.saveSchema()
+
+    def joinTables(self, census_df, district_df):
+        "Join the apportioned demographics and the districts onto the VTDs, then clean up the result"
         self._demographic_df = pd.merge(census_df, self._vtd_df, right_on='GEOID', left_on='geoid', how='left')
         self._demographic_df = pd.merge(district_df, self._demographic_df, right_on='GEOID', left_on='geoid', how='left')
+        if self._votes_df is not None:
+            self._demographic_df = pd.merge(self._demographic_df, self._votes_df, on='GEOID', how='left')
+            self._demographic_df[VOTE_COLUMNS] = self._demographic_df[VOTE_COLUMNS].fillna(0)
         self._demographic_df = gpd.GeoDataFrame(self._demographic_df)
 
         # Drop multi-polygons here
         self.dropWater()
         self.dropMultiPolygons()
-        
-        # Check if we need to dissolve the granularity
-        stateKeys = csv.reader(open(STATEGRANULARITY_LOCATION))
-        for row in stateKeys:
-            if state == row[0]:
-                self.dissolveGranularity(row[1]) #row[1] = dissolvePattern
 
+    def dropUnusedColumns(self):
         for column in [
-            'center_y', 'center_x', 'vtdi', 'vtd', 'geoid_x', 'GEOID', 'geoid_y'
+            'center_y', 'center_x', 'vtdi', 'vtd', 'geoid_x', 'geoid_y'
         ]:
             if column in self._demographic_df.columns:
                 del self._demographic_df[column]
-        
-        self.save()
+
+    def enforceSchema(self):
+        """
+            Cast the merged frame to MERGED_SCHEMA and drop every column no later stage reads.
+            Populations stay fractional (they're apportioned), the writers truncate them once
+            they're summed into the packed fields
+        """
+        columns = [column for column in list(MERGED_SCHEMA) + KEPT_COLUMNS if column in self._demographic_df.columns]
+        df = self._demographic_df[columns].copy()
+        for column, dtype in MERGED_SCHEMA.items():
+            if column not in df.columns:
+                continue
+            if dtype == 'category':
+                df[column] = df[column].astype(str).astype('category')
+            else:
+                df[column] = df[column].fillna(0).astype(dtype)
+        self._demographic_df = gpd.GeoDataFrame(df)
+
+    def saveSchema(self):
+        "Record the dtypes of the cached merged frame next to it, and what it was apportioned from"
+        schema = dict((column, str(dtype)) for column, dtype in self._demographic_df.dtypes.items())
+        with atomicOpen(SCHEMA_LOCATION.format(state=self._state), 'w') as handle:
+            handle.write(json.dumps({'columns': schema, 'rows': len(self._demographic_df),
+                                     'apportionment': self._apportionment}, indent=4))
+
+    def changedGeoids(self, previous_vtd_df):
+        "Returns the GEOIDs of VTDs that were added, removed or changed since previous_vtd_df was loaded"
+        def fingerprints(df):
+            return dict(zip(df['GEOID'], zip(df['geometry'].map(lambda g: g.wkb), df['land'], df['water'])))
+
+        before, after = fingerprints(previous_vtd_df), fingerprints(self._vtd_df)
+        return set(
+            geoid for geoid in set(before) | set(after) if before.get(geoid) != after.get(geoid)
+        )
+
+    def apportion(self, geoids):
+        """
+            Spread the tract populations over the given VTDs by overlapping area.
+            Mirrors parse_census_df (including its rounding), so the result matches a full rebuild
+        """
+        tracts = pd.merge(self._tract_df, self._demographic_df, on="GEOID", how="left")
+        tractGeometries = tracts['geometry'].tolist()
+        index = GeometryIndex(tractGeometries)
+
+        table = {column: [] for column in ['geoid'] + POPULATION_COLUMNS}
+        for _, vtd in self._vtd_df[self._vtd_df['GEOID'].isin(geoids)].iterrows():
+            table['geoid'].append(vtd['GEOID'])
+            totals = dict((column, 0) for column in POPULATION_COLUMNS)
+            for position in index.query(vtd['geometry']):
+                tract = tractGeometries[position]
+                overlap = -vtd['geometry'].union(tract).area + vtd['geometry'].area + tract.area
+                partition = (overlap / tract.area)
+                for column, source in zip(POPULATION_COLUMNS, POPULATION_SOURCES):
+                    totals[column] += partition * tracts[source].iloc[position]
+            for column in POPULATION_COLUMNS:
+                table[column].append(totals[column] + round(totals[column]))
+
+        return pd.DataFrame(data=table)
+
+    def assignDistricts(self, geoids):
+        """
+            Find the congressional district each of the given VTDs overlaps most, like merge_districts_df.
+            Also returns the sort key of every VTD's row in merge_districts_df's output (first district
+            whose bounding box it overlaps, then VTD order, as its queries are ordered by primary key).
+            VTDs that overlap no district's bounding box have no key, merge_districts_df leaves them out
+        """
+        districts = gpd.read_file(getShapefileSource(CONGRESSIONAL_DISTRICTS_LOCATION))
+        districtGeometries = districts['geometry'].tolist()
+        index = GeometryIndex(districtGeometries)
+
+        table = {'geoid': [], 'district': []}
+        rowOrder = {}
+        for position, (_, vtd) in enumerate(self._vtd_df.iterrows()):
+            candidates = index.query(vtd['geometry'])
+            if candidates:
+                rowOrder[vtd['GEOID']] = (candidates[0], position)
+            if vtd['GEOID'] not in geoids:
+                continue
+
+            best, bestArea = None, None
+            for candidate in candidates:
+                intersect = vtd['geometry'].intersection(districtGeometries[candidate]).area
+                if bestArea is None or intersect > bestArea:
+                    best, bestArea = int(districts['CD116FP'].iloc[candidate]), intersect
+            if best is not None:
+                table['geoid'].append(vtd['GEOID'])
+                table['district'].append(best)
+
+        return pd.DataFrame(data=table), rowOrder
 
     def save(self):
         "Cache to a pickle"
         initializeCache()
-        with io.open(STATEPARSER_CACHE_LOCATION + self._state + '.state.pk', 'wb') as handle:
+        with atomicOpen(STATEPARSER_CACHE_LOCATION + self._state + '.state.pk', 'wb') as handle:
             pickle.dump(self._demographic_df, handle)
             pickle.dump(self._vtd_df, handle)
             pickle.dump(self._tract_df, handle)
@@ -221,13 +358,85 @@ def initializeCache():
         logging.info(f"Creating {STATEPARSER_CACHE_LOCATION}")
         os.mkdir(STATEPARSER_CACHE_LOCATION)
 
-def main(state):
-    stateHandle = State(state)
+def setupDjango():
+    """
+        Configure the datamerger project inside this process, so management commands can run
+        without paying for a fresh interpreter, Django setup and database connection each time
+    """
+    global DJANGO_READY
+    if DJANGO_READY:
+        return
+    sys.path.insert(0, os.path.abspath(DATAMERGER_LOCATION))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'datamerger.settings')
+    import django
+    django.setup()
+    DJANGO_READY = True
+
+def runManagementCommand(command: str, *args):
+    "Run a datamerger management command, in process if Django has been set up, otherwise through manage.py"
+    if DJANGO_READY:
+        from django.core.management import call_command
+        call_command(command, *args)
+    else:
+        quoted = ' '.join(f'"{arg}"' for arg in args)
+        os.system(f"cd {DATAMERGER_LOCATION} && python3.7 manage.py {command} {quoted}")
+
+def update(state, geoids=None, blocks: bool = False):
+    """
+        Patch the cached merged dataframe for a handful of corrected VTDs, instead of rerunning the
+        apportionment for the whole state. geoids defaults to every VTD whose geometry or area changed
+        since the cache was built.
+    """
+    if (not os.path.isfile(STATEPARSER_CACHE_LOCATION + state + '.state.pk') or getGranularity(state) is not None
+            or blocks or getCachedApportionment(state) != 'tracts'):
+        # Dissolved states mix every VTD of a county into one node, rebuild them in full
+        # (as are block level builds, the incremental apportionment works from tracts)
+        logging.info(f"Can't update {state} incrementally, running the full stateparser")
+        return main(state, blocks)
+
+    stateHandle = State(state, loadFromCache=True)
+    merged_df, previous_vtd_df = stateHandle._demographic_df, stateHandle._vtd_df
+    if 'GEOID' not in merged_df.columns:
+        logging.info(f"The cached artifact for {state} predates GEOIDs, running the full stateparser")
+        return main(state)
     stateHandle.loadVtd()
     stateHandle.loadTracts()
     stateHandle.loadDemographics()
     stateHandle.loadVotes()
-    stateHandle.mergeTables(state)
+
+    if geoids is None:
+        geoids = stateHandle.changedGeoids(previous_vtd_df)
+    geoids = set(geoids)
+    logging.info(f"Updating {len(geoids)} VTDs of {state}")
+
+    district_df, rowOrder = stateHandle.assignDistricts(geoids)
+    stateHandle.joinTables(stateHandle.apportion(geoids), district_df)
+    stateHandle.dropUnusedColumns()
+
+    # Swap the changed rows in, in the order a full rebuild would produce them
+    patched = pd.concat([merged_df[~merged_df['GEOID'].isin(geoids)], stateHandle._demographic_df], sort=False)
+    orphaned = ~patched['GEOID'].isin(rowOrder)
+    if orphaned.any():
+        # Removed VTDs that weren't listed in geoids, or that no district overlaps anymore
+        logging.warning(f"Dropping {int(orphaned.sum())} cached VTDs of {state} that are gone or in no district: "
+                        f"{', '.join(patched['GEOID'][orphaned].tolist())}")
+        patched = patched[~orphaned]
+    patchedGeoids = patched['GEOID'].tolist()
+    patched = patched.iloc[sorted(range(len(patched)), key=lambda row: rowOrder[patchedGeoids[row]])]
+    patched = patched.reset_index(drop=True)
+    stateHandle._demographic_df = gpd.GeoDataFrame(patched[merged_df.columns])
+    stateHandle.enforceSchema()
+    stateHandle.save()
+    stateHandle.saveSchema()
+
+def main(state, blocks: bool = False):
+    stateHandle = State(state)
+    stateHandle.loadVtd()
+    if not blocks:
+        stateHandle.loadTracts()
+        stateHandle.loadDemographics()
+    stateHandle.loadVotes()
+    stateHandle.mergeTables(state, blocks)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
 """
 A set of utilities useful for this project.
 """
+import csv
+import json
 import os
+import re
+import shutil
+import socket
 import sys
+from contextlib import contextmanager
 from typing import AnyStr, List
 
 from exceptions import (
@@ -19,11 +25,42 @@ OUTPUT_IDX_LOCATION = OUTPUT_PREFIX + '{state}/{state}.idx'
 OUTPUT_JSON_LOCATION = OUTPUT_PREFIX + '{state}/{state}.json'
 CACHE_LOCATION = '.gis2idx_cache/'
 STATEPARSER_CACHE_LOCATION = CACHE_LOCATION + 'stateparser/'
+DAEMON_SOCKET_LOCATION = CACHE_LOCATION + 'daemon.sock'
+RUN_JOURNAL_LOCATION = CACHE_LOCATION + 'journal.jsonl'
 STATEKEY_LOCATION = INPUT_PREFIX + 'stateKeys.csv'
 STATEGRANULARITY_LOCATION = INPUT_PREFIX + 'stateGranularities.csv'
+
+# Inputs of the stateparser, and the artifacts it caches
+VTD_LOCATION = INPUT_PREFIX + '{state}/vtd/'
+TRACTS_LOCATION = INPUT_PREFIX + '{state}/tracts/'
+VOTES_LOCATION = INPUT_PREFIX + '{state}/votes/'
+DEMOGRAPHIC_LOCATION = INPUT_PREFIX + '{state}/{state}.csv'
+BLOCKS_LOCATION = INPUT_PREFIX + '{state}/blocks/'
+BLOCK_DEMOGRAPHIC_LOCATION = INPUT_PREFIX + '{state}/{state}.blocks.csv'
+CONGRESSIONAL_DISTRICTS_LOCATION = INPUT_PREFIX + '116_congressional_districts'
+MERGED_DF_INPUT = STATEPARSER_CACHE_LOCATION + '{state}.state.pk'
+NEIGHBORS_CACHE = STATEPARSER_CACHE_LOCATION + '{state}.neighbors.pk'
+SCHEMA_LOCATION = STATEPARSER_CACHE_LOCATION + '{state}.schema.json'
+GEOMETRY_ARENA_LOCATION = STATEPARSER_CACHE_LOCATION + '{state}.arena'
+
+# The options merged2output takes (documented there), kept here so they're checked before it's imported
+OUTPUT_ARGUMENTS = set(['-idx', '-json', '-novert', '-readable', '-districts', '-shp', '-edges', '-v2', '-deflate',
+                        '-seed', '-patch', '-rook', '-connect', '-precompress', '-gpkg', '-fgb', '-lookup', '-dmap',
+                        '-hierarchy', '-hilbert', '-rcm', '-parallel'])
 MAGIC_NUMBER = 0xBEEFCAFE
+MAGIC_NUMBER_V2 = 0xBEEFCAF2
+PATCH_MAGIC_NUMBER = 0xBEEFD1FF
+EDGES_MAGIC_NUMBER = 0xBEEFED6E
+LOOKUP_MAGIC_NUMBER = 0xBEEF100C
+DMAP_MAGIC_NUMBER = 0xBEEFD157
+BUNDLE_MAGIC_NUMBER = 0xBEEFB0D1
+ARENA_MAGIC_NUMBER = 0xBEEFA4EA
 LOGMODE = 'a' #changing to 'w' will clear old logs
 
+# Outputs are written to '.{name}.{host}-{pid}.part' next to their final path, then renamed over it.
+# The host is there because output/ and the cache may be shared between hosts, where a pid means nothing
+TEMPORARY_PATTERN = re.compile(r'^\.(?P<name>.+)\.(?P<host>[^.]+)-(?P<pid>\d+)\.part(\.\w+)?$')
+
 def generateCSVTemplate(state_name: AnyStr):
     """
         Takes in a statename, and produces a CSV template for filling out demographic data.
@@ -37,6 +74,118 @@ def intToStrHex(integer: int, maxBytes: int = 4):
         raise ValueError(f"{integer} cannot be represented in {maxBytes} bytes")
     return "0" * ((2 * maxBytes) - len(str(strHex))) + str(strHex)
 
+def getShapefileSource(location: str):
+    """
+        Returns what to hand geopandas.read_file for a shapefile directory: the directory if it
+        was extracted, otherwise a zip:// path into the archive downloaded next to it (the
+        directory name + '.zip'), read in place without extracting it
+    """
+    archive = location.rstrip('/') + '.zip'
+    if not os.path.isdir(location) and os.path.isfile(archive):
+        return 'zip://' + os.path.abspath(archive)
+    return location
+
+def shapefileExists(location: str):
+    "Checks for a shapefile directory, or its zip archive"
+    return os.path.isdir(location) or os.path.isfile(location.rstrip('/') + '.zip')
+
+def getGranularity(state):
+    "Returns the level stateGranularities.csv dissolves the state into, if any"
+    stateKeys = csv.reader(open(STATEGRANULARITY_LOCATION))
+    for row in stateKeys:
+        if state == row[0]:
+            return row[1] #row[1] = dissolvePattern
+    return None
+
+def getCachedApportionment(state):
+    """
+        Returns what the cached merged frame of the state was apportioned from ('tracts' or 'blocks'),
+        as recorded in its schema. Caches that don't record it were apportioned from tracts
+    """
+    try:
+        with open(SCHEMA_LOCATION.format(state=state)) as handle:
+            return json.load(handle).get('apportionment', 'tracts')
+    except (OSError, ValueError):
+        return 'tracts'
+
+def hostName():
+    "Returns the name of this host, up to the first dot, as it appears in temporary paths"
+    return socket.gethostname().split('.')[0] or 'localhost'
+
+def temporaryPath(path: str, keepExtension: bool = False):
+    """
+        Returns the path an output is written to before it's renamed into place, unique to this
+        process on this host. keepExtension keeps the extension last, for writers that go by it (OGR drivers)
+    """
+    directory, name = os.path.split(path.rstrip('/'))
+    extension = ''
+    if keepExtension:
+        name, extension = os.path.splitext(name)
+    return os.path.join(directory, f".{name}.{hostName()}-{os.getpid()}.part{extension}")
+
+def replacePath(temporary: str, path: str):
+    "Moves a finished temporary file or directory over path"
+    path = path.rstrip('/')
+    if os.path.isdir(temporary) and os.path.isdir(path):
+        # Directories can't be renamed over, swap the old one out of the way first
+        stale = temporaryPath(path) + '.old'
+        os.rename(path, stale)
+        os.rename(temporary, path)
+        shutil.rmtree(stale)
+    else:
+        os.replace(temporary, path)
+
+@contextmanager
+def atomicOpen(path: str, mode: str = 'w'):
+    """
+        Opens a temporary file in place of path, and renames it over path once the block finishes
+        (flushed to disk), so a crash never leaves a half written output behind. The temporary
+        file is removed if the block raises
+    """
+    temporary = temporaryPath(path)
+    try:
+        with open(temporary, mode) as handle:
+            yield handle
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def processAlive(pid: int):
+    "Checks whether a process with this pid is running"
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def cleanTemporaryFiles(*directories):
+    """
+        Removes the temporary outputs (see temporaryPath) of processes of this host that are gone,
+        returns their paths. Those of other hosts are left alone, their pids can't be checked from here
+    """
+    host = hostName()
+    removed = []
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            for name in dirnames + filenames:
+                match = TEMPORARY_PATTERN.match(name.replace('.part.old', '.part'))
+                if match is None or match.group('host') != host or processAlive(int(match.group('pid'))):
+                    continue
+                path = os.path.join(root, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    dirnames.remove(name)
+                else:
+                    os.remove(path)
+                removed.append(path)
+    return removed
+
 def parseState():
     "Takes in a sys.argv command, extracts the state from it, and checks if it exists"
 
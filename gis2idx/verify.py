@@ -0,0 +1,233 @@
+# Usage: python gis2idx/verify.py [state ...] [Options]
+# Checks every .idx under output/ (or just the given states'), one process per file, and exits
+# with status 1 if any of them fails, so it can gate publishing the artifacts.
+# Checks:
+#   - the magic number, and the CRC32 in HEADER1_F (and every v2 section's)
+#   - the layout: v1 node offsets against calcNodeSize, v2 section sizes and CSR row offsets
+#   - the graph: neighbor ids in range, no self loops or repeated neighbors, symmetric adjacency
+#   - the population: every demographic field at most the node's total, a positive state total,
+#     and the totals of the state's .dmap (when there is one) matching the nodes'
+#   - the county index (v2 CNTY) in range of CTAB, and CTAB's node counts and totals matching the nodes'
+#   - the number of connected components (reported, a failure only with -connected)
+# Options:
+# -connected    -> fail files whose graph has more than one component
+# -serial       -> check the files one at a time, in this process
+
+import glob
+import logging
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from util import (
+    # Constants
+    OUTPUT_PREFIX,
+)
+
+from idxformat import (
+    HEADER1_F,
+    HEADER2_F,
+    NODE_RECORD_F,
+    NEIGHBOR_F,
+    NUM_DEMOGRAPHICS,
+    COUNTY_FIELDS,
+    IdxFile,
+    DistrictMap,
+    calcNodeSize
+)
+
+DMAP_LOCATION = OUTPUT_PREFIX + '{state}/{state}.dmap'
+
+def findIdxFiles(states=None):
+    "Returns the .idx files under output/, of every state or just the given ones"
+    if not states:
+        return sorted(glob.glob(OUTPUT_PREFIX + '*/*.idx'))
+    return sorted(path for state in states for path in glob.glob(OUTPUT_PREFIX + f'{state}/*.idx'))
+
+def checkLayout(idx, size: int):
+    "Returns the layout problems of an opened .idx whose file is size bytes"
+    problems = []
+    if idx.version == 1:
+        nodesStart = (struct.calcsize(HEADER1_F) + struct.calcsize(HEADER2_F)
+                      + struct.calcsize(NODE_RECORD_F) * idx.numNodes)
+        if nodesStart > size:
+            return [f"{idx.numNodes} node records don't fit in {size} bytes"]
+        numNeighbors, nodePos = idx.nodeRecords()
+        sizes = calcNodeSize(0) + struct.calcsize(NEIGHBOR_F) * numNeighbors
+        expected = np.concatenate([[0], np.cumsum(sizes)])
+        bad = np.nonzero(nodePos != expected[:-1])[0]
+        if len(bad):
+            problems.append(f"{len(bad)} node offsets disagree with calcNodeSize, the first at node {bad[0]}")
+        if nodesStart + expected[-1] != size:
+            problems.append(f"The nodes end at byte {nodesStart + expected[-1]}, the file at {size}")
+        return problems
+
+    expectedSizes = {b'TOPO': None, b'ATTR': 8 * idx.numNodes, b'DEMO': 4 * NUM_DEMOGRAPHICS * idx.numNodes}
+    for tag, expectedSize in expectedSizes.items():
+        if tag not in idx.sections:
+            problems.append(f"The {tag.decode()} section is missing")
+            continue
+        compression, offset, length, rawLength, crc = idx.sections[tag]
+        if offset + length > size:
+            problems.append(f"The {tag.decode()} section runs past the end of the file")
+        elif expectedSize is not None and rawLength != expectedSize:
+            problems.append(f"The {tag.decode()} section is {rawLength} bytes, expected {expectedSize}")
+    if problems:
+        return problems
+
+    offsets, neighbors = idx.topology()
+    if offsets[0] != 0 or np.any(np.diff(offsets) < 0) or offsets[-1] != len(neighbors):
+        problems.append("The TOPO row offsets aren't increasing from 0 to the number of neighbors")
+    return problems
+
+def checkGraph(offsets, neighbors, numNodes: int):
+    "Returns (problems, number of connected components) of a CSR graph"
+    problems = []
+    neighbors = neighbors.astype(np.int64)
+    rows = np.repeat(np.arange(numNodes, dtype=np.int64), np.diff(offsets))
+
+    outOfRange = neighbors >= numNodes
+    if outOfRange.any():
+        problems.append(f"{int(outOfRange.sum())} neighbor ids are out of range, the first of node {rows[outOfRange][0]}")
+        return problems, None
+
+    selfLoops = rows == neighbors
+    if selfLoops.any():
+        problems.append(f"{int(selfLoops.sum())} nodes list themselves as a neighbor, the first is {rows[selfLoops][0]}")
+
+    # Every edge as one integer, so symmetry is a sorted membership test
+    edges = rows * numNodes + neighbors
+    uniqueEdges = np.unique(edges)
+    if len(uniqueEdges) != len(edges):
+        problems.append(f"{len(edges) - len(uniqueEdges)} neighbors are listed twice")
+    if len(edges):
+        reverse = neighbors * numNodes + rows
+        positions = np.minimum(np.searchsorted(uniqueEdges, reverse), len(uniqueEdges) - 1)
+        asymmetric = uniqueEdges[positions] != reverse
+        if asymmetric.any():
+            first = np.nonzero(asymmetric)[0][0]
+            problems.append(f"{int(asymmetric.sum())} edges have no reverse edge, the first {rows[first]} -> {neighbors[first]}")
+
+    matrix = csr_matrix((np.ones(len(neighbors), dtype=np.int8), neighbors, offsets), shape=(numNodes, numNodes))
+    numComponents, _ = connected_components(matrix, directed=False)
+    return problems, numComponents
+
+def checkPopulation(demographics, districtMap=None):
+    "Returns the population problems of a (numNodes, 6) demographics array and the state's DistrictMap"
+    problems = []
+    demographics = np.asarray(demographics, dtype=np.int64)
+    overTotal = np.any(demographics[:, 1:] > demographics[:, :1], axis=1)
+    if overTotal.any():
+        problems.append(f"{int(overTotal.sum())} nodes have a demographic above their total population, "
+                        f"the first is {np.nonzero(overTotal)[0][0]}")
+    if len(demographics) and demographics[:, 0].sum() <= 0:
+        problems.append("The state has no population")
+
+    if districtMap is not None:
+        if districtMap.numNodes != len(demographics):
+            problems.append(f"The .dmap has {districtMap.numNodes} nodes, the .idx {len(demographics)}")
+        elif not np.array_equal(districtMap.totals[:, :NUM_DEMOGRAPHICS].astype(np.int64).sum(axis=0),
+                                demographics.sum(axis=0)):
+            problems.append("The .dmap district totals don't add up to the node demographics")
+    return problems
+
+def checkCounties(idx, demographics):
+    "Returns the problems of a v2 file's CNTY and CTAB sections"
+    if b'CNTY' not in idx.sections and b'CTAB' not in idx.sections:
+        return []
+    if b'CNTY' not in idx.sections or b'CTAB' not in idx.sections:
+        return ["CNTY and CTAB have to come together"]
+    if idx.sections[b'CNTY'][3] != 4 * idx.numNodes or idx.sections[b'CTAB'][3] % (4 * COUNTY_FIELDS):
+        return ["The CNTY or CTAB section has the wrong size"]
+
+    index, table = idx.counties()
+    index = index.astype(np.int64)
+    if len(index) and index.max() >= len(table):
+        return [f"{int((index >= len(table)).sum())} nodes point past the {len(table)} counties of CTAB"]
+    problems = []
+    if not np.array_equal(np.bincount(index, minlength=len(table)), table[:, 1].astype(np.int64)):
+        problems.append("The CTAB node counts don't match CNTY")
+    totals = np.zeros((len(table), NUM_DEMOGRAPHICS), dtype=np.int64)
+    np.add.at(totals, index, np.asarray(demographics, dtype=np.int64))
+    if not np.array_equal(totals, table[:, 2:].astype(np.int64)):
+        problems.append("The CTAB totals don't add up to the node demographics")
+    return problems
+
+def verifyIdx(path: str, connected: bool = False):
+    """
+        Returns (problems, summary) for the .idx at path: problems is a list of messages (empty if it
+        passed), summary a dict of its version, nodes, edges, components and population
+    """
+    summary = {}
+    size = os.path.getsize(path)
+    try:
+        idx = IdxFile(path)
+    except (ValueError, struct.error) as error:
+        return [str(error) if isinstance(error, ValueError) else f"{path} is too short for an .idx header"], summary
+
+    with idx:
+        summary.update(version=idx.version, nodes=idx.numNodes, districts=idx.numDistricts)
+        if not idx.verifyChecksum():
+            return ["The checksum doesn't match"], summary
+        problems = checkLayout(idx, size)
+        if problems:
+            return problems, summary
+
+        offsets, neighbors = idx.topology()
+        graphProblems, numComponents = checkGraph(offsets, neighbors, idx.numNodes)
+        problems += graphProblems
+        summary.update(edges=len(neighbors) // 2, components=numComponents)
+        if connected and numComponents is not None and numComponents > 1:
+            problems.append(f"The graph has {numComponents} connected components")
+
+        demographics = idx.demographics()
+        summary['population'] = int(np.asarray(demographics[:, 0], dtype=np.int64).sum())
+        state = os.path.basename(os.path.dirname(path))
+        dmapLocation = DMAP_LOCATION.format(state=state)
+        if path == f"{OUTPUT_PREFIX}{state}/{state}.idx" and os.path.isfile(dmapLocation):
+            with DistrictMap(dmapLocation) as districtMap:
+                problems += checkPopulation(demographics, districtMap)
+        else:
+            problems += checkPopulation(demographics)
+        if idx.version != 1:
+            problems += checkCounties(idx, demographics)
+        if idx.numDistricts < 1 or idx.numDistricts > max(idx.numNodes, 1):
+            problems.append(f"{idx.numDistricts} districts for {idx.numNodes} nodes")
+        del offsets, neighbors, demographics
+    return problems, summary
+
+def verifyAll(paths, connected: bool = False, serial: bool = False):
+    "Returns {path: (problems, summary)} for every path, checked in parallel unless serial"
+    if serial or len(paths) < 2:
+        return dict((path, verifyIdx(path, connected)) for path in paths)
+    with ProcessPoolExecutor() as pool:
+        return dict(zip(paths, pool.map(verifyIdx, paths, [connected] * len(paths))))
+
+def main(argv):
+    states = [arg for arg in argv if not arg.startswith('-')]
+    paths = findIdxFiles(states)
+    if not paths:
+        logging.warning(f"No .idx files found under {OUTPUT_PREFIX}")
+        return 1
+
+    results = verifyAll(paths, '-connected' in argv, '-serial' in argv)
+    failed = 0
+    for path, (problems, summary) in results.items():
+        if problems:
+            failed += 1
+            for problem in problems:
+                logging.error(f"{path}: {problem}")
+        else:
+            logging.info(f"{path}: v{summary['version']}, {summary['nodes']} nodes, {summary['edges']} edges, "
+                         f"{summary['components']} components, population {summary['population']}")
+    logging.info(f"{len(paths) - failed} of {len(paths)} .idx files passed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
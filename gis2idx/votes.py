@@ -0,0 +1,130 @@
+"""
+Election result ingest: reads the vote CSVs of a state and matches their precincts to VTDs.
+
+Rows are matched on GEOID with one merge. Rows without a usable GEOID fall back to the precinct
+name, its tokens sorted so word order doesn't matter: first an exact match of the normalized
+name (within the county, when both sides have one), then a fuzzy match against only the VTDs
+that share a name token with it, through an inverted token index, instead of every VTD in the
+state.
+"""
+
+import difflib
+import glob
+import logging
+import os
+import re
+
+import pandas as pd
+
+from attributes import getAttributes
+
+GEOID_SOURCES = ['GEOID10', 'GEOID16', 'GEOID', 'geoid']
+NAME_SOURCES = ['NAME', 'PRECINCT', 'precinct', 'name', 'NAMELSAD10']
+COUNTY_SOURCES = ['COUNTYFP', 'COUNTYFP10', 'COUNTYFP16', 'countyfp']
+GENERIC_WORDS = set(['precinct', 'pct', 'voting', 'district', 'vtd'])
+FUZZY_CUTOFF = 0.8  # Minimum difflib ratio for a fuzzy name match
+
+def firstColumn(df, sources):
+    "Returns the first of sources that df has, or None"
+    return next((column for column in sources if column in df.columns), None)
+
+def normalizeName(name):
+    """
+        Lowercases a precinct name, drops punctuation, leading zeros and generic words, and sorts
+        the tokens, so "Adair 2" and "Precinct 2 Adair" normalize the same
+    """
+    tokens = re.sub(r'[^0-9a-z]+', ' ', str(name).lower()).split()
+    tokens = [token.lstrip('0') or '0' if token.isdigit() else token for token in tokens]
+    return ' '.join(sorted(token for token in tokens if token not in GENERIC_WORDS))
+
+def countyKey(county):
+    "Returns a county FIPS as a 3 digit string, or None"
+    if county is None or pd.isna(county):
+        return None
+    county = str(county).strip()
+    return county.zfill(3) if county.isdigit() else county
+
+def readVoteTables(directory: str):
+    """
+        Returns every vote CSV in directory as one table of geoid, name, countyfp (None where the
+        file doesn't have them) and the vote attributes
+    """
+    voteAttributes = getAttributes('votes')
+    tables = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.csv'))):
+        df = pd.read_csv(path, dtype=str)
+        table = pd.DataFrame(index=df.index)
+        for key, sources in [('geoid', GEOID_SOURCES), ('name', NAME_SOURCES), ('countyfp', COUNTY_SOURCES)]:
+            column = firstColumn(df, sources)
+            table[key] = df[column] if column is not None else None
+        for attribute in voteAttributes:
+            present = [source for source in attribute.sources if source in df.columns]
+            table[attribute.column] = sum(pd.to_numeric(df[source], errors='coerce').fillna(0) for source in present) \
+                if present else 0
+        logging.info(f"Read {len(table)} precincts of votes from {path}")
+        tables.append(table)
+    if not tables:
+        return None
+    return pd.concat(tables, ignore_index=True)
+
+class NameIndex(object):
+    "Exact and token indexed lookups of VTDs by normalized name"
+
+    def __init__(self, names, counties):
+        self._names = [normalizeName(name) for name in names]
+        self._counties = [countyKey(county) for county in counties]
+        self._exact = {}
+        self._tokens = {}
+        for position, (name, county) in enumerate(zip(self._names, self._counties)):
+            self._exact.setdefault((county, name), []).append(position)
+            self._exact.setdefault((None, name), []).append(position)
+            for token in set(name.split()):
+                self._tokens.setdefault(token, set()).add(position)
+
+    def match(self, name, county=None):
+        "Returns the position of the VTD best matching name (in county, if given), or None"
+        name = normalizeName(name)
+        county = countyKey(county)
+        exact = self._exact.get((county, name))
+        if exact and len(exact) == 1:
+            return exact[0]
+
+        candidates = set()
+        for token in name.split():
+            candidates |= self._tokens.get(token, set())
+        if county is not None:
+            candidates = [c for c in candidates if self._counties[c] == county]
+
+        best, bestRatio = None, FUZZY_CUTOFF
+        for candidate in sorted(candidates):
+            ratio = difflib.SequenceMatcher(None, name, self._names[candidate]).ratio()
+            if ratio > bestRatio:
+                best, bestRatio = candidate, ratio
+        return best
+
+def matchVotes(votes, vtd_df):
+    "Returns the votes summed per VTD, as a table of GEOID and the vote attributes"
+    columns = [attribute.column for attribute in getAttributes('votes')]
+    vtdGeoids = vtd_df['GEOID'].astype(str)
+
+    # Exact GEOID matches, in one merge
+    votes = votes.copy()
+    votes['GEOID'] = votes['geoid'].where(votes['geoid'].isin(set(vtdGeoids)))
+    unmatched = votes['GEOID'].isna()
+
+    # Names for the rest
+    if unmatched.any():
+        index = NameIndex(vtd_df['name'], vtd_df['countyfp'] if 'countyfp' in vtd_df.columns else [None] * len(vtd_df))
+        geoids = vtdGeoids.tolist()
+        matched = [index.match(name, county) for name, county in
+                   zip(votes.loc[unmatched, 'name'], votes.loc[unmatched, 'countyfp'])]
+        votes.loc[unmatched, 'GEOID'] = [geoids[m] if m is not None else None for m in matched]
+
+    missing = votes['GEOID'].isna()
+    logging.info(f"Matched {int((~unmatched).sum())} precincts by GEOID, {int((unmatched & ~missing).sum())} by name, "
+                 f"{int(missing.sum())} unmatched")
+    if missing.any():
+        logging.warning(f"{int(missing.sum())} vote precincts ({int(votes.loc[missing, columns].sum().sum())} votes) "
+                        f"didn't match any VTD")
+
+    return votes[~missing].groupby('GEOID')[columns].sum().reset_index()
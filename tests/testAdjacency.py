@@ -0,0 +1,50 @@
+import sys
+import unittest
+
+import pandas as pd
+from shapely.geometry import box
+
+sys.path.insert(0, 'gis2idx')
+import adjacency
+import merged2output
+
+def touchingPairs(geometries, minSharedLength=None):
+    "Returns the pairs getNeighbors finds, or just those sharing more than minSharedLength of boundary"
+    neighbors = merged2output.getNeighbors(pd.DataFrame({'geometry': geometries}))
+    return set((i, j) for i, n in enumerate(neighbors) for j in n
+               if i < j and (minSharedLength is None or geometries[i].intersection(geometries[j]).length > minSharedLength))
+
+def rookPairs(geometries, minSharedLength=adjacency.MIN_SHARED_LENGTH):
+    neighbors = adjacency.getRookNeighbors(geometries, minSharedLength)
+    return set((i, j) for i, n in enumerate(neighbors) for j in n if i < j)
+
+class testRookNeighbors(unittest.TestCase):
+    def testGrid(self):
+        grid = [box(x * 100, y * 100, (x + 1) * 100, (y + 1) * 100) for x in range(5) for y in range(4)]
+        self.assertEqual(rookPairs(grid), touchingPairs(grid, adjacency.MIN_SHARED_LENGTH))
+        # Every corner-only contact of the grid is left out
+        self.assertEqual(len(touchingPairs(grid)) - len(rookPairs(grid)), 2 * 4 * 3)
+
+    def testUnevenRows(self):
+        # Rows cut at different columns, so borders meet other borders in T-junctions
+        widths = [[100, 100, 100, 100], [150, 50, 200], [40, 300, 60], [400]]
+        geometries = []
+        for y, row in enumerate(widths):
+            x = 0
+            for width in row:
+                geometries.append(box(x, y * 100, x + width, (y + 1) * 100))
+                x += width
+        self.assertEqual(rookPairs(geometries), touchingPairs(geometries, adjacency.MIN_SHARED_LENGTH))
+
+    def testSplitBorder(self):
+        geometries = [box(0, 0, 100, 200), box(100, 0, 200, 100), box(100, 100, 200, 200)]
+        self.assertEqual(adjacency.getRookNeighbors(geometries), [[1, 2], [0, 2], [0, 1]])
+        self.assertEqual(adjacency.getSharedLengths(geometries), {(0, 1): 100.0, (0, 2): 100.0, (1, 2): 100.0})
+
+    def testMinSharedLength(self):
+        geometries = [box(0, 0, 100, 100), box(100, 99.5, 200, 200), box(100, 0, 200, 99.5)]
+        self.assertEqual(rookPairs(geometries), set([(0, 2), (1, 2)]))
+        self.assertEqual(rookPairs(geometries, 0.1), set([(0, 1), (0, 2), (1, 2)]))
+
+if __name__ == '__main__':
+    unittest.main()
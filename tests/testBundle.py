@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, 'gis2idx')
+sys.path.insert(0, 'tests')
+import bundle
+from testIdxFormat import makeGraph, buildV1, buildV2
+
+class testBundle(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'national.bundle')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertEntry(self, key, graph):
+        areas, neighborsLists, _ = graph
+        with bundle.Bundle(self.path) as packed:
+            with packed.idx(key) as idx:
+                self.assertEqual(idx.numNodes, len(areas))
+                self.assertEqual(idx.neighborsLists(), neighborsLists)
+                np.testing.assert_array_equal(idx.areas(), areas)
+
+    def testPackSwapCompact(self):
+        iowa, kansas, iowaRebuilt = makeGraph(30, 0), makeGraph(20, 1), makeGraph(34, 2)
+        self.assertEqual(bundle.pack(self.path, [('IA', 19, b'IDX ', buildV1(*iowa)),
+                                                 ('KS', 20, b'IDX ', buildV2(*kansas))]), 2)
+        self.assertEntry('IA', iowa)
+        self.assertEntry(20, kansas)
+        kansasEntry = dict(((e[0], e[2]), e) for e in bundle.readDirectory(self.path))[('KS', b'IDX ')]
+
+        # The rebuilt state is appended and swapped in, the other one stays where it was
+        size = os.path.getsize(self.path)
+        self.assertEqual(bundle.pack(self.path, [('IA', 19, b'IDX ', buildV2(*iowaRebuilt))]), 2)
+        self.assertGreater(os.path.getsize(self.path), size)
+        entries = dict(((e[0], e[2]), e) for e in bundle.readDirectory(self.path))
+        self.assertEqual(entries[('KS', b'IDX ')], kansasEntry)
+        self.assertGreaterEqual(entries[('IA', b'IDX ')][3], size)
+        self.assertEntry(19, iowaRebuilt)
+        self.assertEntry('KS', kansas)
+
+        # Compacting drops the swapped out copy
+        size = os.path.getsize(self.path)
+        self.assertEqual(bundle.pack(self.path, [], compact=True), 2)
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEntry('IA', iowaRebuilt)
+        self.assertEntry('KS', kansas)
+        with bundle.Bundle(self.path) as packed:
+            self.assertEqual(packed.states(), ['IA', 'KS'])
+            self.assertEqual(packed.stCode(19), 'IA')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['national.bundle'])
+
+    def testDamagedEntry(self):
+        bundle.pack(self.path, [('IA', 19, b'IDX ', buildV1(*makeGraph(30))), ('KS', 20, b'IDX ', buildV1(*makeGraph(20)))])
+        start = dict(((e[0], e[2]), e[3]) for e in bundle.readDirectory(self.path))[('IA', b'IDX ')]
+        with open(self.path, 'r+b') as handle:
+            handle.seek(start + 40)
+            value = handle.read(1)
+            handle.seek(start + 40)
+            handle.write(bytes([value[0] ^ 0xFF]))
+
+        with bundle.Bundle(self.path) as packed:
+            with self.assertRaises(ValueError):
+                packed.idx('IA')
+            with self.assertRaises(ValueError):
+                packed.idx(19)
+            packed.data('IA', verify=False)
+            with packed.idx('KS') as idx:
+                self.assertEqual(idx.numNodes, 20)
+
+    def testDamagedDirectory(self):
+        bundle.pack(self.path, [('IA', 19, b'IDX ', buildV1(*makeGraph(30)))])
+        with open(self.path, 'r+b') as handle:
+            handle.seek(-1, os.SEEK_END)
+            value = handle.read(1)
+            handle.seek(-1, os.SEEK_END)
+            handle.write(bytes([value[0] ^ 0xFF]))
+        with self.assertRaises(ValueError):
+            bundle.Bundle(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
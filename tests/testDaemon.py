@@ -0,0 +1,79 @@
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, 'gis2idx')
+import daemon
+import pipeline
+
+def fakeProcessState(state, args):
+    "Stands in for the pipeline: logs a line, fails for arkansas"
+    logging.info(f"Building {state} with {sorted(args)}")
+    if state == 'arkansas':
+        raise ValueError("no VTDs")
+    return [f"output/{state}/{state}.idx"]
+
+class testDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, 'daemon.sock')
+        self.server = daemon.JobServer(self.socket, daemon.JobHandler)
+        self.server.jobs = queue.Queue()
+        threading.Thread(target=daemon.worker, args=(self.server.jobs,), daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.INFO)
+        patches = [
+            mock.patch.object(daemon, 'DAEMON_SOCKET_LOCATION', self.socket),
+            mock.patch.object(pipeline, 'processState', side_effect=fakeProcessState),
+            mock.patch.object(pipeline, 'sanityChecks'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.level)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def testDone(self):
+        events = list(daemon.submit('iowa', ['-idx', '-v2']))
+        self.assertEqual([event['event'] for event in events], ['queued', 'started', 'log', 'done'])
+        self.assertEqual(events[2]['message'], "Building iowa with ['-idx', '-v2']")
+        self.assertEqual(events[3]['artifacts'], ['output/iowa/iowa.idx'])
+        pipeline.sanityChecks.assert_called_once_with('iowa', set(['-idx', '-v2']))
+
+    def testFailed(self):
+        with self.assertLogs(level='ERROR'):
+            events = list(daemon.submit('arkansas', []))
+        self.assertEqual(events[-1], {"event": "error", "state": "arkansas", "message": "ValueError('no VTDs')"})
+        # The worker keeps serving after a failed job, and the job's log handler is gone
+        self.assertEqual([event['event'] for event in daemon.submit('iowa', [])], ['queued', 'started', 'log', 'done'])
+        self.assertFalse(any(isinstance(handler, daemon.JobLogHandler) for handler in logging.getLogger().handlers))
+
+    def testMainStatus(self):
+        with mock.patch('builtins.print'):
+            self.assertEqual(daemon.main(['iowa', '-idx']), 0)
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(daemon.main(['arkansas']), 1)
+
+    def testMalformedJob(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket)
+        with client, client.makefile('rwb') as stream:
+            stream.write(b'{"args": []}\n')
+            stream.flush()
+            self.assertEqual(stream.readline(), b'{"event": "error", "message": "Malformed job"}\n')
+
+if __name__ == '__main__':
+    unittest.main()
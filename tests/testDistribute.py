@@ -0,0 +1,105 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, 'gis2idx')
+import distribute
+
+STATES = ['alabama', 'alaska', 'arizona', 'arkansas', 'california', 'colorado']
+
+def fakeRun(state, args):
+    "Stands in for the pipeline: logs the build, writes one artifact"
+    directory = sorted(args)[0][len('-out='):]
+    with open(os.path.join(directory, 'builds.log'), 'a') as handle:
+        handle.write(state + '\n')
+    time.sleep(0.05)
+    if state == 'arkansas':
+        raise ValueError("no VTDs")
+    path = os.path.join(directory, state + '.idx')
+    with open(path, 'w') as handle:
+        handle.write(state)
+    return [path]
+
+def runWorker(workdir):
+    distribute.Worker(workdir, run=fakeRun, heartbeat=0.05, timeout=1, poll=0.05).work()
+
+class testDistribute(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.workdir = os.path.join(self.directory, 'work')
+        self.args = set(['-out=' + self.directory])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testWorkersShareJobs(self):
+        distribute.queueJobs(self.workdir, STATES, self.args)
+        workers = [multiprocessing.Process(target=runWorker, args=(self.workdir,)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+
+        # Every state built exactly once
+        with open(os.path.join(self.directory, 'builds.log')) as handle:
+            self.assertEqual(sorted(handle.read().split()), STATES)
+
+        report = distribute.collectReport(self.workdir, STATES, 0)
+        self.assertEqual(report['failed'], ['arkansas'])
+        self.assertEqual(report['reclaimed'], [])
+        self.assertEqual(sum(len(w['states']) for w in report['workers'].values()), len(STATES))
+        self.assertEqual(report['states']['alaska']['artifacts'], [os.path.join(self.directory, 'alaska.idx')])
+        self.assertEqual(os.listdir(os.path.join(self.workdir, distribute.LEASES_DIRECTORY)), [])
+
+    def testReclaimsDeadWorker(self):
+        distribute.queueJobs(self.workdir, ['alabama', 'alaska'], self.args)
+        for state, worker, age in [('alabama', 'dead-1', 10), ('alaska', 'alive-2', 0)]:
+            path = distribute.leasePath(self.workdir, state)
+            with open(path, 'w') as handle:
+                handle.write(json.dumps({"worker": worker}))
+            os.utime(path, (time.time() - age, time.time() - age))
+
+        worker = distribute.Worker(self.workdir, run=fakeRun, heartbeat=0.05, timeout=1, poll=0.05)
+        state, lease, reclaimedFrom = worker.claimNext()
+        self.assertEqual((state, reclaimedFrom), ('alabama', 'dead-1'))
+        self.assertIsNone(worker.claimNext())
+
+        outcome = worker.runJob(state, lease, reclaimedFrom)
+        self.assertEqual(outcome['status'], 'done')
+        self.assertEqual(distribute.readJSON(distribute.donePath(self.workdir, 'alabama'))['reclaimedFrom'], 'dead-1')
+        self.assertEqual(worker.pending(), ['alaska'])
+
+    def testInterleavedReclaimers(self):
+        distribute.queueJobs(self.workdir, ['alabama'], self.args)
+        path = distribute.leasePath(self.workdir, 'alabama')
+        with open(path, 'w') as handle:
+            handle.write(json.dumps({"worker": "dead-1"}))
+        os.utime(path, (time.time() - 10, time.time() - 10))
+
+        # Worker A reclaims and claims the job after worker B saw the stale lease, before B renames it
+        rename = os.rename
+        leases = []
+        def interleave(source, destination):
+            if destination.endswith('.stale-worker-b') and not leases:
+                self.assertEqual(distribute.reclaimStale(self.workdir, 'alabama', 'worker-a', timeout=1), 'dead-1')
+                leases.append(distribute.Lease.claim(self.workdir, 'alabama', 'worker-a', heartbeat=60))
+            rename(source, destination)
+
+        with mock.patch.object(distribute.os, 'rename', side_effect=interleave):
+            self.assertIsNone(distribute.reclaimStale(self.workdir, 'alabama', 'worker-b', timeout=1))
+
+        # A keeps its lease, B backs off instead of claiming the job too
+        self.assertTrue(leases[0].held())
+        self.assertIsNone(distribute.Lease.claim(self.workdir, 'alabama', 'worker-b', heartbeat=60))
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+        leases[0].release()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, 'data')
+import downloadAll
+
+def zipped(name, data):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(name, data)
+    return buffer.getvalue()
+
+FILES = {
+    '/a.csv': b'GEOID,P003001\n' * 5000,
+    '/b.csv': b'GEOID,P003002\n' * 3000,
+    '/c.csv.gz': gzip.compress(b'GEOID,P003003\n' * 2000),
+    '/vtd.zip': zipped('vtd.shp', b'\0' * 4000),
+    '/error.zip': b'<html><body>Service Unavailable</body></html>',
+}
+
+class RangeHandler(BaseHTTPRequestHandler):
+    "Serves FILES, honoring single 'bytes=N-' ranges"
+
+    def do_GET(self):
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+        data = FILES[self.path]
+        offset = 0
+        requested = self.headers.get('Range')
+        if requested:
+            offset = int(requested[len('bytes='):-1])
+            if offset >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {offset}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - offset))
+        self.end_headers()
+        self.wfile.write(data[offset:])
+
+    def log_message(self, *args):
+        pass
+
+class testDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def testResume(self):
+        destination = os.path.join(self.directory, 'a.csv')
+        with open(destination + '.part', 'wb') as handle:
+            handle.write(FILES['/a.csv'][:1000])
+        digest = downloadAll.fetch(self.url + '/a.csv', destination)
+        with open(destination, 'rb') as handle:
+            self.assertEqual(handle.read(), FILES['/a.csv'])
+        self.assertEqual(digest, hashlib.sha256(FILES['/a.csv']).hexdigest())
+        self.assertFalse(os.path.exists(destination + '.part'))
+
+    def testChecksumMismatch(self):
+        destination = os.path.join(self.directory, 'a.csv')
+        with self.assertRaises(downloadAll.ChecksumError):
+            downloadAll.fetch(self.url + '/a.csv', destination, '0' * 64)
+        self.assertFalse(os.path.exists(destination))
+        self.assertFalse(os.path.exists(destination + '.part'))
+
+    def testDownloadAll(self):
+        jobs = [(self.url + path, os.path.join(self.directory, path[1:]), None) for path in ['/a.csv', '/b.csv']]
+        jobs.append((self.url + '/missing.csv', os.path.join(self.directory, 'missing.csv'), None))
+        checksums = {}
+        failures = downloadAll.downloadAll(jobs, checksums, workers=2)
+        self.assertEqual(list(failures), [os.path.join(self.directory, 'missing.csv')])
+        for path in ['/a.csv', '/b.csv']:
+            self.assertEqual(checksums[os.path.join(self.directory, path[1:])], hashlib.sha256(FILES[path]).hexdigest())
+
+    def testCheckedBeforeRename(self):
+        destination = os.path.join(self.directory, 'vtd.zip')
+        digest = downloadAll.fetch(self.url + '/vtd.zip', destination, after=downloadAll.checkZip)
+        self.assertEqual(digest, hashlib.sha256(FILES['/vtd.zip']).hexdigest())
+
+        # An error page served as the zip never takes the zip's place
+        destination = os.path.join(self.directory, 'tracts.zip')
+        with self.assertRaises(zipfile.BadZipFile):
+            downloadAll.fetch(self.url + '/error.zip', destination, after=downloadAll.checkZip)
+        self.assertEqual(os.listdir(self.directory), ['vtd.zip'])
+
+    def testGunzipChecksum(self):
+        # The checksum is of the decompressed CSV, under the name it's kept as
+        destination = os.path.join(self.directory, 'c.csv')
+        expected = hashlib.sha256(gzip.decompress(FILES['/c.csv.gz'])).hexdigest()
+        self.assertEqual(downloadAll.fetch(self.url + '/c.csv.gz', destination, expected, downloadAll.gunzip), expected)
+        with open(destination, 'rb') as handle:
+            self.assertEqual(handle.read(), gzip.decompress(FILES['/c.csv.gz']))
+        self.assertEqual(os.listdir(self.directory), ['c.csv'])
+
+    def testExistingFilesRehashed(self):
+        files = [(self.url + path, os.path.join(self.directory, path[1:]), after)
+                 for path, after in [('/a.csv', None), ('/b.csv', None), ('/vtd.zip', downloadAll.checkZip)]]
+        for (_, destination, _), data in zip(files, [FILES['/a.csv'], b'truncated', FILES['/error.zip']]):
+            with open(destination, 'wb') as handle:
+                handle.write(data)
+        checksums = dict((files[i][1], hashlib.sha256(FILES[path]).hexdigest()) for i, path in [(1, '/b.csv')])
+
+        # a.csv is recorded as it is, b.csv doesn't match its checksum and vtd.zip isn't a zip
+        jobs = downloadAll.getJobs(files, checksums)
+        self.assertEqual(jobs, files[1:])
+        self.assertEqual(checksums[files[0][1]], hashlib.sha256(FILES['/a.csv']).hexdigest())
+        self.assertEqual(os.listdir(self.directory), ['a.csv'])
+
+        self.assertEqual(downloadAll.downloadAll(jobs, checksums, workers=2), {})
+        self.assertEqual(downloadAll.getJobs(files, checksums), [])
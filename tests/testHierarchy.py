@@ -0,0 +1,110 @@
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, 'gis2idx')
+import hierarchy
+from idxformat import (
+    U8,
+    IdxFile,
+    encodeV2
+)
+
+def gridGraph(side):
+    "Returns the neighbor lists of a side x side grid (rook adjacency), node = row * side + column"
+    neighborsLists = []
+    for row in range(side):
+        for column in range(side):
+            neighbors = [(row + dr) * side + column + dc for dr, dc in [(-1, 0), (0, -1), (0, 1), (1, 0)]
+                         if 0 <= row + dr < side and 0 <= column + dc < side]
+            neighborsLists.append(neighbors)
+    return neighborsLists
+
+def blockCounties(side, block):
+    "Returns the county of every grid node, counties being block x block squares"
+    return [f"{(row // block) * (side // block) + column // block + 1:03d}" for row in range(side) for column in range(side)]
+
+def readLevels(sections, numNodes):
+    "Returns {level: (parents, neighbor lists, areas, demographics, edge weights)} of the level sections"
+    with IdxFile(None, buffer=encodeV2('IA', numNodes, 1, sections)) as idx:
+        levels = {}
+        for level in range(1, 10):
+            digit = str(level).encode()
+            if b'PAR' + digit not in idx.sections:
+                break
+            topology = idx.array(b'TOP' + digit)
+            numParents = len(idx.array(b'ATR' + digit, U8))
+            offsets, neighbors = topology[:numParents + 1], topology[numParents + 1:]
+            weights = idx.array(b'EWT' + digit)
+            levels[level] = (
+                idx.array(b'PAR' + digit).tolist(),
+                [neighbors[offsets[i]:offsets[i + 1]].tolist() for i in range(numParents)],
+                idx.array(b'ATR' + digit, U8).tolist(),
+                idx.array(b'DEM' + digit).reshape(numParents, 6),
+                [weights[offsets[i]:offsets[i + 1]].tolist() for i in range(numParents)],
+            )
+        return levels
+
+class testHierarchy(unittest.TestCase):
+    def setUp(self):
+        self.neighborsLists = gridGraph(4)
+        self.areas = np.arange(16) + 1
+        self.demographics = np.tile(np.arange(16)[:, None] + 1, (1, 6))
+
+    def testCounties(self):
+        # Four 2 x 2 counties, one district, so the region level wouldn't merge anything
+        sections = hierarchy.buildSections(self.neighborsLists, self.areas, self.demographics, blockCounties(4, 2), 1)
+        levels = readLevels(sections, 16)
+        self.assertEqual(list(levels), [1])
+        parents, neighborsLists, areas, demographics, weights = levels[1]
+        self.assertEqual(parents, [0, 0, 1, 1, 0, 0, 1, 1, 2, 2, 3, 3, 2, 2, 3, 3])
+        self.assertEqual(neighborsLists, [[1, 2], [0, 3], [0, 3], [1, 2]])
+        # Two precinct adjacencies cross every county border
+        self.assertEqual(weights, [[2, 2]] * 4)
+        self.assertEqual(areas, [1 + 2 + 5 + 6, 3 + 4 + 7 + 8, 9 + 10 + 13 + 14, 11 + 12 + 15 + 16])
+        np.testing.assert_array_equal(demographics[:, 0], areas)
+
+    def testRegions(self):
+        neighborsLists = gridGraph(6)
+        areas, demographics = np.ones(36), np.ones((36, 6))
+        sections = hierarchy.buildSections(neighborsLists, areas, demographics, blockCounties(6, 2), 1)
+        levels = readLevels(sections, 36)
+        self.assertEqual(list(levels), [1, 2])
+        counties, countyNeighbors, _, countyDemographics, countyWeights = levels[1]
+        regions, regionNeighbors, regionAreas, regionDemographics, regionWeights = levels[2]
+        self.assertEqual(len(countyNeighbors), 9)
+        self.assertEqual(len(regions), 9)
+        self.assertLess(len(regionNeighbors), 9)
+
+        # Regions sum their counties, and their edges the county edges that cross between them
+        np.testing.assert_array_equal(regionDemographics, hierarchy.aggregate(countyDemographics, regions, len(regionNeighbors)))
+        self.assertEqual(sum(regionAreas), 36)
+        crossing = sum(w for i, (n, ws) in enumerate(zip(countyNeighbors, countyWeights))
+                       for j, w in zip(n, ws) if regions[i] != regions[j])
+        self.assertEqual(sum(map(sum, regionWeights)), crossing)
+        # No region holds more than half the population
+        self.assertTrue(all(total <= 18 for total in regionDemographics[:, 0]))
+
+    def testDissolvedState(self):
+        # Every precinct is its own county, like a state dissolved into counties: level 1 is regions
+        counties = [f"{i + 1:03d}" for i in range(16)]
+        levels = readLevels(hierarchy.buildSections(self.neighborsLists, self.areas, self.demographics, counties, 1), 16)
+        self.assertEqual(list(levels), [1])
+        parents, neighborsLists, areas, demographics, _ = levels[1]
+        self.assertEqual(len(parents), 16)
+        self.assertLessEqual(len(neighborsLists), 4 * 1 * 2)
+        self.assertEqual(sum(areas), self.areas.sum())
+        np.testing.assert_array_equal(demographics, hierarchy.aggregate(self.demographics, parents, len(neighborsLists)))
+
+        self.assertEqual(hierarchy.buildSections(self.neighborsLists, self.areas, self.demographics, None, 4), [])
+
+    def testContract(self):
+        neighborsLists = [[1, 2], [0, 2], [0, 1, 3], [2]]
+        weights = [[5, 1], [5, 2], [1, 2, 7], [7]]
+        coarse, coarseWeights = hierarchy.contract(neighborsLists, [0, 0, 1, 1], 2, weights)
+        self.assertEqual((coarse, coarseWeights), ([[1], [0]], [[3], [3]]))
+        self.assertEqual(hierarchy.contract(neighborsLists, [0, 1, 1, 2], 3), ([[1], [0, 2], [1]], [[2], [2, 1], [1]]))
+
+if __name__ == '__main__':
+    unittest.main()
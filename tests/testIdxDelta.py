@@ -0,0 +1,85 @@
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, 'gis2idx')
+sys.path.insert(0, 'tests')
+import idxdelta
+import reorder
+from idxformat import IdxFile
+from testIdxFormat import makeGraph, buildV1, buildV2
+
+class testIdxDelta(unittest.TestCase):
+    def changedGraph(self, numNodes):
+        "Returns the graph of makeGraph(30), rebuilt with numNodes nodes and a few edits"
+        areas, neighborsLists, demographics = makeGraph(30)
+        areas, demographics = areas.copy(), demographics.copy()
+        areas[3] += 17
+        demographics[5, 1] += 2
+        demographics[5, 0] += 2
+        # Drop the nodes past numNodes, add new ones linked to node 0
+        neighborsLists = [[j for j in n if j < numNodes] for n in neighborsLists[:numNodes]]
+        for i in range(30, numNodes):
+            neighborsLists.append([0])
+            neighborsLists[0].append(i)
+        extra = numNodes - min(numNodes, 30)
+        areas = np.concatenate([areas[:numNodes], np.full(extra, 1000)])
+        demographics = np.concatenate([demographics[:numNodes], np.full((extra, 6), 1)])
+        return areas, neighborsLists, demographics
+
+    def assertPatches(self, build, **options):
+        base = build(*makeGraph(30), **options)
+        for numNodes in [30, 26, 34]:
+            target = build(*self.changedGraph(numNodes), **options)
+            with IdxFile(None, buffer=base) as old, IdxFile(None, buffer=target) as new:
+                patch = idxdelta.diff(old, new)
+            with IdxFile(None, buffer=base) as old:
+                self.assertEqual(idxdelta.apply(old, patch), target)
+            self.assertLess(len(patch), len(target))
+
+    def testPatchV1(self):
+        self.assertPatches(buildV1)
+
+    def testPatchV2(self):
+        self.assertPatches(buildV2)
+        self.assertPatches(buildV2, compress=True)
+
+    def testPatchCarriesOtherSections(self):
+        areas, neighborsLists, demographics = makeGraph(20)
+        base = buildV2(areas, neighborsLists, demographics, counties=['001'] * 20)
+        target = buildV2(areas, neighborsLists, demographics, counties=['001'] * 10 + ['003'] * 10)
+        with IdxFile(None, buffer=base) as old, IdxFile(None, buffer=target) as new:
+            patch = idxdelta.diff(old, new)
+        with IdxFile(None, buffer=base) as old:
+            self.assertEqual(idxdelta.apply(old, patch), target)
+
+    def testPatchRejectsOtherBase(self):
+        base = buildV1(*makeGraph(30))
+        with IdxFile(None, buffer=base) as old, IdxFile(None, buffer=buildV1(*self.changedGraph(30))) as new:
+            patch = idxdelta.diff(old, new)
+        with IdxFile(None, buffer=buildV1(*makeGraph(30, seed=1))) as other:
+            with self.assertRaises(idxdelta.PatchError):
+                idxdelta.apply(other, patch)
+
+class testStableOrder(unittest.TestCase):
+    def testUnchanged(self):
+        registry = ['a', 'b', 'c', 'd']
+        self.assertEqual(reorder.stableOrder(['c', 'a', 'd', 'b'], registry), [1, 3, 0, 2])
+
+    def testRemovedAddedAndDisplaced(self):
+        registry = ['a', 'b', 'c', 'd', 'e']
+        # 'b' and 'd' are gone, 'e' (id 4) is past the end of the new graph, 'x' is new
+        geoids = ['x', 'e', 'c', 'a']
+        order = reorder.stableOrder(geoids, registry)
+        self.assertEqual(sorted(order), [0, 1, 2, 3])
+        newIds = dict((geoids[row], nodeId) for nodeId, row in enumerate(order))
+        # Kept precincts keep their ids, the displaced one takes the first freed id, then the new one
+        self.assertEqual(newIds, {'a': 0, 'c': 2, 'e': 1, 'x': 3})
+
+    def testGrows(self):
+        order = reorder.stableOrder(['n1', 'b', 'n2', 'a'], ['a', 'b'])
+        self.assertEqual(order, [3, 1, 0, 2])
+
+if __name__ == '__main__':
+    unittest.main()
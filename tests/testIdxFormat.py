@@ -0,0 +1,158 @@
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, 'gis2idx')
+from merged2output import getDistrictTotals, getV2Sections
+from idxformat import (
+    U4,
+    U8,
+    DISTRICT_TOTALS,
+    IdxFile,
+    DistrictMap,
+    encodeDistrictMap,
+    encodeV1,
+    encodeV2,
+    encodeCSR,
+    encodeCounties
+)
+
+def makeGraph(numNodes, seed=0):
+    "Returns (areas, neighborsLists, demographics) of a ring with a few chords"
+    random = np.random.RandomState(seed)
+    edges = set()
+    for i in range(numNodes):
+        edges.add((i, (i + 1) % numNodes))
+    for _ in range(numNodes // 3):
+        i, j = random.randint(0, numNodes, 2)
+        if i != j:
+            edges.add((int(i), int(j)))
+    neighborsLists = [[] for _ in range(numNodes)]
+    for i, j in edges:
+        if j not in neighborsLists[i]:
+            neighborsLists[i].append(j)
+            neighborsLists[j].append(i)
+    areas = random.randint(1, 1 << 30, numNodes)
+    demographics = random.randint(0, 1000, (numNodes, 6))
+    demographics[:, 0] = demographics.sum(axis=1)
+    return areas, [sorted(n) for n in neighborsLists], demographics
+
+def buildV1(areas, neighborsLists, demographics):
+    return encodeV1('IA', 4, range(len(areas)), areas, neighborsLists, demographics)
+
+def buildV2(areas, neighborsLists, demographics, compress=False, counties=None):
+    sections = [
+        (b'TOPO', encodeCSR(neighborsLists)),
+        (b'ATTR', np.asarray(areas).astype(U8).tobytes()),
+        (b'DEMO', np.asarray(demographics).astype(U4).tobytes()),
+    ]
+    if counties is not None:
+        cnty, ctab = encodeCounties(counties, demographics)
+        sections += [(b'CNTY', cnty), (b'CTAB', ctab)]
+    return encodeV2('IA', len(areas), 4, sections, compress)
+
+class testIdxFormat(unittest.TestCase):
+    def assertDecodes(self, data, areas, neighborsLists, demographics):
+        with IdxFile(None, buffer=data) as idx:
+            self.assertTrue(idx.verifyChecksum())
+            self.assertEqual(idx.stCode, 'IA')
+            self.assertEqual((idx.numNodes, idx.numDistricts), (len(areas), 4))
+            self.assertEqual(idx.neighborsLists(), neighborsLists)
+            np.testing.assert_array_equal(idx.areas(), areas)
+            np.testing.assert_array_equal(idx.demographics(), demographics)
+
+    def testV1RoundTrip(self):
+        graph = makeGraph(40)
+        data = buildV1(*graph)
+        self.assertDecodes(data, *graph)
+        with IdxFile(None, buffer=data) as idx:
+            self.assertEqual(idx.version, 1)
+            np.testing.assert_array_equal(idx.nodeIds(), np.arange(40))
+
+    def testV2RoundTrip(self):
+        graph = makeGraph(40)
+        for compress in [False, True]:
+            data = buildV2(*graph, compress=compress)
+            self.assertDecodes(data, *graph)
+            with IdxFile(None, buffer=data) as idx:
+                self.assertEqual(idx.version, 2)
+                self.assertEqual(list(idx.sections), [b'TOPO', b'ATTR', b'DEMO'])
+                self.assertEqual(any(entry[0] for entry in idx.sections.values()), compress)
+
+    def testCounties(self):
+        areas, neighborsLists, demographics = makeGraph(12)
+        counties = ['003', '001', '003', '005'] * 3
+        with IdxFile(None, buffer=buildV2(areas, neighborsLists, demographics, counties=counties)) as idx:
+            index, table = idx.counties()
+            self.assertEqual(table[:, 0].tolist(), [1, 3, 5])
+            self.assertEqual(table[:, 1].tolist(), [3, 6, 3])
+            self.assertEqual(index.tolist(), [1, 0, 1, 2] * 3)
+            np.testing.assert_array_equal(table[1, 2:], demographics[[0, 2, 4, 6, 8, 10]].sum(axis=0))
+
+    def testCountiesFromFrame(self):
+        areas, neighborsLists, demographics = makeGraph(12)
+        df = pd.DataFrame(demographics, columns=['totalPop', 'blackPop', 'nativeAPop', 'asianPop', 'whitePop', 'otherPop'])
+        df['pacisPop'] = df['multiPop'] = 0
+        df['land'], df['water'] = areas, 0
+        df['countyfp'] = pd.Categorical(['019', '007', '019'] * 4)
+        with IdxFile(None, buffer=encodeV2('IA', 12, 4, getV2Sections(df, neighborsLists))) as idx:
+            self.assertDecodes(idx._buffer, areas, neighborsLists, demographics)
+            self.assertIn(b'CNTY', idx.sections)
+            index, table = idx.counties()
+            self.assertEqual(table[:, :2].tolist(), [[7, 4], [19, 8]])
+            self.assertEqual(index.tolist(), [1, 0, 1] * 4)
+            np.testing.assert_array_equal(table[:, 2:].sum(axis=0), demographics.sum(axis=0))
+
+    def testNonNumericCounty(self):
+        _, _, demographics = makeGraph(4)
+        with self.assertLogs(level='WARNING') as logs:
+            cnty, ctab = encodeCounties(['001', 'nan', '001', 'nan'], demographics)
+        self.assertIn('2 nodes', logs.output[0])
+        self.assertEqual(np.frombuffer(ctab, dtype=U4).reshape(2, -1)[:, :2].tolist(), [[1, 2], [0, 2]])
+
+    def testDistrictMap(self):
+        for numNodes, numDistricts, width in [(40, 4, 1), (600, 300, 2)]:
+            _, _, demographics = makeGraph(numNodes)
+            districts = np.arange(numNodes) % numDistricts + 1
+            df = pd.DataFrame(demographics, columns=['totalPop', 'blackPop', 'nativeAPop', 'asianPop', 'whitePop', 'otherPop'])
+            df['pacisPop'] = df['multiPop'] = 0
+            df['land'], df['water'], df['district'] = np.arange(numNodes) * 10, 1, districts
+            totals = getDistrictTotals(df, numDistricts)
+            self.assertEqual(totals.shape, (numDistricts, DISTRICT_TOTALS))
+
+            with DistrictMap(None, buffer=encodeDistrictMap('IA', numDistricts, districts, totals)) as dmap:
+                self.assertTrue(dmap.verifyChecksum())
+                self.assertEqual((dmap.stCode, dmap.numNodes, dmap.numDistricts), ('IA', numNodes, numDistricts))
+                self.assertEqual(dmap.districts.dtype.itemsize, width)
+                np.testing.assert_array_equal(dmap.districts, districts)
+                np.testing.assert_array_equal(dmap.totals[0, :6], demographics[districts == 1].sum(axis=0))
+                self.assertEqual(dmap.totals[0, 6], (np.arange(numNodes)[districts == 1] * 10 + 1).sum())
+                np.testing.assert_array_equal(dmap.totals[:, 7], np.bincount(districts - 1, minlength=numDistricts))
+
+    def testDistrictTotalsOutOfRange(self):
+        df = pd.DataFrame(dict((column, [1, 2]) for column in
+                               ['totalPop', 'blackPop', 'nativeAPop', 'asianPop', 'whitePop', 'otherPop', 'pacisPop',
+                                'multiPop', 'land', 'water']))
+        for districts in [[0, 1], [1, 3]]:
+            df['district'] = districts
+            with self.assertRaises(ValueError):
+                getDistrictTotals(df, 2)
+        # A district without nodes gets a row of zeros
+        df['district'] = [1, 1]
+        self.assertEqual(getDistrictTotals(df, 2)[1].tolist(), [0] * DISTRICT_TOTALS)
+
+    def testChecksumCatchesCorruption(self):
+        for data in [buildV1(*makeGraph(10)), buildV2(*makeGraph(10))]:
+            corrupted = bytearray(data)
+            corrupted[-1] ^= 0xFF
+            with IdxFile(None, buffer=bytes(corrupted)) as idx:
+                self.assertFalse(idx.verifyChecksum())
+
+    def testNotAnIdx(self):
+        with self.assertRaises(ValueError):
+            IdxFile(None, buffer=bytes(64))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
 import json
 import unittest
 import os
+import sys
+
+sys.path.insert(0, 'gis2idx')
+import verify
+from idxformat import IdxFile
 
 with open('tests/expected/iowaExpected.idx.json') as f:
     data = json.load(f)
@@ -36,7 +41,28 @@ class testIDXOutput(unittest.TestCase):
         self.assertEqual(expNodes, actual["nodes"])
 
     def testIDXBinary(self):
-        self.assertTrue(True) #TODO
+        location = 'output/iowa/iowa.idx'
+        problems, summary = verify.verifyIdx(location)
+        self.assertEqual(problems, [])
+
+        with IdxFile(location) as idx:
+            self.assertEqual(expMagicNum, hex(idx.magic))
+            self.assertEqual(expCheckSum, hex(idx.checkSum))
+            self.assertEqual(expStCode, idx.stCode)
+            self.assertEqual(expNumNodes, idx.numNodes)
+            self.assertEqual(expNumDistricts, idx.numDistricts)
+
+            numNeighbors, nodePos = idx.nodeRecords()
+            self.assertEqual([r["numNeighbors"] for r in expNodeRecords], numNeighbors.tolist())
+            self.assertEqual([r["nodePos"] for r in expNodeRecords], nodePos.tolist())
+
+            neighborsLists = idx.neighborsLists()
+            areas = idx.areas().tolist()
+            demographics = idx.demographics().tolist()
+            for i, node in enumerate(expNodes):
+                self.assertEqual(node["area"], areas[i])
+                self.assertEqual(node["neighbors"], neighborsLists[i])
+                self.assertEqual(list(node["demographics"].values()), demographics[i])
 
 class testJSONOutput(unittest.TestCase):
     def testStateJSON(self):
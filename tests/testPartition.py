@@ -0,0 +1,63 @@
+import sys
+import unittest
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, 'gis2idx')
+sys.path.insert(0, 'tests')
+import partition
+from testHierarchy import gridGraph
+
+def isContiguous(neighborsLists, districts, district):
+    "Checks that the nodes of a district are connected within it"
+    nodes = [u for u, d in enumerate(districts) if d == district]
+    seen = set(nodes[:1])
+    queue = deque(nodes[:1])
+    while queue:
+        u = queue.popleft()
+        for v in neighborsLists[u]:
+            if districts[v] == district and v not in seen:
+                seen.add(v)
+                queue.append(v)
+    return len(seen) == len(nodes)
+
+def maxDeviation(populations, districts, numDistricts):
+    totals = np.bincount(np.asarray(districts) - 1, weights=populations, minlength=numDistricts)
+    ideal = sum(populations) / numDistricts
+    return max(abs(totals - ideal)) / ideal
+
+class testPartition(unittest.TestCase):
+    def assertValidPlan(self, neighborsLists, populations, numDistricts, districts, tolerance):
+        self.assertEqual(len(districts), len(neighborsLists))
+        self.assertEqual(sorted(set(districts)), list(range(1, numDistricts + 1)))
+        for district in range(1, numDistricts + 1):
+            self.assertTrue(isContiguous(neighborsLists, districts, district), f"District {district} is split")
+        self.assertLessEqual(maxDeviation(populations, districts, numDistricts), tolerance)
+
+    def testUniformGrid(self):
+        neighborsLists = gridGraph(100)
+        populations = [100] * len(neighborsLists)
+        for numDistricts in [2, 4, 9]:
+            districts = partition.partition(neighborsLists, populations, numDistricts)
+            self.assertValidPlan(neighborsLists, populations, numDistricts, districts, partition.TOLERANCE)
+
+    def testUnevenPopulations(self):
+        neighborsLists = gridGraph(40)
+        populations = np.random.RandomState(3).randint(50, 2000, len(neighborsLists)).tolist()
+        districts = partition.partition(neighborsLists, populations, 4)
+        # Nodes are at most 2000 of a district of about 410000, small enough to balance within 1%
+        self.assertValidPlan(neighborsLists, populations, 4, districts, partition.TOLERANCE)
+
+    def testDeterministic(self):
+        neighborsLists = gridGraph(30)
+        populations = np.random.RandomState(5).randint(1, 100, len(neighborsLists)).tolist()
+        self.assertEqual(partition.partition(neighborsLists, populations, 5),
+                         partition.partition(neighborsLists, populations, 5))
+
+    def testTooFewNodes(self):
+        with self.assertRaises(ValueError):
+            partition.partition(gridGraph(2), [1] * 4, 5)
+
+if __name__ == '__main__':
+    unittest.main()
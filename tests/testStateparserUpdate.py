@@ -0,0 +1,184 @@
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+import geopandas as gpd
+import pandas as pd
+from geopandas.testing import assert_geodataframe_equal
+from shapely.geometry import box
+
+sys.path.insert(0, 'gis2idx')
+import merged2output
+import stateparser
+from util import (
+    VTD_LOCATION,
+    TRACTS_LOCATION,
+    DEMOGRAPHIC_LOCATION,
+    CONGRESSIONAL_DISTRICTS_LOCATION,
+    STATEGRANULARITY_LOCATION,
+    MERGED_DF_INPUT,
+    OUTPUT_PREFIX
+)
+
+STATE = 'teststate'
+SIDE = 10   # A 4 x 4 grid of SIDE x SIDE VTDs
+
+# Tracts and districts deliberately don't line up with the VTDs
+TRACTS = [box(0, 0, 15, 20), box(15, 0, 40, 20), box(0, 20, 25, 40), box(25, 20, 40, 40)]
+DISTRICTS = [box(0, 0, 20, 40), box(20, 0, 40, 40)]
+
+def vtdGeoid(column, row):
+    return f"19001{column * 4 + row:06d}"
+
+def gridVtds():
+    "Returns {GEOID: geometry} of the grid"
+    return dict((vtdGeoid(column, row), box(column * SIDE, row * SIDE, (column + 1) * SIDE, (row + 1) * SIDE))
+                for column in range(4) for row in range(4))
+
+def writeShapefile(location, records, crs='EPSG:3857'):
+    os.makedirs(location, exist_ok=True)
+    gpd.GeoDataFrame(records, crs=crs).to_file(os.path.join(location, os.path.basename(location.rstrip('/')) + '.shp'))
+
+def writeInputs(vtds):
+    "Writes the inputs of STATE, with the given {GEOID: geometry} VTDs"
+    writeShapefile(VTD_LOCATION.format(state=STATE), [{
+        'STATEFP10': '19', 'COUNTYFP10': geoid[2:5], 'VTDST10': geoid[5:], 'GEOID10': geoid, 'VTDI10': 'A',
+        'NAME10': geoid[5:], 'NAMELSAD10': f"Voting District {geoid[5:]}", 'LSAD10': 'V2', 'MTFCC10': 'G5240',
+        'FUNCSTAT10': 'N', 'ALAND10': int(geometry.area), 'AWATER10': 0, 'INTPTLAT10': str(geometry.centroid.y),
+        'INTPTLON10': str(geometry.centroid.x), 'geometry': geometry,
+    } for geoid, geometry in vtds.items()])
+
+    tractGeoids = [f"19001{i + 1:04d}00" for i in range(len(TRACTS))]
+    writeShapefile(TRACTS_LOCATION.format(state=STATE), [{
+        'STATEFP': '19', 'COUNTYFP': '001', 'TRACTCE': geoid[5:], 'AFFGEOID': '1400000US' + geoid, 'GEOID': geoid,
+        'NAME': geoid[5:], 'LSAD': 'CT', 'ALAND': int(geometry.area), 'AWATER': 0, 'geometry': geometry,
+    } for geoid, geometry in zip(tractGeoids, TRACTS)])
+
+    demographics = pd.DataFrame({'GEOID': tractGeoids})
+    for i in range(8):
+        demographics[f'P00300{i + 1}'] = [(1000 + 37 * i) * (tract + 1) for tract in range(len(TRACTS))]
+    demographics.to_csv(DEMOGRAPHIC_LOCATION.format(state=STATE), index=False)
+
+def mergeDistricts(vtd_df):
+    "merge_districts_df, with shapely's bounding box test standing in for PostGIS"
+    districts = gpd.read_file(CONGRESSIONAL_DISTRICTS_LOCATION)
+    tabledict = {}
+    for _, district in districts.iterrows():
+        bounds = box(*district['geometry'].bounds)
+        for _, vtd in vtd_df.iterrows():
+            if not box(*vtd['geometry'].bounds).intersects(bounds):
+                continue
+            intersect = vtd['geometry'].intersection(district['geometry']).area
+            if vtd['GEOID'] not in tabledict or intersect > tabledict[vtd['GEOID']][1]:
+                tabledict[vtd['GEOID']] = (int(district['CD116FP']), intersect)
+    return pd.DataFrame(data={'geoid': list(tabledict), 'district': [entry[0] for entry in tabledict.values()]})
+
+def fullBuild():
+    "Runs the whole stateparser over STATE, apportioning every VTD, returns the cached frame"
+    stateHandle = stateparser.State(STATE)
+    stateHandle.loadVtd()
+    stateHandle.loadTracts()
+    stateHandle.loadDemographics()
+    stateHandle.loadVotes()
+    census_df = stateHandle.apportion(set(stateHandle._vtd_df['GEOID']))
+    stateHandle.finishMerge(census_df, mergeDistricts(stateHandle._vtd_df))
+    return loadCache()
+
+def loadCache():
+    with open(MERGED_DF_INPUT.format(state=STATE), 'rb') as handle:
+        return pickle.load(handle)
+
+class testStateparserUpdate(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        os.makedirs(os.path.dirname(STATEGRANULARITY_LOCATION))
+        with open(STATEGRANULARITY_LOCATION, 'w') as handle:
+            handle.write('iowa,county')
+        writeShapefile(CONGRESSIONAL_DISTRICTS_LOCATION, [
+            {'CD116FP': f'{i + 1:02d}', 'geometry': geometry} for i, geometry in enumerate(DISTRICTS)
+        ])
+        writeInputs(gridVtds())
+        fullBuild()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def testUpdateMatchesRebuild(self):
+        # Redraw a row of VTDs, moving one of them across the district line
+        vtds = gridVtds()
+        vtds[vtdGeoid(1, 1)] = box(10, 10, 11, 20)
+        vtds[vtdGeoid(2, 1)] = box(11, 10, 22, 20)
+        vtds[vtdGeoid(3, 1)] = box(22, 10, 40, 20)
+        writeInputs(vtds)
+
+        stateparser.update(STATE)
+        updated = loadCache()
+        rebuilt = fullBuild()
+        assert_geodataframe_equal(updated, rebuilt)
+        self.assertEqual(updated.loc[updated['GEOID'] == vtdGeoid(2, 1), 'district'].tolist(), [1])
+
+    def testUpdateDropsUnlistedRemovedVtd(self):
+        vtds = gridVtds()
+        vtds[vtdGeoid(0, 0)] = box(0, 0, 10, 5)
+        del vtds[vtdGeoid(3, 3)]
+        writeInputs(vtds)
+
+        # Only the reshaped VTD is listed, the removed one has no district (or row) anymore
+        stateparser.update(STATE, geoids=[vtdGeoid(0, 0)])
+        updated = loadCache()
+        self.assertNotIn(vtdGeoid(3, 3), updated['GEOID'].tolist())
+        assert_geodataframe_equal(updated, fullBuild())
+
+class testMergedSchema(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def enforced(self, df):
+        stateHandle = stateparser.State.__new__(stateparser.State)
+        stateHandle._demographic_df = df
+        stateHandle.enforceSchema()
+        return stateHandle._demographic_df
+
+    def frame(self):
+        population = dict((column, [0.0, 0.0]) for column in stateparser.POPULATION_COLUMNS)
+        population.update({'totalPop': [10.9, 4.2], 'otherPop': [0.6, 0.4], 'pacisPop': [0.6, 0.4], 'multiPop': [0.9, 0.4]})
+        return gpd.GeoDataFrame(dict(population, **{
+            'GEOID': ['19001000000', '19001000001'], 'name': ['North', 'South'], 'countyfp': ['001', '003'],
+            'district': [1.0, 2.0], 'land': [100.0, 200.0], 'water': [0.0, 5.0], 'vtdi': ['A', 'A'],
+            'geometry': [box(0, 0, 10, 10), box(10, 0, 20, 10)],
+        }), crs='EPSG:3857')
+
+    def testPackedFieldsSumBeforeTruncating(self):
+        df = self.enforced(self.frame())
+        self.assertNotIn('vtdi', df.columns)
+        self.assertEqual(str(df['otherPop'].dtype), 'float64')
+        self.assertEqual(str(df['district'].dtype), 'uint8')
+        # 0.6 + 0.6 + 0.9 packs as 2, not as the sum of the truncated columns
+        self.assertEqual(merged2output.packDemographicsTable(df).tolist(), [[10, 0, 0, 0, 0, 2], [4, 0, 0, 0, 0, 1]])
+        self.assertEqual([merged2output.packDemograpchics(row)[1] for _, row in df.iterrows()],
+                         merged2output.packDemographicsTable(df).tolist())
+
+    def testShapefileFromCache(self):
+        df = self.enforced(self.frame())
+        self.assertEqual(str(df['countyfp'].dtype), 'category')
+        os.makedirs(OUTPUT_PREFIX + STATE)
+        merged2output.toSHP(df, STATE)
+        written = gpd.read_file(os.path.join(merged2output.SHP_OUTPUT.format(state=STATE), f'{STATE}.shp'))
+        self.assertEqual(written['name'].tolist(), ['North', 'South'])
+        self.assertEqual(written['countyfp'].tolist(), ['001', '003'])
+        self.assertEqual(written['district'].tolist(), [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, 'gis2idx')
+from util import (
+    TEMPORARY_PATTERN,
+    atomicOpen,
+    cleanTemporaryFiles,
+    hostName,
+    replacePath,
+    temporaryPath
+)
+
+def deadPid():
+    "Returns the pid of a process that has exited"
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+class testTemporaryFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, name):
+        path = os.path.join(self.directory, name)
+        open(path, 'w').close()
+        return path
+
+    def testTemporaryPath(self):
+        path = os.path.join(self.directory, 'iowa.geo.json')
+        for temporary in [temporaryPath(path), temporaryPath(path, keepExtension=True)]:
+            match = TEMPORARY_PATTERN.match(os.path.basename(temporary))
+            self.assertEqual((match.group('host'), int(match.group('pid'))), (hostName(), os.getpid()))
+        self.assertTrue(temporaryPath(path, keepExtension=True).endswith('.part.json'))
+
+    def testAtomicOpen(self):
+        path = os.path.join(self.directory, 'iowa.idx')
+        with atomicOpen(path, 'wb') as handle:
+            handle.write(b'idx')
+        with self.assertRaises(RuntimeError):
+            with atomicOpen(path, 'wb') as handle:
+                handle.write(b'half')
+                raise RuntimeError()
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(), b'idx')
+        self.assertEqual(os.listdir(self.directory), ['iowa.idx'])
+
+    def testCleanOnlyDeadLocalProcesses(self):
+        pid = deadPid()
+        dead = self.touch(f".iowa.idx.{hostName()}-{pid}.part")
+        deadOld = self.touch(f".shp.{hostName()}-{pid}.part.old")
+        live = self.touch(f".iowa.json.{hostName()}-{os.getpid()}.part")
+        # A run on another host sharing the directory, its pid means nothing here
+        remote = self.touch(f".iowa.dmap.elsewhere-{pid}.part")
+        other = self.touch('iowa.idx')
+
+        self.assertEqual(sorted(cleanTemporaryFiles(self.directory)), sorted([dead, deadOld]))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(os.path.basename(path) for path in [live, remote, other]))
+
+    def testReplaceDirectory(self):
+        path = os.path.join(self.directory, 'shp')
+        for content in ['old', 'new']:
+            temporary = temporaryPath(path)
+            os.makedirs(temporary)
+            open(os.path.join(temporary, content), 'w').close()
+            replacePath(temporary, path)
+        self.assertEqual(os.listdir(path), ['new'])
+        self.assertEqual(os.listdir(self.directory), ['shp'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+from shapely.geometry import box
+
+sys.path.insert(0, 'gis2idx')
+import stateparser
+import votes
+
+def makeVtds():
+    return pd.DataFrame({
+        'GEOID': ['19001000001', '19001000002', '19003000001', '19003000002', '19005000001'],
+        'name': ['Precinct 2 Adair', 'Union', 'Union', 'Adair Township 3', 'Orient'],
+        'countyfp': ['001', '001', '003', '003', '005'],
+    })
+
+def makeVotes(rows):
+    "Returns a table like readVoteTables', from (geoid, name, countyfp, dem, rep, other) rows"
+    return pd.DataFrame(rows, columns=['geoid', 'name', 'countyfp', 'demVotes', 'repVotes', 'otherVotes'])
+
+def matched(table):
+    "Returns {GEOID: (dem, rep, other)} of a matchVotes table"
+    return dict((row['GEOID'], (row['demVotes'], row['repVotes'], row['otherVotes'])) for _, row in table.iterrows())
+
+class testMatchVotes(unittest.TestCase):
+    def testGeoid(self):
+        table = votes.matchVotes(makeVotes([
+            ('19005000001', 'Somewhere else', None, 10, 20, 3),
+            ('19005000001', None, None, 1, 2, 0),
+        ]), makeVtds())
+        self.assertEqual(matched(table), {'19005000001': (11, 22, 3)})
+
+    def testExactNameInCounty(self):
+        table = votes.matchVotes(makeVotes([
+            (None, 'UNION', '3', 5, 6, 1),
+            (None, 'Union Precinct', '001', 7, 8, 0),
+        ]), makeVtds())
+        self.assertEqual(matched(table), {'19003000001': (5, 6, 1), '19001000002': (7, 8, 0)})
+
+    def testNameTokenOrder(self):
+        self.assertEqual(votes.normalizeName('Adair 02'), votes.normalizeName('Precinct 2 Adair'))
+        table = votes.matchVotes(makeVotes([(None, 'Adair 2', '001', 4, 4, 4)]), makeVtds())
+        self.assertEqual(matched(table), {'19001000001': (4, 4, 4)})
+
+    def testFuzzyName(self):
+        table = votes.matchVotes(makeVotes([(None, 'Adair Twnship 3', '003', 9, 1, 0)]), makeVtds())
+        self.assertEqual(matched(table), {'19003000002': (9, 1, 0)})
+
+    def testUnmatched(self):
+        with self.assertLogs(level='WARNING') as logs:
+            table = votes.matchVotes(makeVotes([
+                (None, 'Nowhere', '001', 3, 3, 3),
+                ('19001000001', None, None, 1, 0, 0),
+            ]), makeVtds())
+        self.assertEqual(matched(table), {'19001000001': (1, 0, 0)})
+        self.assertIn('(9 votes)', logs.output[0])
+
+    def testReadVoteTables(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pd.DataFrame({'GEOID10': ['19001000001'], 'NAME': ['Adair 2'], 'COUNTYFP10': ['1'],
+                          'G16PREDCli': ['10'], 'G16PRERTru': ['20'], 'G16PRELJoh': ['3'], 'G16PREGSte': ['2']}
+                         ).to_csv(os.path.join(directory, 'votes.csv'), index=False)
+            table = votes.readVoteTables(directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(table.loc[0, ['geoid', 'name', 'countyfp']].tolist(), ['19001000001', 'Adair 2', '1'])
+        self.assertEqual(table.loc[0, ['demVotes', 'repVotes', 'otherVotes']].tolist(), [10, 20, 5])
+
+class testJoinVotes(unittest.TestCase):
+    def testVtdsWithoutVotes(self):
+        vtd_df = makeVtds()
+        vtd_df['land'] = 100
+        vtd_df['geometry'] = [box(i, 0, i + 1, 1) for i in range(len(vtd_df))]
+        census_df = pd.DataFrame({'geoid': vtd_df['GEOID'], 'totalPop': [10.5] * len(vtd_df)})
+        district_df = pd.DataFrame({'geoid': vtd_df['GEOID'], 'district': [1, 1, 2, 2, 3]})
+
+        stateHandle = stateparser.State.__new__(stateparser.State)
+        stateHandle._vtd_df = vtd_df
+        stateHandle._votes_df = votes.matchVotes(makeVotes([('19003000001', None, None, 5, 6, 1)]), vtd_df)
+        stateHandle.joinTables(census_df, district_df)
+
+        df = stateHandle._demographic_df.set_index('GEOID')
+        self.assertEqual(df.loc['19003000001', stateparser.VOTE_COLUMNS].tolist(), [5, 6, 1])
+        self.assertEqual(df[stateparser.VOTE_COLUMNS].drop('19003000001').values.sum(), 0)
+        self.assertFalse(df[stateparser.VOTE_COLUMNS].isna().any().any())
+
+if __name__ == '__main__':
+    unittest.main()